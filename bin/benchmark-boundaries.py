@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+
+# This script times alternative implementations of parts of the
+# boundary extraction code in boundaries.py against each other, using
+# the Overpass responses that the tests use.  For example:
+#
+#   bin/benchmark-boundaries.py parsers
+#
+# Run it with no arguments to see the benchmarks that are available.
+
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+import os
+import random
+import shutil
+import stat
+import sys
+from tempfile import mkdtemp
+import timeit
+import tracemalloc
+import xml.sax
+
+from lxml import etree
+
+from mock import patch
+
+from boundaries import (
+    PARSER_ENGINES, ArrayWay, CompactNode, EndpointIndex, EndpointToWayMap, Node, OSMXMLParser, Osm3sQueryBroker,
+    Way, config, dump_parsed_element, fetch_cached, get_element_from_store, join_way_soup, load_parsed_element,
+    orjson, parse_xml_string, read_boundaries_from_pbf, xml_to_overpass_json)
+import boundaries
+from element_cache import ELEMENT_CACHE_BACKENDS
+from element_store import ElementStore, ElementStoreLoader
+from osm_pbf import write_pbf
+from generate_kml import get_kml_for_osm_element_no_fetch
+
+fixtures_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  '..',
+                                  'mapit_global',
+                                  'tests',
+                                  'overpass-responses')
+
+
+def fixture_filenames():
+    return sorted(glob(os.path.join(fixtures_directory, '*.xml')))
+
+
+def best_time(f, repeat):
+    """Return the fastest time in seconds of repeat calls to f"""
+    return min(timeit.repeat(f, number=1, repeat=repeat))
+
+
+def allocated_by(f):
+    """Call f and return its result and the bytes it left allocated"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = f()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, after - before
+
+
+def benchmark_parsers(repeat):
+    """Compare the XML parser engines on each Overpass response"""
+    cache_directory = mkdtemp()
+    try:
+        for filename in fixture_filenames():
+            with open(filename, encoding='utf-8') as f:
+                data = f.read()
+            print(os.path.basename(filename))
+            for engine in PARSER_ENGINES:
+                seconds = best_time(
+                    lambda: parse_xml_string(data,
+                                             fetch_missing=False,
+                                             cache_directory=cache_directory,
+                                             engine=engine),
+                    repeat)
+                print("  %-6s %10.2f ms" % (engine, seconds * 1000))
+    finally:
+        shutil.rmtree(cache_directory)
+
+
+def benchmark_json(repeat):
+    """Compare parsing Overpass XML and JSON responses for the same elements"""
+    cache_directory = mkdtemp()
+    print("JSON decoded with", "orjson" if orjson else "json")
+    try:
+        for filename in fixture_filenames():
+            with open(filename, encoding='utf-8') as f:
+                xml = f.read()
+            data = xml_to_overpass_json(xml)
+            print("%s (XML %d KiB, JSON %d KiB)" % (os.path.basename(filename), len(xml) // 1024, len(data) // 1024))
+            cases = [('xml', xml, engine) for engine in PARSER_ENGINES] + [('json', data, None)]
+            for label, response, engine in cases:
+                seconds = best_time(
+                    lambda: parse_xml_string(response,
+                                             fetch_missing=False,
+                                             cache_directory=cache_directory,
+                                             engine=engine),
+                    repeat)
+                print("  %-12s %10.2f ms" % (label + (' ' + engine if engine else ''), seconds * 1000))
+    finally:
+        shutil.rmtree(cache_directory)
+
+
+def benchmark_node_memory(repeat):
+    """Compare the memory used by Node and CompactNode objects"""
+    filename = os.path.join(fixtures_directory, 'relation-58446.xml')
+    with open(filename, encoding='utf-8') as f:
+        data = f.read()
+    # Keep the attributes as bytes, so that each node is created from
+    # new strings, as it would be when parsing:
+    coordinates = []
+    parse_xml_string(data, fetch_missing=False, compact_nodes=True,
+                     callback=lambda e, p: coordinates.append(
+                         tuple(a.encode('ascii') for a in (e.element_id, e.lat, e.lon)))
+                     if e.element_type == 'node' else None)
+    print("%d nodes from %s" % (len(coordinates), os.path.basename(filename)))
+    for node_class in (Node, CompactNode):
+        nodes, allocated = allocated_by(
+            lambda: [node_class(i.decode(), latitude=lat.decode(), longitude=lon.decode())
+                     for i, lat, lon in coordinates])
+        print("  %-12s %8.1f bytes per node" % (node_class.__name__, allocated / float(len(nodes))))
+    cache_directory = mkdtemp()
+    try:
+        for compact_nodes in (False, True):
+            parser, allocated = allocated_by(
+                lambda: parse_xml_string(data,
+                                         fetch_missing=False,
+                                         cache_directory=cache_directory,
+                                         compact_nodes=compact_nodes))
+            print("  parsed with compact_nodes=%-5s %8.1f KiB" % (compact_nodes, allocated / 1024.0))
+    finally:
+        shutil.rmtree(cache_directory)
+
+
+def parse_fixture_relation(relation_id, cache_directory, **parser_kwargs):
+    """Parse the fixture for a relation, returning the complete Relation"""
+    filename = os.path.join(fixtures_directory, 'relation-%s.xml' % (relation_id,))
+    with open(filename, encoding='utf-8') as f:
+        parser = parse_xml_string(f.read(),
+                                  fetch_missing=False,
+                                  cache_directory=cache_directory,
+                                  **parser_kwargs)
+    relation = parser.known_relations[relation_id]
+    relation.reconstruct_missing(parser, {})
+    return relation
+
+
+def benchmark_way_geometry(repeat):
+    """Compare KML generation from Ways of Nodes and from ArrayWays"""
+    cache_directory = mkdtemp()
+    try:
+        for relation_id in ('295353', '58446'):
+            print("relation", relation_id)
+            for label, parser_kwargs in (
+                    ('Node Ways', {}),
+                    ('CompactNode Ways', {'compact_nodes': True}),
+                    ('ArrayWays', {'compact_nodes': True, 'array_ways': True})):
+                relation, allocated = allocated_by(
+                    lambda: parse_fixture_relation(relation_id, cache_directory, **parser_kwargs))
+                seconds = best_time(lambda: get_kml_for_osm_element_no_fetch(relation), repeat)
+                print("  %-18s KML in %8.2f ms, parsed data %8.1f KiB" % (
+                    label, seconds * 1000, allocated / 1024.0))
+    finally:
+        shutil.rmtree(cache_directory)
+
+
+def benchmark_cache_lookup(repeat, elements=20000, lookups=2000):
+    """Compare the lookup latency of the element cache backends"""
+    with open(os.path.join(fixtures_directory, 'node-1000000000000.xml'), encoding='utf-8') as f:
+        data = f.read()
+    keys = [('way', str(i)) for i in range(1, elements * 7, 7)]
+    rng = random.Random(0)
+    hits = [rng.choice(keys) for i in range(lookups)]
+    misses = [('way', str(i)) for i in range(2, lookups * 7, 7)]
+    print("%d elements, %d lookups" % (elements, lookups))
+    for backend, make_cache in sorted(ELEMENT_CACHE_BACKENDS.items()):
+        cache_directory = mkdtemp()
+        try:
+            cache = make_cache(cache_directory)
+            cache.put_many((element_type, element_id, data) for element_type, element_id in keys)
+            for label, to_look_up in (('hit', hits), ('miss', misses)):
+                seconds = best_time(lambda: [cache.get(*k) for k in to_look_up], repeat)
+                print("  %-10s %-5s %8.2f us per lookup" % (backend, label, seconds * 1e6 / len(to_look_up)))
+            cache.close()
+        finally:
+            shutil.rmtree(cache_directory)
+
+
+def benchmark_parsed_cache(repeat):
+    """Compare parsing cached XML with loading pre-parsed elements"""
+    cache_directory = mkdtemp()
+    try:
+        for relation_id in ('295353', '58446'):
+            print("relation", relation_id)
+            for label, parser_kwargs in (
+                    ('Node Ways', {}),
+                    ('ArrayWays', {'compact_nodes': True, 'array_ways': True})):
+                xml_seconds = best_time(
+                    lambda: parse_fixture_relation(relation_id, cache_directory, **parser_kwargs), repeat)
+                data = dump_parsed_element(parse_fixture_relation(relation_id, cache_directory, **parser_kwargs))
+                parser = OSMXMLParser(fetch_missing=False, cache_directory=cache_directory, **parser_kwargs)
+                load_seconds = best_time(lambda: load_parsed_element(data, parser), repeat)
+                print("  %-10s XML %8.2f ms, pre-parsed %8.2f ms (%d KiB)" % (
+                    label, xml_seconds * 1000, load_seconds * 1000, len(data) // 1024))
+    finally:
+        shutil.rmtree(cache_directory)
+
+
+def to_inline_geometry(xml):
+    """Rewrite a response as if its query were from get_query_with_inline_geometry
+
+    Nodes that are only in ways are dropped, and their locations put
+    in the ways' <nd> elements instead; the tags of dependent elements
+    are dropped too.
+    """
+    root = etree.fromstring(xml.encode('utf-8'))
+    nodes = dict((e.get('id'), e) for e in root if e.tag == 'node')
+    top_level = set(e.get('id') for e in root if e.tag == 'relation')
+    member_nodes = set(m.get('ref') for m in root.iter('member') if m.get('type') == 'node')
+    for e in list(root):
+        if e.tag == 'node' and e.get('id') not in member_nodes:
+            root.remove(e)
+            continue
+        if e.tag != 'relation' and top_level:
+            for tag in e.findall('tag'):
+                e.remove(tag)
+        for nd in e.iter('nd'):
+            node = nodes.get(nd.get('ref'))
+            if node is not None:
+                nd.set('lat', node.get('lat'))
+                nd.set('lon', node.get('lon'))
+    return etree.tostring(root, encoding='unicode')
+
+
+def benchmark_inline_geometry(repeat):
+    """Compare parsing responses with separate nodes and with inline way geometry"""
+    cache_directory = mkdtemp()
+    try:
+        for relation_id in ('295353', '58446'):
+            filename = os.path.join(fixtures_directory, 'relation-%s.xml' % (relation_id,))
+            with open(filename, encoding='utf-8') as f:
+                xml = f.read()
+            inline = to_inline_geometry(xml)
+            print("relation %s (%d KiB, inline geometry %d KiB)" % (
+                relation_id, len(xml) // 1024, len(inline) // 1024))
+            kml = {}
+            for label, response in (('separate', xml), ('inline', inline)):
+                def parse():
+                    parser = parse_xml_string(response, fetch_missing=False, cache_directory=cache_directory)
+                    relation = parser.known_relations[relation_id]
+                    relation.reconstruct_missing(parser, {})
+                    return relation
+                seconds = best_time(parse, repeat)
+                kml[label] = get_kml_for_osm_element_no_fetch(parse())
+                print("  %-10s %10.2f ms" % (label, seconds * 1000))
+            print("  same KML:", kml['separate'] == kml['inline'])
+    finally:
+        shutil.rmtree(cache_directory)
+
+
+def benchmark_element_store(repeat):
+    """Compare making relations from the element store with parsing their responses"""
+    tmp_directory = mkdtemp()
+    try:
+        store = ElementStore(os.path.join(tmp_directory, 'element-store.sqlite3'))
+        loader = ElementStoreLoader(store)
+        for filename in fixture_filenames():
+            with open(filename, 'rb') as f:
+                xml.sax.parse(f, loader)
+        loader.close()
+        print("loaded %d nodes, %d ways and %d relations" % (
+            loader.counts['node'], loader.counts['way'], loader.counts['relation']))
+        for relation_id in ('295353', '58446'):
+            parse_seconds = best_time(lambda: parse_fixture_relation(relation_id, tmp_directory), repeat)
+            store_seconds = best_time(lambda: get_element_from_store(store, 'relation', relation_id), repeat)
+            from_store = get_element_from_store(store, 'relation', relation_id)
+            from_response = parse_fixture_relation(relation_id, tmp_directory)
+            same = [w.lon_lat_tuples() for w in from_store.way_iterator()] == \
+                [w.lon_lat_tuples() for w in from_response.way_iterator()]
+            print("  relation %-8s response %8.2f ms, element store %8.2f ms, same ways: %s" % (
+                relation_id, parse_seconds * 1000, store_seconds * 1000, same))
+        store.close()
+    finally:
+        shutil.rmtree(tmp_directory)
+
+
+def benchmark_pbf(repeat, block_size=1000):
+    """Compare reading boundaries from a PBF file in one process and in several"""
+    elements = {}
+    for filename in fixture_filenames():
+        for e in etree.parse(filename).getroot():
+            if e.tag == 'node':
+                value = (int(round(float(e.get('lat')) * 1e7)), int(round(float(e.get('lon')) * 1e7)))
+            elif e.tag == 'way':
+                value = [int(nd.get('ref')) for nd in e.iter('nd')]
+            elif e.tag == 'relation':
+                value = [(m.get('type'), int(m.get('ref')), m.get('role')) for m in e.iter('member')]
+            else:
+                continue
+            tags = dict((t.get('k'), t.get('v')) for t in e.iter('tag'))
+            elements[(e.tag, int(e.get('id')))] = (e.tag, int(e.get('id')), value, tags)
+    tmp_directory = mkdtemp()
+    try:
+        pbf_filename = os.path.join(tmp_directory, 'fixtures.osm.pbf')
+        with open(pbf_filename, 'wb') as fp:
+            write_pbf(fp, sorted(elements.values(), key=lambda e: (('node', 'way', 'relation').index(e[0]), e[1])),
+                      block_size)
+        print("%d elements in %d KiB of PBF, in blocks of %d" % (
+            len(elements), os.path.getsize(pbf_filename) // 1024, block_size))
+        tag_filters = [{'boundary': 'administrative', 'admin_level': '8'},
+                       {'boundary': 'administrative', 'admin_level': '4'}]
+        kml = {}
+        for processes in (1, 2, 4):
+            seconds = best_time(lambda: read_boundaries_from_pbf(pbf_filename, tag_filters, processes), repeat)
+            relations = [e for e in read_boundaries_from_pbf(pbf_filename, tag_filters, processes)
+                         if e.element_type == 'relation']
+            kml[processes] = [get_kml_for_osm_element_no_fetch(r) for r in relations]
+            print("  %d processes %10.2f ms for %d relations" % (processes, seconds * 1000, len(relations)))
+        for relation_id in ('295353', '58446'):
+            relation = parse_fixture_relation(relation_id, tmp_directory)
+            print("  relation %s KML same as from Overpass: %s" % (
+                relation_id, get_kml_for_osm_element_no_fetch(relation) in kml[1]))
+    finally:
+        shutil.rmtree(tmp_directory)
+
+
+# A stand-in for osm3s_query, which answers queries from the Overpass
+# responses that the tests use, merging them for a query for several
+# elements.  Like the real thing, it's a new process for each query:
+STUB_OSM3S_QUERY = '''#!%(python)s
+import os
+import re
+import sys
+from lxml import etree
+
+query = sys.stdin.read()
+merged = etree.Element('osm', version='0.6', generator='Overpass API')
+seen = set()
+for element_id, element_type in re.findall(r'ref="(\\d+)" type="(\\w+)"', query):
+    filename = os.path.join(%(fixtures)r, '%%s-%%s.xml' %% (element_type, element_id))
+    if not os.path.exists(filename):
+        continue
+    for e in etree.parse(filename).getroot():
+        if e.get('id') and (e.tag, e.get('id')) not in seen:
+            seen.add((e.tag, e.get('id')))
+            merged.append(e)
+sys.stdout.buffer.write(etree.tostring(merged, encoding='utf-8', xml_declaration=True))
+'''
+
+
+def benchmark_osm3s_broker(repeat, elements=40, threads=8):
+    """Compare one osm3s_query per element with the Osm3sQueryBroker"""
+    stub_directory = mkdtemp()
+    try:
+        stub = os.path.join(stub_directory, 'osm3s_query')
+        with open(stub, 'w') as f:
+            f.write(STUB_OSM3S_QUERY % {'python': sys.executable, 'fixtures': fixtures_directory})
+        os.chmod(stub, os.stat(stub).st_mode | stat.S_IXUSR)
+        # Mostly small responses, as most elements are nodes and ways:
+        small = [('node', '1000000000000'), ('node', '1000000000001'), ('relation', '10000000000')]
+        requests = (small * elements)[:elements - 2] + [('relation', '295353'), ('relation', '58446')]
+        path = stub_directory + os.pathsep + os.environ.get('PATH', '')
+        print("%d elements fetched by %d threads with a stub osm3s_query" % (len(requests), threads))
+        for label, broker in (('per element', None), ('broker', Osm3sQueryBroker(workers=2))):
+            def fetch_all():
+                with ThreadPoolExecutor(max_workers=threads) as executor:
+                    return list(executor.map(lambda t: fetch_cached(*t), requests))
+            with patch.dict(os.environ, {'PATH': path}), \
+                    patch.dict(config, {'LOCAL_OVERPASS': True}), \
+                    patch.object(boundaries, 'get_osm3s_broker', return_value=broker):
+                seconds = best_time(fetch_all, repeat)
+            processes = '%d processes' % (broker.queries / float(repeat),) if broker else ''
+            print("  %-12s %8.2f ms %s" % (label, seconds * 1000, processes))
+            if broker:
+                broker.close()
+    finally:
+        shutil.rmtree(stub_directory)
+
+
+def pairwise_join_way_soup(ways):
+    """join_way_soup as it was, joining ways with Way.join as they're found"""
+    closed_ways = []
+    endpoints_to_ways = EndpointToWayMap()
+    for way in ways:
+        if way.closed():
+            closed_ways.append(way)
+            continue
+        to_join_to = endpoints_to_ways.get_from_either_end(way)
+        if to_join_to:
+            joined = way
+            for existing_way in to_join_to:
+                joined = joined.join(existing_way)
+                endpoints_to_ways.remove_way(existing_way)
+                if joined.closed():
+                    closed_ways.append(joined)
+                    break
+            if not joined.closed():
+                endpoints_to_ways.add_way(joined)
+        else:
+            endpoints_to_ways.add_way(way)
+    return closed_ways
+
+
+def synthetic_way_soup(way_class, ways, nodes_per_way, shuffle, rings=2):
+    """Return the ways of a relation with rings made of many ways each
+
+    They're in order around each ring, as relations' members usually
+    are, unless shuffle is set."""
+    random.seed(1)
+    result = []
+    node_id = 1
+    for ring in range(rings):
+        total = ways // rings * (nodes_per_way - 1)
+        nodes = [CompactNode(node_id + i, latitude=50 + (i % 1000) * 1e-3, longitude=ring + i * 1e-5)
+                 for i in range(total)]
+        nodes.append(nodes[0])
+        node_id += total
+        for i in range(0, total, nodes_per_way - 1):
+            way_nodes = nodes[i:i + nodes_per_way]
+            if random.random() < 0.5:
+                way_nodes.reverse()
+            result.append(way_class(str(len(result) + 1), nodes=way_nodes))
+    if shuffle:
+        random.shuffle(result)
+    return result
+
+
+def benchmark_ring_assembly(repeat, ways=12000, nodes_per_way=20):
+    """Compare joining ways pairwise with the RingAssembler in join_way_soup"""
+    print("%d ways of %d nodes each, in 2 rings" % (ways, nodes_per_way))
+    for shuffle in (False, True):
+        for way_class in (Way, ArrayWay):
+            soup = synthetic_way_soup(way_class, ways, nodes_per_way, shuffle)
+            results = {}
+            for label, f in (('pairwise', pairwise_join_way_soup), ('assembler', join_way_soup)):
+                seconds = best_time(lambda: f(soup), repeat)
+                results[label] = [r.float_lon_lat_tuples() for r in f(soup)]
+                print("  %-8s %-8s %-9s %10.2f ms" % (
+                    'shuffled' if shuffle else 'in order', way_class.__name__, label, seconds * 1000))
+            print("  Same rings:", results['pairwise'] == results['assembler'])
+
+
+def benchmark_endpoint_probes(repeat, ways=20000):
+    """Compare looking up endpoints by Node in EndpointToWayMap and by ID in EndpointIndex"""
+    print("%d probes, half of them for endpoints that are there" % (2 * ways,))
+    for node_class in (Node, CompactNode):
+        soup = [Way(str(i), nodes=[node_class(str(2 * i), latitude='52', longitude='1'),
+                                   node_class(str(2 * i + 1), latitude='52', longitude='2')])
+                for i in range(ways)]
+        by_node = EndpointToWayMap()
+        by_id = EndpointIndex()
+        for way in soup[::2]:
+            by_node.add_way(way)
+            first, last = way.end_node_ids()
+            by_id.add([first, last, way, way])
+        ends = [way.end_node_ids() for way in soup]
+        for label, probe in (
+                ('by Node', lambda: [by_node.get_from_either_end(way) for way in soup]),
+                ('by ID', lambda: [(by_id.get(first), by_id.get(last)) for first, last in ends])):
+            seconds = best_time(probe, repeat)
+            print("  %-12s %-8s %8.1f ns per probe" % (node_class.__name__, label, seconds * 1e9 / (2 * ways)))
+
+
+benchmarks = {
+    'cache-lookup': benchmark_cache_lookup,
+    'element-store': benchmark_element_store,
+    'endpoint-probes': benchmark_endpoint_probes,
+    'inline-geometry': benchmark_inline_geometry,
+    'json': benchmark_json,
+    'parsers': benchmark_parsers,
+    'pbf': benchmark_pbf,
+    'ring-assembly': benchmark_ring_assembly,
+    'parsed-cache': benchmark_parsed_cache,
+    'node-memory': benchmark_node_memory,
+    'osm3s-broker': benchmark_osm3s_broker,
+    'way-geometry': benchmark_way_geometry,
+}
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+    parser = OptionParser(usage="Usage: %prog [options] BENCHMARK...")
+    parser.add_option("--repeat", dest="repeat", type="int", default=5,
+                      help="Take the best of this many runs (default 5)")
+
+    (options, args) = parser.parse_args()
+
+    unknown = [a for a in args if a not in benchmarks]
+    if not args or unknown:
+        parser.print_help(file=sys.stderr)
+        print("\nThe available benchmarks are:", file=sys.stderr)
+        for name, f in sorted(benchmarks.items()):
+            print("  %-20s %s" % (name, f.__doc__), file=sys.stderr)
+        sys.exit(1)
+
+    for name in args:
+        print("==", name)
+        benchmarks[name](options.repeat)
@@ -1,29 +1,145 @@
 #!/usr/bin/env python
 
 import errno
+import json
+from email.utils import parsedate_to_datetime
 from mock import Mock, patch # noqa
 import requests
 import os
 from os.path import dirname, join
+import queue
+import random
 import re
+import struct
 import sys
+import threading
+import time
 import xml.sax
 from xml.sax.handler import ContentHandler
 import yaml
+from array import array
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from lxml import etree
 from subprocess import Popen, PIPE
+from tempfile import TemporaryFile
+from types import MappingProxyType
 
 # The following are only used by doctests, hence noqa
 import shutil  # noqa
+from datetime import datetime, timezone  # noqa
 from tempfile import mkdtemp, NamedTemporaryFile  # noqa
 
-from io import StringIO
+from io import BytesIO, StringIO
+
+from element_cache import ELEMENT_CACHE_BACKENDS, DirectoryElementCache, MissingElementCache
+from dependency_index import DependencyIndex
+from element_store import ElementStore, ElementStoreLoader, apply_osm_change
+from lru_cache import LRUCache, WeightedLRUCache
+from node_locations import DenseNodeLocations
+from osm_pbf import PBFExtract, write_pbf
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 with open(os.path.join(
         os.path.dirname(__file__), '..', 'conf', 'general.yml')) as f:
     config = yaml.load(f, Loader=yaml.SafeLoader)
 
-CACHE_VISITED = set()
+# The DenseNodeLocations shared by all parsers if NODE_LOCATIONS_FILE
+# is set; see get_default_node_locations:
+DEFAULT_NODE_LOCATIONS = None
+DEFAULT_NODE_LOCATIONS_LOCK = threading.Lock()
+
+# The hits, misses and evictions of the in-memory caches of every
+# parser, added to by OSMXMLParser.record_cache_statistics:
+IN_MEMORY_CACHE_TOTALS = {}
+IN_MEMORY_CACHE_TOTALS_LOCK = threading.Lock()
+
+# The elements that have been parsed from the on-disk cache by any
+# parser in this process, kept in the binary form from
+# dump_parsed_element and limited by the total size of that; see
+# get_known_or_fetch:
+PARSED_FILE_MEMO = WeightedLRUCache(config.get('PARSED_FILE_MEMO_SIZE', 256 * 1024 * 1024) or 0)
+PARSED_FILE_MEMO_LOCK = threading.Lock()
+
+# The element caches returned by get_element_cache, keyed by backend,
+# cache directory and compression:
+ELEMENT_CACHES = {}
+ELEMENT_CACHES_LOCK = threading.Lock()
+
+# The records of missing elements returned by get_missing_element_cache,
+# keyed by cache directory and TTL:
+MISSING_ELEMENT_CACHES = {}
+MISSING_ELEMENT_CACHES_LOCK = threading.Lock()
+
+# The element stores returned by get_element_store, keyed by cache
+# directory:
+ELEMENT_STORES = {}
+ELEMENT_STORES_LOCK = threading.Lock()
+
+# The DependencyIndex for each cache directory; see
+# get_dependency_index:
+DEPENDENCY_INDEXES = {}
+DEPENDENCY_INDEXES_LOCK = threading.Lock()
+
+# The requests.Session shared by every query to a remote Overpass
+# server; see get_overpass_session:
+OVERPASS_SESSION = None
+OVERPASS_SESSION_LOCK = threading.Lock()
+
+# The Osm3sQueryBroker used for queries for single elements with a
+# local Overpass database; see get_osm3s_broker:
+OSM3S_BROKER = None
+OSM3S_BROKER_LOCK = threading.Lock()
+
+# Responses from a remote Overpass server that mean it's too busy, or
+# timed out, so the query should be retried after a while:
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# How long, in seconds, an element that a query found nothing for is
+# remembered as missing, if MISSING_ELEMENT_TTL isn't set:
+DEFAULT_MISSING_ELEMENT_TTL = 7 * 24 * 60 * 60
+
+# The XML parsing engines that can be used for OSM XML: 'sax' uses
+# the standard library's xml.sax, and 'lxml' uses lxml's iterparse.
+PARSER_ENGINES = ('sax', 'lxml')
+
+# The formats that Overpass responses for single elements can be
+# requested in.  Responses in either format can be parsed, whichever
+# this is set to:
+OVERPASS_OUTPUTS = ('xml', 'json')
+
+# CompactNode stores coordinates as integers in units of 10^-7
+# degrees, which is the precision that OSM uses:
+FIXED_POINT_SCALE = 10 ** 7
+
+# A read-only, shared tags mapping for elements that have no tags:
+EMPTY_TAGS = MappingProxyType({})
+
+# ArrayWay stores the coordinates of missing nodes as NaN:
+NAN = float('nan')
+
+# Pre-parsed elements (see dump_parsed_element) start with this magic
+# number and format version; the version must be changed whenever the
+# format is, so that out-of-date pre-parsed elements are ignored:
+PARSED_ELEMENT_MAGIC = b'OSMP'
+PARSED_ELEMENT_FORMAT_VERSION = 1
+PARSED_ELEMENT_TYPES = ('node', 'way', 'relation')
+# The fixed-point coordinate used for missing nodes in pre-parsed ways:
+MISSING_COORDINATE = -2 ** 31
+
+# The number of elements fetched per query by fetch_missing_batched,
+# unless it's told otherwise:
+DEFAULT_OVERPASS_BATCH_SIZE = 50
 
 
 # Suggested by http://stackoverflow.com/q/600268/223092
@@ -70,15 +186,182 @@ def mkdir_p(path):
             raise
 
 
-def get_query_relation_and_dependents(element_type, element_id):
-    return """<osm-script timeout="3600">
+def get_overpass_output(output=None):
+    """Return the format to request Overpass responses for elements in
+
+    If no format is specified, the OVERPASS_OUTPUT setting from
+    general.yml is used, falling back to 'xml':
+
+    >>> with patch.dict(config, {'OVERPASS_OUTPUT': 'json'}):
+    ...     get_overpass_output()
+    'json'
+    >>> get_overpass_output('csv')
+    Traceback (most recent call last):
+      ...
+    Exception: Unknown Overpass output format 'csv'
+    """
+    if output is None:
+        output = config.get('OVERPASS_OUTPUT') or 'xml'
+    if output not in OVERPASS_OUTPUTS:
+        raise Exception("Unknown Overpass output format '%s'" % (output,))
+    return output
+
+
+def get_osm_script_start(output=None):
+    """Return the opening <osm-script> tag of a query for elements"""
+    if get_overpass_output(output) == 'json':
+        return '<osm-script output="json" timeout="3600">'
+    return '<osm-script timeout="3600">'
+
+
+def get_inline_way_geometry(geometry=None):
+    """Return whether to ask Overpass for way geometry inline
+
+    If this isn't specified, the INLINE_WAY_GEOMETRY setting from
+    general.yml is used, which is False by default.
+    """
+    if geometry is None:
+        geometry = config.get('INLINE_WAY_GEOMETRY', False)
+    return bool(geometry)
+
+
+def get_query_with_inline_geometry(element_type_id_tuples, output=None):
+    """Return a query for elements with the geometry of ways inline
+
+    Rather than recursing down to every node, this asks for the member
+    ways and nodes of relations as skeletons (with no tags) and for
+    ways with geometry="full", so that each <nd> has the location of
+    its node as well as its ref, and no separate <node> elements are
+    needed for them.  The members are printed first, so that a parser
+    already knows them when it reaches the relations:
+
+    >>> print(get_query_with_inline_geometry([('way', '12'), ('relation', '34')], output='xml'), end='')
+    <osm-script timeout="3600">
+      <union into="relations">
+        <id-query into="relations" ref="34" type="relation"/>
+      </union>
+      <union into="members">
+        <recurse from="relations" into="members" type="relation-way"/>
+        <recurse from="relations" into="members" type="relation-node"/>
+      </union>
+      <print from="members" geometry="full" limit="" mode="skeleton" order="id"/>
+      <union into="elements">
+        <id-query into="elements" ref="12" type="way"/>
+      </union>
+      <print from="elements" geometry="full" limit="" mode="body" order="id"/>
+      <print from="relations" limit="" mode="body" order="id"/>
+    </osm-script>
+
+    (Relations are printed without geometry="full", since that would
+    repeat the geometry of every member way within the relation.)
+    """
+    def id_queries(set_name, element_types):
+        return "\n".join('    <id-query into="%s" ref="%s" type="%s"/>' % (set_name, element_id, element_type)
+                         for element_type, element_id in element_type_id_tuples
+                         if element_type in element_types)
+    relations = id_queries('relations', ('relation',))
+    elements = id_queries('elements', ('node', 'way'))
+    lines = [get_osm_script_start(output)]
+    if relations:
+        lines += ['  <union into="relations">',
+                  relations,
+                  '  </union>',
+                  '  <union into="members">',
+                  '    <recurse from="relations" into="members" type="relation-way"/>',
+                  '    <recurse from="relations" into="members" type="relation-node"/>',
+                  '  </union>',
+                  '  <print from="members" geometry="full" limit="" mode="skeleton" order="id"/>']
+    if elements:
+        lines += ['  <union into="elements">',
+                  elements,
+                  '  </union>',
+                  '  <print from="elements" geometry="full" limit="" mode="body" order="id"/>']
+    if relations:
+        lines.append('  <print from="relations" limit="" mode="body" order="id"/>')
+    lines.append('</osm-script>')
+    return "\n".join(lines) + "\n"
+
+
+def get_query_relation_and_dependents(element_type, element_id, output=None, geometry=None):
+    """Return a query for an element and its dependents
+
+    The response is in the format set by output, as with
+    get_overpass_output.  If geometry is True (see
+    get_inline_way_geometry) the query is one from
+    get_query_with_inline_geometry instead:
+
+    >>> print(get_query_relation_and_dependents('way', '12', output='json'), end='')
+    <osm-script output="json" timeout="3600">
+      <union into="_">
+        <id-query into="_" ref="12" type="way"/>
+        <recurse from="_" into="_" type="down"/>
+      </union>
+      <print from="_" limit="" mode="body" order="id"/>
+    </osm-script>
+    """
+    if get_inline_way_geometry(geometry):
+        return get_query_with_inline_geometry([(element_type, element_id)], output)
+    return """%s
   <union into="_">
     <id-query into="_" ref="%s" type="%s"/>
     <recurse from="_" into="_" type="down"/>
   </union>
   <print from="_" limit="" mode="body" order="id"/>
 </osm-script>
-""" % (element_id, element_type)
+""" % (get_osm_script_start(output), element_id, element_type)
+
+
+def get_query_elements_and_dependents(element_type, element_ids=None, output=None, geometry=None):
+    """Return a query for several elements and their dependents
+
+    This is like get_query_relation_and_dependents, but the elements
+    are found by a union of id-queries, so that one request to the
+    Overpass API can fetch many of them.  They can be given as a type
+    and a list of IDs, or as a list of (type, ID) tuples.  As with
+    get_query_relation_and_dependents, geometry selects a query from
+    get_query_with_inline_geometry:
+
+    >>> print(get_query_elements_and_dependents('way', ['12', '13'], output='xml'), end='')
+    <osm-script timeout="3600">
+      <union into="_">
+        <union into="_">
+          <id-query into="_" ref="12" type="way"/>
+          <id-query into="_" ref="13" type="way"/>
+        </union>
+        <recurse from="_" into="_" type="down"/>
+      </union>
+      <print from="_" limit="" mode="body" order="id"/>
+    </osm-script>
+    >>> print(get_query_elements_and_dependents([('node', '5'), ('way', '12')], output='xml'), end='')
+    <osm-script timeout="3600">
+      <union into="_">
+        <union into="_">
+          <id-query into="_" ref="5" type="node"/>
+          <id-query into="_" ref="12" type="way"/>
+        </union>
+        <recurse from="_" into="_" type="down"/>
+      </union>
+      <print from="_" limit="" mode="body" order="id"/>
+    </osm-script>
+    """
+    if element_ids is None:
+        element_type_id_tuples = element_type
+    else:
+        element_type_id_tuples = [(element_type, element_id) for element_id in element_ids]
+    if get_inline_way_geometry(geometry):
+        return get_query_with_inline_geometry(element_type_id_tuples, output)
+    id_queries = "\n".join('      <id-query into="_" ref="%s" type="%s"/>' % (element_id, element_type)
+                           for element_type, element_id in element_type_id_tuples)
+    return """%s
+  <union into="_">
+    <union into="_">
+%s
+    </union>
+    <recurse from="_" into="_" type="down"/>
+  </union>
+  <print from="_" limit="" mode="body" order="id"/>
+</osm-script>
+""" % (get_osm_script_start(output), id_queries)
 
 
 def get_query_relations_and_ways(required_tags):
@@ -97,19 +380,87 @@ def get_query_relations_and_ways(required_tags):
 </osm-script>""" % (has_kv, has_kv)
 
 
-def get_from_overpass(query_xml, filename):
+def get_query_boundaries_and_dependents(tag_filters):
+    """Return one query for every boundary and everything they're made of
+
+    The boundaries are the relations and ways whose tags match one
+    of tag_filters (each a dictionary of tags that must all be
+    present), as with get_query_relations_and_ways.  Their members
+    are found recursively, including member relations, along with the
+    nodes of every way.  The response is huge for the whole planet,
+    so the query's timeout and memory limit are much bigger than for
+    other queries:
+
+    >>> print(get_query_boundaries_and_dependents([{'boundary': 'political', 'political_division': 'ward'}]), end='')
+    <osm-script element-limit="68719476736" timeout="86400">
+      <union into="boundaries">
+        <query into="_" type="relation">
+          <has-kv k="boundary" modv="" v="political"/>
+          <has-kv k="political_division" modv="" v="ward"/>
+        </query>
+        <query into="_" type="way">
+          <has-kv k="boundary" modv="" v="political"/>
+          <has-kv k="political_division" modv="" v="ward"/>
+        </query>
+      </union>
+      <union into="_">
+        <item from="boundaries" into="_"/>
+        <recurse from="boundaries" into="_" type="down-rel"/>
+      </union>
+      <print from="_" limit="" mode="body" order="id"/>
+    </osm-script>
+    """
+    queries = []
+    for required_tags in tag_filters:
+        has_kv = "\n".join('      <has-kv k="%s" modv="" v="%s"/>' % (k, v)
+                           for k, v in list(required_tags.items()))
+        for element_type in ('relation', 'way'):
+            queries.append('    <query into="_" type="%s">\n%s\n    </query>' % (element_type, has_kv))
+    return """<osm-script element-limit="68719476736" timeout="86400">
+  <union into="boundaries">
+%s
+  </union>
+  <union into="_">
+    <item from="boundaries" into="_"/>
+    <recurse from="boundaries" into="_" type="down-rel"/>
+  </union>
+  <print from="_" limit="" mode="body" order="id"/>
+</osm-script>
+""" % ("\n".join(queries),)
+
+
+def get_from_overpass(query_xml, cache, element_type, element_id):
+    """Run an Overpass query for an element, caching the result if remote
+
+    With a local Overpass database, the query is run by the
+    Osm3sQueryBroker, if there is one, which makes the same query
+    for the element as get_query_relation_and_dependents does, but
+    may combine it with queries for other elements.
+    """
     if config.get('LOCAL_OVERPASS'):
+        broker = get_osm3s_broker()
+        if broker is not None:
+            return broker.query(element_type, element_id)
         return get_osm3s(query_xml)
     else:
-        if not os.path.exists(filename):
-            return get_remote(query_xml, filename)
-        return open(filename, encoding='utf-8').read()
+        data = cache.get(element_type, element_id)
+        if data is None:
+            with cache.open_for_writing(element_type, element_id) as fp:
+                download_remote(query_xml, fp)
+            data = cache.get(element_type, element_id)
+        return data
+
+
+def get_osm3s_command():
+    return ["osm3s_query",
+            "--concise",
+            "--db-dir=" + config['OVERPASS_DB_DIRECTORY']]
 
 
 def get_osm3s(query_xml):
-    p = Popen(["osm3s_query",
-               "--concise",
-               "--db-dir=" + config['OVERPASS_DB_DIRECTORY']],
+    if isinstance(query_xml, str):
+        query_xml = query_xml.encode('utf-8')
+    p = Popen(get_osm3s_command(),
               stdin=PIPE,
               stdout=PIPE)
     out, err = p.communicate(query_xml)
@@ -118,31 +469,511 @@ def get_osm3s(query_xml):
     return out
 
 
-def get_remote(query_xml, filename):
+@contextmanager
+def stream_osm3s(query_xml, command=None):
+    """Run a query with osm3s_query, giving its output as a file object
+
+    This is for queries with very large responses: rather than
+    reading the whole response into memory, as get_osm3s does, the
+    binary file object that's returned reads from the process's
+    output as it's produced.  It's meant to be used as a context
+    manager; once the response has been read, an exception is raised
+    if osm3s_query failed.  If the block is left early, osm3s_query is
+    killed.  command is only for the doctests.
+
+    >>> with stream_osm3s('<osm-script/>', command=['cat']) as fp:
+    ...     fp.read()
+    b'<osm-script/>'
+    >>> with stream_osm3s('', command=['false']) as fp:
+    ...     fp.read()
+    Traceback (most recent call last):
+      ...
+    Exception: The osm3s_query failed
+    """
+    if isinstance(query_xml, str):
+        query_xml = query_xml.encode('utf-8')
+    p = Popen(command or get_osm3s_command(),
+              stdin=PIPE,
+              stdout=PIPE)
+    try:
+        p.stdin.write(query_xml)
+        p.stdin.close()
+    except BrokenPipeError:
+        # It's already exited, so the return code will say why:
+        pass
+    try:
+        yield p.stdout
+    except BaseException:
+        p.kill()
+        raise
+    finally:
+        p.stdout.close()
+        returncode = p.wait()
+    if returncode != 0:
+        raise Exception("The osm3s_query failed")
+
+
+class Osm3sQueryBroker(object):
+
+    """Run queries for single elements on a local Overpass database in batches
+
+    Every osm3s_query process has to start up and open the database,
+    and it only runs one query, so this combines queries for elements
+    that are requested at about the same time (e.g. from different
+    threads) into one query, with get_query_elements_and_dependents.
+    Then the response is split up again, so that each element gets
+    the response that a query for it alone would have produced (see
+    split_batch_response).
+
+    There are as many worker threads as osm3s_query processes that
+    may run at once.  A worker that's free takes every request that's
+    waiting, up to batch_size of them, so requests are never delayed
+    to wait for others; they only get combined when they would
+    otherwise have had to wait for a worker.
+
+    >>> from concurrent.futures import wait
+    >>> with open(os.path.join(dirname(__file__), '..', 'mapit_global', 'tests',
+    ...                        'overpass-responses', 'relation-295353.xml')) as f:
+    ...     response = f.read()
+    >>> def slow_osm3s(query_xml):
+    ...     time.sleep(0.1)
+    ...     return response
+    >>> broker = Osm3sQueryBroker(workers=1, batch_size=10)
+    >>> with patch.object(sys.modules[__name__], 'get_osm3s', side_effect=slow_osm3s) as mock_osm3s:
+    ...     with ThreadPoolExecutor(max_workers=3) as executor:
+    ...         futures = [executor.submit(broker.query, 'relation', '295353')]
+    ...         time.sleep(0.05)
+    ...         futures += [executor.submit(broker.query, 'relation', element_id)
+    ...                     for element_id in ('295353', '10000000000')]
+    ...         _ = wait(futures)
+    >>> mock_osm3s.call_count, broker.elements
+    (2, 3)
+    >>> [len(parse_xml_string(f.result(), fetch_missing=False)) for f in futures]
+    [5706, 5706, 0]
+    >>> broker.close()
+    """
+
+    def __init__(self, workers=2, batch_size=50):
+        self.batch_size = batch_size
+        self.requests = queue.Queue()
+        self.queries = 0
+        self.elements = 0
+        self.threads = [threading.Thread(target=self.run, daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def query(self, element_type, element_id):
+        """Return the response to get_query_relation_and_dependents for an element"""
+        future = Future()
+        self.requests.put((element_type, str(element_id), future))
+        return future.result()
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            if batch[0] is None:
+                # Leave that for the other workers, so they stop too:
+                self.requests.put(None)
+                return
+            while len(batch) < self.batch_size:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.requests.put(None)
+                    break
+                batch.append(request)
+            futures_by_element = {}
+            for element_type, element_id, future in batch:
+                futures_by_element.setdefault((element_type, element_id), []).append(future)
+            try:
+                responses = self.run_query(sorted(futures_by_element))
+            except Exception as e:
+                for futures in futures_by_element.values():
+                    for future in futures:
+                        future.set_exception(e)
+            else:
+                for t, futures in futures_by_element.items():
+                    for future in futures:
+                        future.set_result(responses[t])
+
+    def run_query(self, element_type_id_tuples):
+        """Run one query for several elements, returning a response for each"""
+        self.queries += 1
+        self.elements += len(element_type_id_tuples)
+        if len(element_type_id_tuples) == 1:
+            t = element_type_id_tuples[0]
+            return {t: get_osm3s(get_query_relation_and_dependents(*t))}
+        xml = get_osm3s(get_query_elements_and_dependents(element_type_id_tuples))
+        parser = parse_xml_string(xml, False)
+        responses = {}
+        for element_type in PARSED_ELEMENT_TYPES:
+            element_ids = [i for t, i in element_type_id_tuples if t == element_type]
+            for element_id, response in split_batch_response(parser, element_type, element_ids).items():
+                responses[(element_type, element_id)] = response
+        return responses
+
+    def close(self):
+        """Stop the worker threads once they've finished their queries"""
+        self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def get_osm3s_broker():
+    """Return the Osm3sQueryBroker shared by this process, if there is one
+
+    There's no broker if OSM3S_BATCH_SIZE is 0 in general.yml, so each
+    element is queried for with its own osm3s_query process.
+    Otherwise, the broker is started the first time this is called,
+    with up to OSM3S_PROCESSES processes at once.
+
+    >>> with patch.dict(config, {'OSM3S_BATCH_SIZE': 0}):
+    ...     print(get_osm3s_broker())
+    None
+    """
+    global OSM3S_BROKER
+    batch_size = config.get('OSM3S_BATCH_SIZE', 50)
+    if not batch_size:
+        return None
+    with OSM3S_BROKER_LOCK:
+        if OSM3S_BROKER is None:
+            OSM3S_BROKER = Osm3sQueryBroker(config.get('OSM3S_PROCESSES', 2), batch_size)
+    return OSM3S_BROKER
+
+
+def get_overpass_session():
+    """Return the requests.Session used for every remote Overpass query
+
+    It's shared by all threads, so that connections to the server are
+    kept alive and reused, with a pool of as many connections as
+    elements are fetched at once (see FETCH_CONCURRENCY).
+
+    >>> get_overpass_session() is get_overpass_session()
+    True
+    """
+    global OVERPASS_SESSION
+    with OVERPASS_SESSION_LOCK:
+        if OVERPASS_SESSION is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=get_fetch_concurrency())
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            OVERPASS_SESSION = session
+    return OVERPASS_SESSION
+
+
+def get_retry_delay(attempt, response=None, backoff=None, max_backoff=None):
+    """Return how many seconds to wait before retrying a failed query
+
+    If the server said how long to wait, with a Retry-After header,
+    that's used, either as a number of seconds or as a date:
+
+    >>> get_retry_delay(0, Mock(headers={'Retry-After': '30'}))
+    30.0
+    >>> retry_after = datetime.fromtimestamp(time.time() + 3600, timezone.utc)
+    >>> response = Mock(headers={'Retry-After': retry_after.strftime('%a, %d %b %Y %H:%M:%S GMT')})
+    >>> 3590 < get_retry_delay(0, response) <= 3600
+    True
+
+    Otherwise, the delay is chosen at random, up to a limit that
+    doubles with each attempt, starting at backoff seconds and going
+    no higher than max_backoff seconds, so that clients that fail at
+    the same time don't all retry at the same time.  These default to
+    the OVERPASS_BACKOFF and OVERPASS_MAX_BACKOFF settings:
+
+    >>> 0 <= get_retry_delay(3, backoff=2, max_backoff=60) <= 16
+    True
+    >>> 0 <= get_retry_delay(10, backoff=2, max_backoff=60) <= 60
+    True
+    """
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+    if backoff is None:
+        backoff = config.get('OVERPASS_BACKOFF', 1)
+    if max_backoff is None:
+        max_backoff = config.get('OVERPASS_MAX_BACKOFF', 300)
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def download_remote(query_xml, fp, retries=None, chunk_size=1024 * 1024):
+    """Run a query on the remote Overpass server, writing the response to fp
+
+    The response is written to the binary file object fp as it
+    arrives, a chunk at a time, so it's never all in memory.
+
+    >>> fp = BytesIO()
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get):
+    ...     download_remote(get_query_relation_and_dependents('relation', '10000000000'), fp)
+    >>> len(parse_xml_string(fp.getvalue(), fetch_missing=False))
+    0
+
+    If the connection fails part of the way through, and fp can start
+    again (it has a restart() method, like the files that element
+    caches' open_for_writing return, or it's seekable), what was
+    written is thrown away and the query is run again, up to as many
+    times as get_overpass_response would retry it.  Otherwise, or once
+    the retries are used up, the exception is raised after whatever
+    was received has been written:
+
+    >>> def broken_content(chunk_size):
+    ...     yield b'<osm><node'
+    ...     raise requests.exceptions.ChunkedEncodingError("connection broken")
+    >>> broken = Mock(status_code=200, iter_content=broken_content)
+    >>> ok = Mock(status_code=200, iter_content=lambda chunk_size: iter([b'<osm/>']))
+    >>> fp = BytesIO()
+    >>> with patch.object(requests.Session, 'get', side_effect=[broken, ok]), \\
+    ...         patch.object(time, 'sleep') as mock_sleep:
+    ...     download_remote('<query/>', fp)
+    >>> fp.getvalue(), mock_sleep.call_count
+    (b'<osm/>', 1)
+    """
+    if retries is None:
+        retries = config.get('OVERPASS_RETRIES', 5)
+    restart = get_restart(fp)
+    for attempt in range(retries + 1):
+        r = get_overpass_response(query_xml, retries - attempt, stream=True)
+        try:
+            for chunk in r.iter_content(chunk_size):
+                fp.write(chunk)
+            return
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if attempt == retries or restart is None:
+                raise
+        finally:
+            r.close()
+        restart()
+        time.sleep(get_retry_delay(attempt))
+
+
+def get_restart(fp):
+    """Return a function that throws away what's been written to fp, or None if it can't be
+
+    >>> fp = BytesIO(b'<osm>')
+    >>> _ = fp.seek(0, os.SEEK_END)
+    >>> restart = get_restart(fp)
+    >>> _ = fp.write(b'<no')
+    >>> restart()
+    >>> fp.getvalue()
+    b'<osm>'
+    >>> get_restart(IncrementalParserFile(None)) is None
+    True
+    """
+    restart = getattr(fp, 'restart', None)
+    if restart is not None:
+        return restart
+    if not (hasattr(fp, 'seekable') and fp.seekable()):
+        return None
+    start = fp.tell()
+
+    def restart():
+        fp.seek(start)
+        fp.truncate()
+    return restart
+
+
+def get_overpass_response(query_xml, retries=None, stream=False):
+    """Run a query on the remote Overpass server, returning the Response
+
+    If the connection fails, or the server is too busy or times out,
+    the query is retried up to retries times (by default, the
+    OVERPASS_RETRIES setting), waiting as get_retry_delay says before
+    each retry:
+
+    >>> busy = Mock(status_code=429, headers={'Retry-After': '5'})
+    >>> ok = Mock(status_code=200, text='<osm/>')
+    >>> with patch.object(requests.Session, 'get', side_effect=[busy, ok]) as mock_get, \\
+    ...         patch.object(time, 'sleep') as mock_sleep:
+    ...     get_overpass_response('<query/>').text
+    '<osm/>'
+    >>> mock_get.call_count, mock_sleep.call_args
+    (2, call(5.0))
+
+    Once the retries are used up, the error is raised:
+
+    >>> with patch.object(requests.Session, 'get', side_effect=requests.ConnectionError("refused")), \\
+    ...         patch.object(time, 'sleep') as mock_sleep:
+    ...     get_overpass_response('<query/>', retries=2)
+    Traceback (most recent call last):
+      ...
+    requests.exceptions.ConnectionError: refused
+    >>> mock_sleep.call_count
+    2
+    """
     url = config['OVERPASS_SERVER']
-    r = requests.get(url, params={'data': query_xml})
-    r.raise_for_status()
-    data = r.text
-    with open(filename, "w") as fp:
-        fp.write(data)
-    return data
+    if retries is None:
+        retries = config.get('OVERPASS_RETRIES', 5)
+    timeout = config.get('OVERPASS_TIMEOUT', 900)
+    session = get_overpass_session()
+    for attempt in range(retries + 1):
+        try:
+            r = session.get(url, params={'data': query_xml}, timeout=timeout, stream=stream)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            time.sleep(get_retry_delay(attempt))
+            continue
+        if r.status_code in RETRY_STATUS_CODES and attempt < retries:
+            r.close()
+            time.sleep(get_retry_delay(attempt, r))
+            continue
+        r.raise_for_status()
+        return r
+
+
+def get_default_cache_directory():
+    script_directory = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_directory,
+                        '..',
+                        'data',
+                        'new-cache')
+
+
+def get_element_cache(cache_directory=None, backend=None, compression=None):
+    """Return the cache of Overpass responses in cache_directory
+
+    The kind of cache is set by the CACHE_BACKEND setting, if backend
+    isn't given: 'directory' (the default) keeps each response in its
+    own file, while 'sqlite' keeps them all in one SQLite database in
+    cache_directory.  New responses are compressed according to the
+    CACHE_COMPRESSION setting, if compression isn't given.  The same
+    object is returned each time for the same arguments:
+
+    >>> tmp_cache = mkdtemp()
+    >>> cache = get_element_cache(tmp_cache, 'sqlite')
+    >>> type(cache).__name__
+    'SQLiteElementCache'
+    >>> cache is get_element_cache(tmp_cache, 'sqlite')
+    True
+    >>> type(get_element_cache(tmp_cache, 'directory')).__name__
+    'DirectoryElementCache'
+    >>> get_element_cache(tmp_cache, 'nonsense')
+    Traceback (most recent call last):
+      ...
+    Exception: Unknown cache backend 'nonsense'
+
+    Remove the temporary directory created for these doctests:
+    >>> shutil.rmtree(tmp_cache)
+    """
+    if cache_directory is None:
+        cache_directory = get_default_cache_directory()
+    if backend is None:
+        backend = config.get('CACHE_BACKEND') or 'directory'
+    if backend not in ELEMENT_CACHE_BACKENDS:
+        raise Exception("Unknown cache backend '%s'" % (backend,))
+    if compression is None:
+        compression = config.get('CACHE_COMPRESSION') or None
+    key = (backend, os.path.abspath(cache_directory), compression)
+    with ELEMENT_CACHES_LOCK:
+        if key not in ELEMENT_CACHES:
+            ELEMENT_CACHES[key] = ELEMENT_CACHE_BACKENDS[backend](cache_directory, compression)
+        return ELEMENT_CACHES[key]
+
+
+def get_missing_element_cache(cache_directory=None, ttl=None):
+    """Return the MissingElementCache for a cache directory
+
+    Its records are kept in missing-elements.sqlite3 in the cache
+    directory.  If ttl is None, the MISSING_ELEMENT_TTL setting is
+    used, which defaults to a week.  As with get_element_cache, the
+    same instance is returned each time.
+
+    >>> tmp_cache = mkdtemp()
+    >>> missing = get_missing_element_cache(tmp_cache, ttl=60)
+    >>> missing is get_missing_element_cache(tmp_cache, ttl=60)
+    True
+    >>> os.path.basename(missing.filename)
+    'missing-elements.sqlite3'
+    >>> shutil.rmtree(tmp_cache)
+    """
+    if cache_directory is None:
+        cache_directory = get_default_cache_directory()
+    if ttl is None:
+        ttl = config.get('MISSING_ELEMENT_TTL', DEFAULT_MISSING_ELEMENT_TTL) or 0
+    key = (os.path.abspath(cache_directory), ttl)
+    with MISSING_ELEMENT_CACHES_LOCK:
+        if key not in MISSING_ELEMENT_CACHES:
+            MISSING_ELEMENT_CACHES[key] = MissingElementCache(
+                os.path.join(cache_directory, 'missing-elements.sqlite3'), ttl)
+        return MISSING_ELEMENT_CACHES[key]
+
+
+def get_missing_element_statistics():
+    """Return the total size, records added and hits of the missing-element caches
+
+    Each hit is a query to the Overpass API (or osm3s_query) that
+    was avoided because the element was known to be missing."""
+    totals = {'size': 0, 'recorded': 0, 'hits': 0}
+    with MISSING_ELEMENT_CACHES_LOCK:
+        for missing in MISSING_ELEMENT_CACHES.values():
+            for k, v in missing.statistics().items():
+                totals[k] += v
+    return totals
+
+
+def get_element_store(cache_directory=None):
+    """Return the ElementStore for a cache directory
+
+    It's kept in element-store.sqlite3 in the cache directory, and
+    the same instance is returned each time.
+
+    >>> tmp_cache = mkdtemp()
+    >>> store = get_element_store(tmp_cache)
+    >>> store is get_element_store(tmp_cache), os.path.basename(store.filename)
+    (True, 'element-store.sqlite3')
+    >>> shutil.rmtree(tmp_cache)
+    """
+    if cache_directory is None:
+        cache_directory = get_default_cache_directory()
+    key = os.path.abspath(cache_directory)
+    with ELEMENT_STORES_LOCK:
+        if key not in ELEMENT_STORES:
+            ELEMENT_STORES[key] = ElementStore(os.path.join(cache_directory, 'element-store.sqlite3'),
+                                               OSMXMLParser.IGNORED_ROLES)
+        return ELEMENT_STORES[key]
+
+
+def get_dependency_index(cache_directory=None):
+    """Return the DependencyIndex for a cache directory
+
+    Its files are kept in the cache directory, with names starting
+    dependency-index, and the same instance is returned each time.
+
+    >>> tmp_cache = mkdtemp()
+    >>> index = get_dependency_index(tmp_cache)
+    >>> index is get_dependency_index(tmp_cache), os.path.basename(index.filename)
+    (True, 'dependency-index')
+    >>> shutil.rmtree(tmp_cache)
+    """
+    if cache_directory is None:
+        cache_directory = get_default_cache_directory()
+    key = os.path.abspath(cache_directory)
+    with DEPENDENCY_INDEXES_LOCK:
+        if key not in DEPENDENCY_INDEXES:
+            DEPENDENCY_INDEXES[key] = DependencyIndex(os.path.join(cache_directory, 'dependency-index'))
+        return DEPENDENCY_INDEXES[key]
 
 
 def get_cache_filename(element_type, element_id, cache_directory=None):
+    """Return the filename for an element in the directory cache backend
+
+    The file's directory is created, so that it can be written to.
+    """
     if cache_directory is None:
-        script_directory = os.path.dirname(os.path.abspath(__file__))
-        cache_directory = os.path.join(script_directory,
-                                       '..',
-                                       'data',
-                                       'new-cache')
-    element_id = int(element_id, 10)
-    subdirectory = "%03d" % (element_id % 1000,)
-    full_subdirectory = os.path.join(cache_directory,
-                                     element_type,
-                                     subdirectory)
-    mkdir_p(full_subdirectory)
-    basename = "%s-%d.xml" % (element_type, element_id)
-    return os.path.join(full_subdirectory, basename)
+        cache_directory = get_default_cache_directory()
+    filename = DirectoryElementCache(cache_directory).filename(element_type, element_id)
+    mkdir_p(os.path.dirname(filename))
+    return filename
 
 
 def get_name_from_tags(tags, element_type=None, element_id=None):
@@ -208,12 +1039,14 @@ def get_non_contained_elements(elements):
     return [e for e in elements if e not in contained_elements]
 
 
-class OSMElement(object):
+class BaseOSMElement(object):
 
-    def __init__(self, element_id, element_content_missing=False, element_type=None):
-        self.element_id = element_id
-        self.element_type = element_type or "BUG"
-        self.missing = element_content_missing
+    """What every kind of OSM element has in common
+
+    This has no slots of its own, so that CompactNode, which keeps its
+    ID and type differently, doesn't pay for OSMElement's."""
+
+    __slots__ = ()
 
     def __lt__(self, other):
         return int(self.element_id, 10) < int(other.element_id, 10)
@@ -239,7 +1072,7 @@ class OSMElement(object):
         False
 
         """
-        if not isinstance(other, OSMElement):
+        if not isinstance(other, BaseOSMElement):
             return False
         if self.element_type == other.element_type:
             return self.element_id == other.element_id
@@ -258,6 +1091,11 @@ class OSMElement(object):
         return not self.__eq__(other)
 
     def __hash__(self):
+        """Hash on the ID string, whose hash Python caches
+
+        >>> hash(Node('42')) == hash(OSMElement('42', element_type='node')) == hash('42')
+        True
+        """
         return hash(self.element_id)
 
     def name_id_tuple(self):
@@ -414,6 +1252,16 @@ class OSMElement(object):
             etree.SubElement(xml_element, 'tag', attrib={'k': k, 'v': v})
 
 
+class OSMElement(BaseOSMElement):
+
+    __slots__ = ('element_id', 'element_type', 'missing')
+
+    def __init__(self, element_id, element_content_missing=False, element_type=None):
+        self.element_id = element_id
+        self.element_type = element_type or "BUG"
+        self.missing = element_content_missing
+
+
 class Node(OSMElement):
 
     """Represents an OSM node
@@ -465,6 +1313,24 @@ class Node(OSMElement):
         """
         return (self.lon, self.lat)
 
+    def float_lon_lat_tuple(self):
+        """Return the latitude and longitude as a tuple of two floats
+
+        >>> n = Node("1234", latitude="52", longitude="0.5")
+        >>> n.float_lon_lat_tuple()
+        (0.5, 52.0)
+        """
+        return (float(self.lon), float(self.lat))
+
+    def fixed_point_lon_lat_tuple(self):
+        """Return the latitude and longitude in units of 10^-7 degrees
+
+        >>> n = Node("1234", latitude="52", longitude="-0.5")
+        >>> n.fixed_point_lon_lat_tuple()
+        (-5000000, 520000000)
+        """
+        return (to_fixed_point(self.lon), to_fixed_point(self.lat))
+
     def __repr__(self):
         if self.element_content_missing:
             return 'Node(id="%s", missing)' % (self.element_id)
@@ -512,6 +1378,169 @@ class Node(OSMElement):
         return parent_element
 
 
+def to_fixed_point(coordinate):
+    """Convert a latitude or longitude to an integer in units of 10^-7 degrees
+
+    >>> to_fixed_point("-2.9544991")
+    -29544991
+    >>> to_fixed_point(52)
+    520000000
+    >>> to_fixed_point(None) is None
+    True
+    """
+    if coordinate is None:
+        return None
+    return int(round(float(coordinate) * FIXED_POINT_SCALE))
+
+
+def from_fixed_point(value):
+    """Format a fixed-point coordinate as a string, as Overpass would
+
+    >>> from_fixed_point(-29544991)
+    '-2.9544991'
+    >>> from_fixed_point(544600000)
+    '54.4600000'
+    >>> from_fixed_point(None) is None
+    True
+    """
+    if value is None:
+        return None
+    return "%.7f" % (value / FIXED_POINT_SCALE,)
+
+
+class CompactNode(BaseOSMElement):
+
+    """A lower-memory representation of an OSM node with no tags
+
+    This uses __slots__ rather than an instance dictionary, keeps the
+    ID as an int and the coordinates as fixed-point ints, and all
+    instances share a single read-only, empty tags mapping.  It's
+    created in the same way as a Node, and has the same interface:
+
+    >>> n = CompactNode("291974462", latitude="55.0548850", longitude="-2.9544991")
+    >>> n
+    Node(id="291974462", lat="55.0548850", lon="-2.9544991")
+    >>> n.osm_id, n.lat_e7, n.lon_e7
+    (291974462, 550548850, -29544991)
+    >>> n.name_id_tuple()
+    ('node', '291974462')
+    >>> n.lon_lat_tuple()
+    ('-2.9544991', '55.0548850')
+    >>> hasattr(n, '__dict__'), sys.getsizeof(n) < sys.getsizeof(Node("291974462"))
+    (False, True)
+
+    The latitude and longitude are always formatted with seven
+    decimal places, which is what Overpass outputs, so XML generated
+    from a CompactNode matches the original:
+
+    >>> print(etree.tostring(n.to_xml(etree.Element('example')), encoding='unicode'))
+    <example><node id="291974462" lat="55.0548850" lon="-2.9544991"/></example>
+
+    A CompactNode is equal to a Node with the same ID, and they hash
+    to the same value, so the two can be mixed in a Way or as
+    dictionary keys:
+
+    >>> n == Node("291974462")
+    True
+    >>> hash(n) == hash(Node("291974462"))
+    True
+    >>> n != CompactNode(291974463)
+    True
+
+    There's no space for tags; use to_node to get a Node that can
+    have them:
+
+    >>> n.tags['name'] = 'Somewhere'
+    Traceback (most recent call last):
+      ...
+    TypeError: 'mappingproxy' object does not support item assignment
+    >>> full = n.to_node()
+    >>> full.tags['name'] = 'Somewhere'
+    >>> print(full.pretty())
+    node (291974462) lat: 55.0548850, lon: -2.9544991
+      name => Somewhere
+
+    Ways made from CompactNodes can be joined as normal:
+
+    >>> top_left = CompactNode("12", latitude="52", longitude="1")
+    >>> top_right = CompactNode("13", latitude="52", longitude="2")
+    >>> bottom_right = CompactNode("14", latitude="51", longitude="2")
+    >>> bottom_left = CompactNode("15", latitude="51", longitude="1")
+    >>> ways = [Way("1", nodes=[bottom_left, top_left]),
+    ...         Way("2", nodes=[top_left, top_right, bottom_right]),
+    ...         Way("3", nodes=[bottom_right, bottom_left])]
+    >>> joined = join_way_soup(ways)
+    >>> joined
+    [Way(id="None", nodes=5)]
+    >>> joined[0].bounding_box_tuple()
+    (51.0, 1.0, 52.0, 2.0)
+    """
+
+    __slots__ = ('osm_id', 'lat_e7', 'lon_e7', 'missing')
+
+    element_type = 'node'
+    tags = EMPTY_TAGS
+
+    def __init__(self, node_id, latitude=None, longitude=None, element_content_missing=False):
+        self.osm_id = int(node_id)
+        self.lat_e7 = to_fixed_point(latitude)
+        self.lon_e7 = to_fixed_point(longitude)
+        self.missing = element_content_missing
+
+    @property
+    def element_id(self):
+        return str(self.osm_id)
+
+    @property
+    def lat(self):
+        return from_fixed_point(self.lat_e7)
+
+    @property
+    def lon(self):
+        return from_fixed_point(self.lon_e7)
+
+    def __eq__(self, other):
+        if type(other) is CompactNode:
+            return self.osm_id == other.osm_id
+        return BaseOSMElement.__eq__(self, other)
+
+    def __hash__(self):
+        # The same as a Node's hash.  Keeping it would take another
+        # int object per node, which is more than formatting the ID
+        # each time is worth:
+        return hash(str(self.osm_id))
+
+    def lon_lat_tuple(self):
+        if self.lat_e7 is None:
+            return (None, None)
+        return ("%.7f" % (self.lon_e7 / FIXED_POINT_SCALE), "%.7f" % (self.lat_e7 / FIXED_POINT_SCALE))
+
+    def to_node(self):
+        """Return an equivalent Node, which can have tags added"""
+        return Node(self.element_id, self.lat, self.lon, self.missing)
+
+    @classmethod
+    def from_location(cls, node_id, lon_e7, lat_e7):
+        """Create a CompactNode from fixed-point coordinates
+
+        >>> CompactNode.from_location('12', -5000000, 520000000)
+        Node(id="12", lat="52.0000000", lon="-0.5000000")
+        """
+        node = cls(node_id)
+        node.lon_e7, node.lat_e7 = lon_e7, lat_e7
+        return node
+
+    def float_lon_lat_tuple(self):
+        return (self.lon_e7 / FIXED_POINT_SCALE, self.lat_e7 / FIXED_POINT_SCALE)
+
+    def fixed_point_lon_lat_tuple(self):
+        return (self.lon_e7, self.lat_e7)
+
+    pretty = Node.pretty
+    to_xml = Node.to_xml
+    __repr__ = Node.__repr__
+
+
 class Way(OSMElement):
 
     """Represents an OSM way as returned via the Overpass API
@@ -590,6 +1619,9 @@ class Way(OSMElement):
         """
         return self.nodes.__getitem__(val)
 
+    def add_node(self, node):
+        self.nodes.append(node)
+
     def pretty(self, indent=0):
         """Generate a fuller string representation of this way
 
@@ -630,6 +1662,15 @@ class Way(OSMElement):
     def closed(self):
         return self.first == self.last
 
+    def end_node_ids(self):
+        """Return the IDs of the first and last nodes, as ints
+
+        >>> Way('1', nodes=[Node("12", latitude="52", longitude="1"),
+        ...                 Node("13", latitude="52", longitude="2")]).end_node_ids()
+        (12, 13)
+        """
+        return int(self.nodes[0].element_id), int(self.nodes[-1].element_id)
+
     def join(self, other):
         """Try to join another way to this one.
 
@@ -723,14 +1764,16 @@ class Way(OSMElement):
             raise Exception("Trying to join a closed way to another")
         if other.closed():
             raise Exception("Trying to join a way to a closed way")
+        # other may be an ArrayWay, whose nodes are a tuple:
+        other_nodes = list(other.nodes)
         if self.first == other.first:
-            new_nodes = list(reversed(other.nodes))[0:-1] + self.nodes
+            new_nodes = list(reversed(other_nodes))[0:-1] + self.nodes
         elif self.first == other.last:
-            new_nodes = other.nodes[0:-1] + self.nodes
+            new_nodes = other_nodes[0:-1] + self.nodes
         elif self.last == other.first:
-            new_nodes = self.nodes[0:-1] + other.nodes
+            new_nodes = self.nodes[0:-1] + other_nodes
         elif self.last == other.last:
-            new_nodes = self.nodes[0:-1] + list(reversed(other.nodes))
+            new_nodes = self.nodes[0:-1] + list(reversed(other_nodes))
         else:
             raise Exception("Trying to join two ways with no end point in common")
         return Way(None, new_nodes)
@@ -765,8 +1808,9 @@ class Way(OSMElement):
 
         """
 
-        longitudes = [float(n.lon) for n in self]
-        latitudes = [float(n.lat) for n in self]
+        coordinates = self.float_lon_lat_tuples()
+        longitudes = [lon for lon, lat in coordinates]
+        latitudes = [lat for lon, lat in coordinates]
 
         if any(x for x in longitudes if x < -90):
             longitudes = [x + 360 for x in longitudes]
@@ -779,6 +1823,26 @@ class Way(OSMElement):
 
         return (min_lat, min_lon, max_lat, max_lon)
 
+    def lon_lat_tuples(self):
+        """Return a list of (longitude, latitude) string tuples for the nodes
+
+        >>> w = Way('76543', nodes=[Node("12", latitude="52", longitude="1"),
+        ...                         Node("13", latitude="52.5", longitude="2")])
+        >>> w.lon_lat_tuples()
+        [('1', '52'), ('2', '52.5')]
+        """
+        return [n.lon_lat_tuple() for n in self.nodes]
+
+    def float_lon_lat_tuples(self):
+        """Return a list of (longitude, latitude) float tuples for the nodes
+
+        >>> w = Way('76543', nodes=[Node("12", latitude="52", longitude="1"),
+        ...                         Node("13", latitude="52.5", longitude="2")])
+        >>> w.float_lon_lat_tuples()
+        [(1.0, 52.0), (2.0, 52.5)]
+        """
+        return [n.float_lon_lat_tuple() for n in self.nodes]
+
     def __repr__(self):
         """A returns simple repr-style representation of the Way
 
@@ -791,7 +1855,7 @@ class Way(OSMElement):
         if self.element_content_missing:
             return 'Way(id="%s", missing)' % (self.element_id,)
         else:
-            return 'Way(id="%s", nodes=%d)' % (self.element_id, len(self.nodes))
+            return 'Way(id="%s", nodes=%d)' % (self.element_id, len(self))
 
     def get_missing_elements(self, to_append_to=None):
         """Return a list of element type, id tuples of missing elements
@@ -910,9 +1974,8 @@ class Way(OSMElement):
 
         id_to_node should be a dictionary that maps IDs of nodes (as
         strings) the complete Node object or None.  parser should have
-        a method called get_known_or_fetch('node', element_id) which
-        will return None or the complete Node object, if the parser
-        can find it.
+        a method called get_way_node(element_id) which will return
+        None or the complete Node object, if the parser can find it.
 
         If any nodes could not be found from parser or id_to_node,
         they are returned as a list.  Therefore, if the way could be
@@ -923,9 +1986,7 @@ class Way(OSMElement):
         ...                         OSMElement.make_missing_element('node', '14'),
         ...                         Node("15", latitude="51", longitude="2")])
         >>> class FakeParser:
-        ...     def get_known_or_fetch(self, element_type, element_id):
-        ...         if element_type != 'node':
-        ...             return None
+        ...     def get_way_node(self, element_id):
         ...         if element_id == "14":
         ...             return Node("14", latitude="52.4", longitude="2.1")
         ...         return None
@@ -952,7 +2013,7 @@ class Way(OSMElement):
                 found_node = id_to_node[node_id]
             else:
                 # Ask the parser to try to fetch it from its filesystem cache:
-                found_node = parser.get_known_or_fetch('node', node_id)
+                found_node = parser.get_way_node(node_id)
             if (found_node is not None) and (not found_node.element_content_missing):
                 self.nodes[i] = found_node
             else:
@@ -960,37 +2021,271 @@ class Way(OSMElement):
         return still_missing
 
 
-class Relation(OSMElement):
+class ArrayWay(Way):
 
-    """Represents an OSM relation as returned via the Overpass API"""
+    """A Way that stores its geometry in arrays rather than Node objects
 
-    def __init__(self, relation_id, element_content_missing=False):
-        super(Relation, self).__init__(relation_id, element_content_missing, 'relation')
-        # A relation has an ordered list of children, which we store
-        # as a list of tuples.  The first element of each tuple is a
-        # Node, Way or Relation, and the second is a "role" string.
-        self.children = []
-        self.tags = {}
+    The node IDs are kept in an array('q') and the longitudes and
+    latitudes in two arrays of doubles, so a way with many nodes
+    doesn't need an object per node.  (If NumPy is available, it's
+    used to compute bounding boxes.)  The interface is the same as
+    Way's, and an ArrayWay can be created in the same way:
 
-    def __iter__(self):
-        for c in self.children:
-            yield c
+    >>> top_left = Node("12", latitude="52", longitude="1")
+    >>> top_right = Node("13", latitude="52", longitude="2")
+    >>> bottom_right = Node("14", latitude="51", longitude="2")
+    >>> bottom_left = Node("15", latitude="51", longitude="1")
+    >>> top = ArrayWay("3456", nodes=[top_left, top_right])
+    >>> top
+    Way(id="3456", nodes=2)
+    >>> top.node_ids
+    array('q', [12, 13])
+    >>> top.lons, top.lats
+    (array('d', [1.0, 2.0]), array('d', [52.0, 52.0]))
+
+    Nodes are only created when they're asked for, and are
+    CompactNode objects:
+
+    >>> top.first, top.last
+    (Node(id="12", lat="52.0000000", lon="1.0000000"), Node(id="13", lat="52.0000000", lon="2.0000000"))
+    >>> top[1] == top_right
+    True
+    >>> top.closed()
+    False
 
-    def __len__(self):
-        return len(self.children)
+    Since they're made afresh each time, the nodes are a tuple, so
+    that nodes can only be added with add_node:
 
-    def __getitem__(self, val):
-        return self.children.__getitem__(val)
+    >>> top.nodes.append(bottom_right)
+    Traceback (most recent call last):
+       ...
+    AttributeError: 'tuple' object has no attribute 'append'
+
+    Joining works directly on the arrays, including with ordinary
+    Ways:
+
+    >>> right = ArrayWay("1234", nodes=[bottom_right, top_right])
+    >>> joined = top.join(right)
+    >>> joined.node_ids
+    array('q', [12, 13, 14])
+    >>> joined = joined.join(Way("6789", nodes=[bottom_right, bottom_left, top_left]))
+    >>> joined.node_ids
+    array('q', [14, 15, 12, 13, 14])
+    >>> joined.closed()
+    True
+    >>> joined.bounding_box_tuple()
+    (51.0, 1.0, 52.0, 2.0)
+    >>> joined.lon_lat_tuples()[:2]
+    [('2.0000000', '51.0000000'), ('1.0000000', '51.0000000')]
 
-    def add_member(self, new_member, role=''):
-        self.children.append((new_member, role))
+    The same exceptions are thrown as for a Way:
 
-    def pretty(self, indent=0):
-        """Generate a fuller string representation of this way
+    >>> joined.join(top)
+    Traceback (most recent call last):
+       ...
+    Exception: Trying to join a closed way to another
+    >>> top.join(ArrayWay("6789", nodes=[bottom_right, bottom_left]))
+    Traceback (most recent call last):
+       ...
+    Exception: Trying to join two ways with no end point in common
+
+    Missing nodes are stored with NaN coordinates, and can be
+    reconstructed in the same way as for a Way:
+
+    >>> w = ArrayWay('76543', nodes=[Node("12", latitude="52", longitude="1"),
+    ...                              OSMElement.make_missing_element('node', '13')])
+    >>> w.get_missing_elements()
+    [('node', '13')]
+    >>> list(w)
+    [Node(id="12", lat="52.0000000", lon="1.0000000"), Node(id="13", missing)]
+    >>> w.reconstruct_missing(None, {"13": Node("13", latitude="51.2", longitude="1.3")})
+    []
+    >>> w.get_missing_elements()
+    []
+    >>> w.float_lon_lat_tuples()
+    [(1.0, 52.0), (1.3, 51.2)]
 
-        For example:
+    Ways crossing the -180 degree meridian have their bounding box
+    shifted, as for Way:
 
-        >>> r = Relation('98765')
+    >>> alaska = ArrayWay('76543', nodes=[Node("12", latitude="62", longitude="-149"),
+    ...                                   Node("13", latitude="62", longitude="-150"),
+    ...                                   Node("14", latitude="61", longitude="-149")])
+    >>> alaska.bounding_box_tuple()
+    (61.0, 210.0, 62.0, 211.0)
+
+    The result is the same without NumPy:
+
+    >>> with patch.dict(ArrayWay.bounding_box_tuple.__globals__, {'numpy': None}):
+    ...     alaska.bounding_box_tuple()
+    (61.0, 210.0, 62.0, 211.0)
+    """
+
+    def __init__(self, way_id, nodes=None, element_content_missing=False):
+        OSMElement.__init__(self, way_id, element_content_missing, 'way')
+        self.node_ids = array('q')
+        self.lons = array('d')
+        self.lats = array('d')
+        self.tags = {}
+        for node in nodes or []:
+            self.add_node(node)
+
+    @classmethod
+    def from_way(cls, way):
+        if isinstance(way, cls):
+            return way
+        return cls(way.element_id, way.nodes, way.element_content_missing)
+
+    @classmethod
+    def from_arrays(cls, way_id, node_ids, lons, lats):
+        way = cls(way_id)
+        way.node_ids, way.lons, way.lats = node_ids, lons, lats
+        return way
+
+    def add_node(self, node):
+        self.node_ids.append(int(node.element_id))
+        if node.element_content_missing:
+            lon, lat = NAN, NAN
+        else:
+            lon, lat = node.float_lon_lat_tuple()
+        self.lons.append(lon)
+        self.lats.append(lat)
+
+    def make_node(self, i):
+        node_id, lon = self.node_ids[i], self.lons[i]
+        if lon != lon:
+            return OSMElement.make_missing_element('node', str(node_id))
+        return CompactNode(node_id, latitude=self.lats[i], longitude=lon)
+
+    @property
+    def nodes(self):
+        return tuple(self.make_node(i) for i in range(len(self.node_ids)))
+
+    def __iter__(self):
+        for i in range(len(self.node_ids)):
+            yield self.make_node(i)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __getitem__(self, val):
+        if isinstance(val, slice):
+            return self.nodes[val]
+        return self.make_node(val)
+
+    @property
+    def first(self):
+        return self.make_node(0)
+
+    @property
+    def last(self):
+        return self.make_node(-1)
+
+    def closed(self):
+        return self.node_ids[0] == self.node_ids[-1]
+
+    def end_node_ids(self):
+        return self.node_ids[0], self.node_ids[-1]
+
+    def arrays(self, reverse=False):
+        if reverse:
+            return (self.node_ids[::-1], self.lons[::-1], self.lats[::-1])
+        return (self.node_ids, self.lons, self.lats)
+
+    def join(self, other):
+        other = ArrayWay.from_way(other)
+        if self.closed():
+            raise Exception("Trying to join a closed way to another")
+        if other.closed():
+            raise Exception("Trying to join a way to a closed way")
+        ids, other_ids = self.node_ids, other.node_ids
+        if ids[0] == other_ids[0]:
+            before, after = other.arrays(reverse=True), self.arrays()
+        elif ids[0] == other_ids[-1]:
+            before, after = other.arrays(), self.arrays()
+        elif ids[-1] == other_ids[0]:
+            before, after = self.arrays(), other.arrays()
+        elif ids[-1] == other_ids[-1]:
+            before, after = self.arrays(), other.arrays(reverse=True)
+        else:
+            raise Exception("Trying to join two ways with no end point in common")
+        return ArrayWay.from_arrays(None, *[b[:-1] + a for b, a in zip(before, after)])
+
+    def bounding_box_tuple(self):
+        if numpy is not None:
+            lons = numpy.frombuffer(self.lons)
+            lats = numpy.frombuffer(self.lats)
+            min_lon, max_lon = float(lons.min()), float(lons.max())
+            min_lat, max_lat = float(lats.min()), float(lats.max())
+        else:
+            min_lon, max_lon = min(self.lons), max(self.lons)
+            min_lat, max_lat = min(self.lats), max(self.lats)
+        if min_lon < -90:
+            min_lon += 360
+            max_lon += 360
+        return (min_lat, min_lon, max_lat, max_lon)
+
+    def lon_lat_tuples(self):
+        return [("%.7f" % lon, "%.7f" % lat) for lon, lat in zip(self.lons, self.lats)]
+
+    def float_lon_lat_tuples(self):
+        return list(zip(self.lons, self.lats))
+
+    def get_missing_elements(self, to_append_to=None):
+        to_append_to = OSMElement.get_missing_elements(self, to_append_to)
+        for node_id, lon in zip(self.node_ids, self.lons):
+            if lon != lon:
+                to_append_to.append(('node', str(node_id)))
+        return to_append_to
+
+    def reconstruct_missing(self, parser, id_to_node):
+        still_missing = []
+        for i, lon in enumerate(self.lons):
+            if lon == lon:
+                continue
+            node_id = str(self.node_ids[i])
+            if node_id in id_to_node:
+                found_node = id_to_node[node_id]
+            else:
+                found_node = parser.get_way_node(node_id)
+            if (found_node is not None) and (not found_node.element_content_missing):
+                self.lons[i], self.lats[i] = found_node.float_lon_lat_tuple()
+            else:
+                still_missing.append(OSMElement.make_missing_element('node', node_id))
+        return still_missing
+
+
+class Relation(OSMElement):
+
+    """Represents an OSM relation as returned via the Overpass API"""
+
+    def __init__(self, relation_id, element_content_missing=False):
+        super(Relation, self).__init__(relation_id, element_content_missing, 'relation')
+        # A relation has an ordered list of children, which we store
+        # as a list of tuples.  The first element of each tuple is a
+        # Node, Way or Relation, and the second is a "role" string.
+        self.children = []
+        self.tags = {}
+
+    def __iter__(self):
+        for c in self.children:
+            yield c
+
+    def __len__(self):
+        return len(self.children)
+
+    def __getitem__(self, val):
+        return self.children.__getitem__(val)
+
+    def add_member(self, new_member, role=''):
+        self.children.append((new_member, role))
+
+    def pretty(self, indent=0):
+        """Generate a fuller string representation of this way
+
+        For example:
+
+        >>> r = Relation('98765')
         >>> r.add_member(Node('76542', latitude="51.0", longitude="0.3"))
         >>> r.add_member(Way('76543'))
         >>> r.add_member(Way('76544'), role='inner')
@@ -1024,11 +2319,12 @@ class Relation(OSMElement):
             result += "\n" + child.pretty(indent + 4)
         return result
 
-    def way_iterator(self, inner=False):
+    def way_iterator(self, inner=False, relations=None):
         """Iterate over the ways in this relation
 
         If inner is set, iterate only over ways with the roles 'inner'
-        or 'enclave' - otherwise miss them out.
+        or 'enclave' - otherwise miss them out.  If relations is a
+        set, the sub-relations that are gone through are added to it.
 
         For example:
 
@@ -1055,11 +2351,14 @@ class Relation(OSMElement):
         Way(id="54320", nodes=0)
         Way(id="76546", nodes=0)
 
-        >>> for w in r.way_iterator(inner=True):
+        >>> sub_relations = set()
+        >>> for w in r.way_iterator(inner=True, relations=sub_relations):
         ...     print(w)
         Way(id="76544", nodes=0)
         Way(id="76545", nodes=0)
         Way(id="54322", nodes=0)
+        >>> sub_relations
+        {Relation(id="87654", members=2)}
         """
 
         for child, role in self.children:
@@ -1072,7 +2371,9 @@ class Relation(OSMElement):
             if child.element_type == 'way':
                 yield child
             elif child.element_type == 'relation':
-                for sub_way in child.way_iterator(inner):
+                if relations is not None:
+                    relations.add(child)
+                for sub_way in child.way_iterator(inner, relations):
                     yield sub_way
 
     def __repr__(self):
@@ -1260,8 +2561,9 @@ class Relation(OSMElement):
 
         id_to_node should be a dictionary that maps IDs of nodes (as
         strings) the complete Node object or None.  parser should have
-        a method called get_known_or_fetch('node', element_id) which
-        will return None or the complete Node object, if the parser
+        methods called get_known_or_fetch(element_type, element_id)
+        and (for the nodes of member ways) get_way_node(element_id),
+        which will return None or the complete element, if the parser
         can find it.
 
         If any nodes could not be found from parser or id_to_node,
@@ -1290,6 +2592,8 @@ class Relation(OSMElement):
         ...         if element_id == "14":
         ...             return Node("14", latitude="52.4", longitude="2.1")
         ...         return OSMElement.make_missing_element(element_type, element_id)
+        ...     def get_way_node(self, element_id):
+        ...         return self.get_known_or_fetch('node', element_id)
         >>> node_cache = {"13": Node("13", latitude="51.2", longitude="1.3"),
         ...               "19": None,
         ...               "20": Node("20", latitude="51.3", longitude="1.1"),
@@ -1304,6 +2608,8 @@ class Relation(OSMElement):
         >>> class FakeEmptyParser:
         ...     def get_known_or_fetch(self, element_type, element_id):
         ...         return OSMElement.make_missing_element(element_type, element_id)
+        ...     def get_way_node(self, element_id):
+        ...         return self.get_known_or_fetch('node', element_id)
         >>> node_cache = {}
         >>> r.reconstruct_missing(FakeEmptyParser(), node_cache) # doctest: +NORMALIZE_WHITESPACE
         [Node(id="13", missing), Node(id="14", missing),
@@ -1339,6 +2645,273 @@ class Relation(OSMElement):
         return still_missing
 
 
+def pack_string(s, parts):
+    b = s.encode('utf-8')
+    parts.append(struct.pack('<I', len(b)))
+    parts.append(b)
+
+
+def pack_tags(tags, parts):
+    parts.append(struct.pack('<I', len(tags)))
+    for k, v in sorted(tags.items()):
+        pack_string(k, parts)
+        pack_string(v, parts)
+
+
+def pack_array(a, parts):
+    if sys.byteorder == 'big':
+        a = array(a.typecode, a)
+        a.byteswap()
+    parts.append(a.tobytes())
+
+
+def dump_element(element, parts, ancestors):
+    element_type = element.element_type
+    # A relation that contains itself is written as missing inside itself:
+    missing = element.element_content_missing or (element_type == 'relation' and element.element_id in ancestors)
+    parts.append(struct.pack('<BBq',
+                             PARSED_ELEMENT_TYPES.index(element_type),
+                             missing,
+                             int(element.element_id)))
+    if missing:
+        return
+    pack_tags(element.tags, parts)
+    if element_type == 'node':
+        parts.append(struct.pack('<ii', *element.fixed_point_lon_lat_tuple()))
+    elif element_type == 'way':
+        node_ids, lons, lats = array('q'), array('i'), array('i')
+        tagged_nodes = []
+        for i, node in enumerate(element):
+            node_ids.append(int(node.element_id))
+            if node.element_content_missing:
+                lon, lat = MISSING_COORDINATE, MISSING_COORDINATE
+            else:
+                lon, lat = node.fixed_point_lon_lat_tuple()
+                if node.tags:
+                    tagged_nodes.append((i, node.tags))
+            lons.append(lon)
+            lats.append(lat)
+        parts.append(struct.pack('<I', len(node_ids)))
+        for a in (node_ids, lons, lats):
+            pack_array(a, parts)
+        parts.append(struct.pack('<I', len(tagged_nodes)))
+        for i, tags in tagged_nodes:
+            parts.append(struct.pack('<I', i))
+            pack_tags(tags, parts)
+    else:
+        ancestors = ancestors | set([element.element_id])
+        parts.append(struct.pack('<I', len(element.children)))
+        for member, role in element:
+            pack_string(role, parts)
+            dump_element(member, parts, ancestors)
+
+
+def dump_parsed_element(element):
+    """Return a compact binary version of an element and everything in it
+
+    This includes the tags of every element, the members of
+    relations (recursively) and the node IDs and fixed-point
+    coordinates of ways, as little-endian integers packed with the
+    struct module, after a magic number and format version.  It can
+    be turned back into an element with load_parsed_element, which is
+    much faster than parsing the XML that it came from.
+
+    >>> w = Way('76543', nodes=[Node("12", latitude="52", longitude="1"),
+    ...                         OSMElement.make_missing_element('node', '13'),
+    ...                         Node("12", latitude="52", longitude="1")])
+    >>> w.tags['name'] = 'Example'
+    >>> w.nodes[2].tags['highway'] = 'stop'
+    >>> r = Relation('98765')
+    >>> r.add_member(Node('76542', latitude='52', longitude='0.3'), role='admin_centre')
+    >>> r.add_member(w, role='outer')
+    >>> r.add_member(OSMElement.make_missing_element('relation', '98764'))
+    >>> data = dump_parsed_element(r)
+    >>> data[:4]
+    b'OSMP'
+    >>> loaded = load_parsed_element(data, OSMXMLParser(fetch_missing=False))
+    >>> print(loaded.pretty(), end='')
+    relation (98765)
+      child node with role 'admin_centre'
+        node (76542) lat: 52.0000000, lon: 0.3000000
+      child way with role 'outer'
+        way (76543)
+          name => Example
+          node (12) lat: 52.0000000, lon: 1.0000000
+          node (13) lat: None, lon: None
+          node (12) lat: 52.0000000, lon: 1.0000000
+            highway => stop
+      child relation with role ''
+        relation (98764)
+    >>> loaded[1][0][1], loaded[2][0]
+    (Node(id="13", missing), Relation(id="98764", missing))
+
+    With a parser that uses CompactNodes and ArrayWays, those are
+    what's loaded:
+
+    >>> loaded = load_parsed_element(data, OSMXMLParser(fetch_missing=False, compact_nodes=True, array_ways=True))
+    >>> loaded[0][0]
+    Node(id="76542", lat="52.0000000", lon="0.3000000")
+    >>> loaded[1][0].lons
+    array('d', [1.0, nan, 1.0])
+
+    Data from a different version of the format isn't loaded:
+
+    >>> load_parsed_element(data[:4] + struct.pack('<H', 0) + data[6:], OSMXMLParser()) is None
+    True
+    """
+    parts = [struct.pack('<4sH', PARSED_ELEMENT_MAGIC, PARSED_ELEMENT_FORMAT_VERSION)]
+    dump_element(element, parts, set())
+    return b''.join(parts)
+
+
+def get_parsed_dependencies(element):
+    """Return the ways and relations whose data dump_parsed_element includes with element's
+
+    That's every member of a relation, and of its sub-relations,
+    apart from nodes, whose locations are part of the response for
+    each way they're in.  These are returned as (element_type,
+    element_id) tuples, so that the pre-parsed element can be
+    removed from the cache if any of them change:
+
+    >>> r = Relation('98765')
+    >>> r.add_member(Node('76542', latitude='52', longitude='0.3'), role='admin_centre')
+    >>> r.add_member(Way('76543'), role='outer')
+    >>> sub_relation = Relation('98764')
+    >>> sub_relation.add_member(Way('76544'))
+    >>> sub_relation.add_member(r)
+    >>> r.add_member(sub_relation)
+    >>> sorted(get_parsed_dependencies(r))
+    [('relation', '98764'), ('way', '76543'), ('way', '76544')]
+    """
+    found = set()
+    relations = [element] if element.element_type == 'relation' else []
+    while relations:
+        for member, role in relations.pop():
+            key = (member.element_type, member.element_id)
+            if member.element_type == 'node' or key in found:
+                continue
+            found.add(key)
+            if member.element_type == 'relation' and not member.element_content_missing:
+                relations.append(member)
+    found.discard((element.element_type, element.element_id))
+    return found
+
+
+class ParsedElementLoader(object):
+
+    """Rebuild elements from dump_parsed_element's binary format
+
+    The classes of the nodes and ways created are the same as those
+    that parser would create, and the locations of the nodes are
+    recorded in its node_locations, as parsing the XML would."""
+
+    def __init__(self, data, parser):
+        self.data = memoryview(data)
+        self.offset = 0
+        self.compact_nodes = parser.compact_nodes
+        self.array_ways = parser.array_ways
+        self.node_locations = parser.node_locations
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+
+    def unpack_string(self):
+        length, = self.unpack('<I')
+        s = str(self.data[self.offset:self.offset + length], 'utf-8')
+        self.offset += length
+        return s
+
+    def unpack_tags(self):
+        count, = self.unpack('<I')
+        tags = {}
+        for i in range(count):
+            k = self.unpack_string()
+            tags[k] = self.unpack_string()
+        return tags
+
+    def unpack_array(self, typecode, length):
+        a = array(typecode)
+        end = self.offset + length * a.itemsize
+        a.frombytes(self.data[self.offset:end])
+        if sys.byteorder == 'big':
+            a.byteswap()
+        self.offset = end
+        return a
+
+    def make_node(self, node_id, lon_e7, lat_e7, tags):
+        if self.node_locations is not None:
+            self.node_locations.set(int(node_id), lon_e7, lat_e7)
+        if self.compact_nodes and not tags:
+            return CompactNode.from_location(node_id, lon_e7, lat_e7)
+        node = Node(node_id, latitude=from_fixed_point(lat_e7), longitude=from_fixed_point(lon_e7))
+        node.tags.update(tags)
+        return node
+
+    def load_way(self, way_id):
+        length, = self.unpack('<I')
+        node_ids = self.unpack_array('q', length)
+        lons = self.unpack_array('i', length)
+        lats = self.unpack_array('i', length)
+        tagged_nodes = {}
+        tagged_count, = self.unpack('<I')
+        for i in range(tagged_count):
+            index, = self.unpack('<I')
+            tagged_nodes[index] = self.unpack_tags()
+        if self.array_ways:
+            if self.node_locations is not None:
+                for node_id, lon_e7, lat_e7 in zip(node_ids, lons, lats):
+                    if lon_e7 != MISSING_COORDINATE:
+                        self.node_locations.set(node_id, lon_e7, lat_e7)
+
+            def to_degrees(a):
+                return array('d', [NAN if v == MISSING_COORDINATE else v / FIXED_POINT_SCALE for v in a])
+            return ArrayWay.from_arrays(way_id, node_ids, to_degrees(lons), to_degrees(lats))
+        way = Way(way_id)
+        for i in range(length):
+            node_id = str(node_ids[i])
+            if lons[i] == MISSING_COORDINATE:
+                way.add_node(OSMElement.make_missing_element('node', node_id))
+            else:
+                way.add_node(self.make_node(node_id, lons[i], lats[i], tagged_nodes.get(i, EMPTY_TAGS)))
+        return way
+
+    def load_element(self):
+        type_index, missing, element_id = self.unpack('<BBq')
+        element_type = PARSED_ELEMENT_TYPES[type_index]
+        element_id = str(element_id)
+        if missing:
+            return OSMElement.make_missing_element(element_type, element_id)
+        tags = self.unpack_tags()
+        if element_type == 'node':
+            lon_e7, lat_e7 = self.unpack('<ii')
+            return self.make_node(element_id, lon_e7, lat_e7, tags)
+        elif element_type == 'way':
+            element = self.load_way(element_id)
+        else:
+            element = Relation(element_id)
+            count, = self.unpack('<I')
+            for i in range(count):
+                role = self.unpack_string()
+                element.children.append((self.load_element(), role))
+        element.tags = tags
+        return element
+
+    def load(self):
+        if len(self.data) < 6:
+            return None
+        magic, version = self.unpack('<4sH')
+        if magic != PARSED_ELEMENT_MAGIC or version != PARSED_ELEMENT_FORMAT_VERSION:
+            return None
+        return self.load_element()
+
+
+def load_parsed_element(data, parser):
+    """Return the element in data from dump_parsed_element, or None if it's out of date"""
+    return ParsedElementLoader(data, parser).load()
+
+
 class UnexpectedElementException(Exception):
     def __init__(self, element_name, message):
         self.element_name = element_name
@@ -1348,6 +2921,21 @@ class UnexpectedElementException(Exception):
         return self.message
 
 
+def make_known_elements(maxsize=None):
+    """Return a mapping for a parser's in-memory cache of elements of one type
+
+    That's a plain dictionary unless it's limited to maxsize elements:
+
+    >>> make_known_elements()
+    {}
+    >>> make_known_elements(100).maxsize
+    100
+    """
+    if maxsize is None:
+        return {}
+    return LRUCache(maxsize)
+
+
 class OSMXMLParser(ContentHandler):
 
     """A SAX-based parser for data from OSM's Overpass API
@@ -1564,7 +3152,7 @@ class OSMXMLParser(ContentHandler):
     ...     <member type="relation" ref="295353" role="example-subrelation"/>
     ...   </relation>
     ... </osm>'''
-    >>> with patch.object(requests, 'get', side_effect=fake_requests_get):
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get):
     ...     parser = parse_xml_string(xml_requiring_fetch,
     ...                               cache_directory=tmp_cache)
     >>> south_cambridgeshire_relation, fake_role = parser[0][0]
@@ -1576,7 +3164,7 @@ class OSMXMLParser(ContentHandler):
     Doing that again will be faster, since the results of the API will
     have been cached to disk, but still produce the same result:
 
-    >>> with patch.object(requests, 'get', side_effect=fake_requests_get):
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get):
     ...     parser = parse_xml_string(xml_requiring_fetch,
     ...                               cache_directory=tmp_cache)
     >>> south_cambridgeshire_relation, fake_role = parser[0][0]
@@ -1604,7 +3192,7 @@ class OSMXMLParser(ContentHandler):
 
     If fetching isn't allowed, we get the same result the first time:
 
-    >>> with patch.object(requests, 'get', side_effect=fake_requests_get):
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get):
     ...     parser = parse_xml_string(xml_with_fictitious_refs,
     ...                               cache_directory=tmp_cache)
     >>> for e in parser[0]:
@@ -1628,20 +3216,46 @@ class OSMXMLParser(ContentHandler):
 
     VALID_TOP_LEVEL_ELEMENTS = set(('node', 'relation', 'way'))
     VALID_RELATION_MEMBERS = set(('node', 'relation', 'way'))
-    IGNORED_TAGS = set(('osm', 'note', 'meta', 'bound'))
+    IGNORED_TAGS = set(('osm', 'note', 'meta', 'bound', 'bounds'))
     IGNORED_ROLES = set(('subarea', 'defaults', 'apply_to'))
 
-    def __init__(self, fetch_missing=True, callback=None, cache_in_memory=True, cache_directory=None):
+    def __init__(self, fetch_missing=True, callback=None, cache_in_memory=True, cache_directory=None,
+                 engine=None, compact_nodes=None, array_ways=None, node_locations=None, visited=None,
+                 parsed_cache=None, cache_limits=None):
         self.top_level_elements = []
         self.current_top_level_element = None
-        # These dictionaries map ids to already discovered elements:
-        self.known_nodes = {}
-        self.known_ways = {}
-        self.known_relations = {}
+        # These dictionaries map ids to already discovered elements,
+        # and may be limited to the most recently used ones:
+        if cache_limits is None:
+            cache_limits = config.get('IN_MEMORY_CACHE_LIMITS') or {}
+        self.cache_limits = cache_limits
+        self.known_nodes = make_known_elements(cache_limits.get('node'))
+        self.known_ways = make_known_elements(cache_limits.get('way'))
+        self.known_relations = make_known_elements(cache_limits.get('relation'))
         self.fetch_missing = fetch_missing
         self.callback = callback
         self.cache_in_memory = cache_in_memory
         self.cache_directory = cache_directory
+        self.engine = get_parser_engine(engine)
+        if compact_nodes is None:
+            compact_nodes = config.get('COMPACT_NODES', False)
+        self.compact_nodes = compact_nodes
+        self.node_class = CompactNode if compact_nodes else Node
+        if array_ways is None:
+            array_ways = config.get('ARRAY_WAYS', False)
+        self.array_ways = array_ways
+        self.way_class = ArrayWay if array_ways else Way
+        if node_locations is None:
+            node_locations = get_default_node_locations()
+        self.node_locations = node_locations
+        if parsed_cache is None:
+            parsed_cache = config.get('PARSED_CACHE', False)
+        self.parsed_cache = parsed_cache
+        # The IDs of the relations that have been fetched while
+        # fetching the element that this parser is part of:
+        if visited is None:
+            visited = set()
+        self.visited = visited
 
     def clear_caches(self):
         self.known_nodes.clear()
@@ -1669,6 +3283,155 @@ class OSMXMLParser(ContentHandler):
     def __getitem__(self, val):
         return self.top_level_elements.__getitem__(val)
 
+    def nested_parser_options(self):
+        """Return the options that parsers of dependent elements should share"""
+        return {'engine': self.engine,
+                'compact_nodes': self.compact_nodes,
+                'array_ways': self.array_ways,
+                'node_locations': self.node_locations,
+                'visited': self.visited,
+                'parsed_cache': self.parsed_cache,
+                'cache_limits': self.cache_limits}
+
+    def cache_statistics(self):
+        """Return the sizes, hits, misses and evictions of the limited in-memory caches
+
+        Unlimited ones are plain dictionaries, which don't count
+        anything, so they're left out:
+
+        >>> parser = parse_xml_string('''<?xml version="1.0" encoding="UTF-8"?>
+        ... <osm version="0.6" generator="Overpass API">
+        ...   <node id="291974462" lat="55.0548850" lon="-2.9544991"/>
+        ...   <node id="312203528" lat="54.4600000" lon="-5.0596341"/>
+        ...   <node id="312203529" lat="54.4600000" lon="-5.0596342"/>
+        ...   <way id="28421671">
+        ...     <nd ref="291974462"/>
+        ...     <nd ref="312203528"/>
+        ...     <nd ref="312203529"/>
+        ...   </way>
+        ... </osm>''', fetch_missing=False, cache_limits={'node': 2})
+        >>> parser.cache_statistics()
+        {'node': {'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 1, 'evictions': 1}}
+        """
+        return dict((element_type, known.statistics())
+                    for element_type, known in (('node', self.known_nodes),
+                                                ('way', self.known_ways),
+                                                ('relation', self.known_relations))
+                    if isinstance(known, LRUCache))
+
+    def record_cache_statistics(self):
+        """Add this parser's cache hits, misses and evictions to the totals
+
+        The totals for every parser can be found with
+        get_in_memory_cache_totals."""
+        with IN_MEMORY_CACHE_TOTALS_LOCK:
+            for element_type, statistics in self.cache_statistics().items():
+                totals = IN_MEMORY_CACHE_TOTALS.setdefault(element_type, {'hits': 0, 'misses': 0, 'evictions': 0})
+                for k in totals:
+                    totals[k] += statistics[k]
+
+    def uses_parsed_cache(self, element_type):
+        """Return True if pre-parsed elements of this type should be used
+
+        Only ways and relations are pre-parsed, and only if the
+        responses from the Overpass API are cached, since otherwise
+        there's nothing to invalidate the pre-parsed version."""
+        return self.parsed_cache and element_type != 'node' and not config.get('LOCAL_OVERPASS')
+
+    def get_from_parsed_cache(self, cache, element_type, element_id):
+        """Return the element pre-parsed in cache and its data
+
+        If there's no pre-parsed element, (None, None) is returned."""
+        if not self.uses_parsed_cache(element_type):
+            return None, None
+        data = cache.get_parsed(element_type, element_id)
+        if data is None:
+            return None, None
+        return load_parsed_element(data, self), data
+
+    def add_to_parsed_cache(self, cache, element):
+        """Store a pre-parsed version of element in cache
+
+        Only complete elements are stored, so that a parser that can
+        fetch missing elements will still try to.  The cache removes
+        the pre-parsed element if any of the ways or relations that
+        it includes are replaced (see get_parsed_dependencies)."""
+        if self.uses_parsed_cache(element.element_type) and not element.get_missing_elements():
+            data = dump_parsed_element(element)
+            cache.put_parsed(element.element_type, element.element_id, data, get_parsed_dependencies(element))
+            return data
+        return None
+
+    def get_from_node_locations(self, node_id):
+        """Return a CompactNode from the node-location store, or None"""
+        if self.node_locations is None:
+            return None
+        location = self.node_locations.get(int(node_id))
+        if location is None:
+            return None
+        return CompactNode.from_location(node_id, *location)
+
+    def get_way_node(self, node_id):
+        """Return a node that's part of a way, fetching it if necessary
+
+        Only the location of a way's nodes is needed, so if the parser
+        has a node-location store (a DenseNodeLocations), they're
+        looked up in it before the on-disk cache.  The location of
+        every node that's parsed is saved there, so another parser can
+        find those nodes without any XML parsing, e.g. when
+        reconstructing a way:
+
+        >>> tmp_directory = mkdtemp()
+        >>> locations = DenseNodeLocations(os.path.join(tmp_directory, 'node-locations'))
+        >>> parser = parse_xml_string('''<?xml version="1.0" encoding="UTF-8"?>
+        ... <osm version="0.6" generator="Overpass API">
+        ...   <node id="291974462" lat="55.0548850" lon="-2.9544991"/>
+        ...   <node id="312203528" lat="54.4600000" lon="-5.0596341">
+        ...     <tag k="place" v="town"/>
+        ...   </node>
+        ... </osm>''', fetch_missing=False, node_locations=locations)
+        >>> locations.get(312203528)
+        (-50596341, 544600000)
+        >>> w = Way('28421671', nodes=[OSMElement.make_missing_element('node', '291974462'),
+        ...                            OSMElement.make_missing_element('node', '312203528')])
+        >>> other_parser = OSMXMLParser(fetch_missing=False,
+        ...                             cache_directory=tmp_directory,
+        ...                             node_locations=locations)
+        >>> w.reconstruct_missing(other_parser, {})
+        []
+        >>> for n in w:
+        ...     print(n)
+        Node(id="291974462", lat="55.0548850", lon="-2.9544991")
+        Node(id="312203528", lat="54.4600000", lon="-5.0596341")
+
+        Nodes found in the node-location store have no tags, so
+        they're not used for anything else, such as a relation's
+        admin_centre or label node, which get_known_or_fetch still
+        looks for in the on-disk cache:
+
+        >>> other_parser.get_known_or_fetch('node', '312203528')
+        Node(id="312203528", missing)
+
+        >>> locations.close()
+        >>> shutil.rmtree(tmp_directory)
+        """
+        node_id = str(node_id)
+        if self.cache_in_memory:
+            node = self.known_nodes.get(node_id)
+            if node is not None:
+                return node
+        node = self.get_from_node_locations(node_id)
+        if node is not None:
+            return node
+        return self.fetch_unknown('node', node_id)
+
+    def expand_compact_node(self):
+        """Replace the CompactNode being parsed with a Node, so it can have tags"""
+        node = self.current_top_level_element.to_node()
+        self.current_top_level_element = node
+        if self.cache_in_memory:
+            self.known_nodes[node.element_id] = node
+
     def raise_if_sub_level(self, name):
         if self.current_top_level_element is not None:
             raise UnexpectedElementException(
@@ -1689,19 +3452,117 @@ class OSMXMLParser(ContentHandler):
         """Return an OSM Node, Way or Relation, fetching it if necessary
 
         If the element couldn't be found any means, an element marked
-        with element_content_missing is returned."""
+        with element_content_missing is returned.
+
+        If the parser has parsed_cache set (which defaults to the
+        PARSED_CACHE setting) then a way or relation that's parsed from
+        the on-disk cache is also stored there in a binary form (see
+        dump_parsed_element), which is loaded instead of parsing the
+        XML next time:
+
+        >>> tmp_cache = mkdtemp()
+        >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get):
+        ...     fetched = fetch_cached('relation', '295353', cache_directory=tmp_cache)
+        >>> parser = OSMXMLParser(fetch_missing=False, cache_directory=tmp_cache, parsed_cache=True)
+        >>> parser.get_known_or_fetch('relation', '295353')
+        Relation(id="295353", members=118)
+        >>> get_element_cache(tmp_cache).get_parsed('relation', '295353')[:4]
+        b'OSMP'
+        >>> clear_parsed_file_memo()
+        >>> parser = OSMXMLParser(fetch_missing=False, cache_directory=tmp_cache, parsed_cache=True)
+        >>> with patch.object(sys.modules[__name__], 'parse_xml_string', side_effect=Exception("XML parsed")):
+        ...     relation = parser.get_known_or_fetch('relation', '295353')
+        >>> relation
+        Relation(id="295353", members=118)
+
+        The pre-parsed relation includes its member ways, so it's
+        removed if one of them is fetched again:
+
+        >>> way = next(member for member, role in relation if member.element_type == 'way')
+        >>> get_element_cache(tmp_cache).put('way', way.element_id, '<osm/>')
+        >>> get_element_cache(tmp_cache).get_parsed('relation', '295353') is None
+        True
+
+        Whether or not it's pre-parsed, an element parsed from the
+        on-disk cache is remembered for the rest of the process, in a
+        memo shared by every parser, so it's parsed at most once as
+        long as the memo isn't full (see PARSED_FILE_MEMO_SIZE in
+        general.yml).  The memo keeps the element in the binary form
+        from dump_parsed_element, so each parser gets its own copy
+        of the element, which it can change without affecting others:
+
+        >>> clear_parsed_file_memo()
+        >>> first = OSMXMLParser(fetch_missing=False, cache_directory=tmp_cache)
+        >>> relation = first.get_known_or_fetch('relation', '295353')
+        >>> second = OSMXMLParser(fetch_missing=False, cache_directory=tmp_cache, array_ways=True)
+        >>> with patch.object(sys.modules[__name__], 'parse_xml_string', side_effect=Exception("XML parsed")):
+        ...     copy = second.get_known_or_fetch('relation', '295353')
+        >>> first_way = next(e for e, role in copy if e.element_type == 'way')
+        >>> copy is relation, copy == relation, type(first_way).__name__
+        (False, True, 'ArrayWay')
+        >>> statistics = get_parsed_file_memo_statistics()
+        >>> statistics['hits'], statistics['weight'] == len(dump_parsed_element(relation))
+        (1, True)
+        >>> shutil.rmtree(tmp_cache)
+
+        If a query for an element finds nothing, that's recorded (see
+        MISSING_ELEMENT_TTL in general.yml), so that it isn't queried
+        for again, e.g. with a local Overpass database, where nothing
+        else is cached:
+
+        >>> tmp_cache = mkdtemp()
+        >>> empty = '<?xml version="1.0" encoding="UTF-8"?><osm version="0.6"/>'
+        >>> with patch.dict(config, {'LOCAL_OVERPASS': True}), \\
+        ...         patch.object(sys.modules[__name__], 'get_osm3s', return_value=empty) as mock_osm3s:
+        ...     for i in range(3):
+        ...         parser = OSMXMLParser(cache_directory=tmp_cache)
+        ...         print(parser.get_known_or_fetch('way', '1000000000000'))
+        Way(id="1000000000000", missing)
+        Way(id="1000000000000", missing)
+        Way(id="1000000000000", missing)
+        >>> mock_osm3s.call_count
+        1
+        >>> get_missing_element_cache(tmp_cache).statistics()
+        {'size': 1, 'recorded': 1, 'hits': 2}
+        >>> shutil.rmtree(tmp_cache)
+        """
         element_id = str(element_id)
         if self.cache_in_memory:
-            d = {'node': self.known_nodes,
-                 'way': self.known_ways,
-                 'relation': self.known_relations}[element_type]
-            if element_id in d:
-                return d[element_id]
+            result = self.known_elements(element_type).get(element_id)
+            if result is not None:
+                return result
+        return self.fetch_unknown(element_type, element_id, verbose)
+
+    def known_elements(self, element_type):
+        """Return the in-memory cache of elements of element_type"""
+        return {'node': self.known_nodes,
+                'way': self.known_ways,
+                'relation': self.known_relations}[element_type]
+
+    def fetch_unknown(self, element_type, element_id, verbose=False):
+        """Do what get_known_or_fetch does for an element that isn't in memory"""
         result = None
-        # See if it is in the on-disk cache:
-        cache_filename = get_cache_filename(element_type, element_id, self.cache_directory)
-        if os.path.exists(cache_filename):
-            parser = parse_xml(cache_filename, fetch_missing=self.fetch_missing)
+        # See if it is in the on-disk cache, pre-parsed or as XML,
+        # unless it has already been parsed from there in this
+        # process by a parser that could fetch missing elements if
+        # this one can:
+        cache = get_element_cache(self.cache_directory)
+        memo_key = (cache, element_type, element_id, self.fetch_missing)
+        with PARSED_FILE_MEMO_LOCK:
+            data = PARSED_FILE_MEMO.lookup(memo_key)
+        if data is not None:
+            result = load_parsed_element(data, self)
+        if result is None:
+            result, data = self.get_from_parsed_cache(cache, element_type, element_id)
+            if result is not None:
+                remember_parsed_file(memo_key, data)
+        cached = cache.get(element_type, element_id) if result is None else None
+        if cached is not None:
+            parser = parse_xml_string(cached,
+                                      self.fetch_missing,
+                                      cache_directory=self.cache_directory,
+                                      **self.nested_parser_options())
+            parser.record_cache_statistics()
             for e in parser.top_level_elements:
                 if e.name_id_tuple() == (element_type, element_id):
                     result = e
@@ -1713,77 +3574,172 @@ class OSMXMLParser(ContentHandler):
                 else:
                     # However, if there's the wrong data in the file,
                     # that's worth looking into:
-                    raise Exception("Failed to find expected element in: " + cache_filename)
+                    raise Exception("Failed to find expected element in: " + cache.location(element_type, element_id))
+            data = self.add_to_parsed_cache(cache, result)
+            if PARSED_FILE_MEMO.maxweight > 0:
+                remember_parsed_file(memo_key, data or dump_parsed_element(result))
         if result is None:
+            # Don't query for something that was recently found not
+            # to exist:
+            if self.fetch_missing and get_missing_element_cache(self.cache_directory).is_missing(
+                    element_type, element_id):
+                return OSMElement.make_missing_element(element_type, element_id)
             if self.fetch_missing:
                 result = fetch_osm_element(element_type,
                                            element_id,
                                            self.fetch_missing,
                                            verbose,
-                                           self.cache_directory)
+                                           self.cache_directory,
+                                           **self.nested_parser_options())
                 if not result:
                     return OSMElement.make_missing_element(element_type, element_id)
             else:
                 return OSMElement.make_missing_element(element_type, element_id)
         if self.cache_in_memory:
-            d[element_id] = result
+            self.known_elements(element_type)[element_id] = result
         return result
 
+    def get_inline_node(self, node_id, lat, lon):
+        """Return the node for an <nd> that gives its location inline
+
+        That's in responses to the queries from
+        get_query_with_inline_geometry, in which there's no <node>
+        element for most nodes:
+
+        >>> parser = parse_xml_string('''<?xml version="1.0" encoding="UTF-8"?>
+        ... <osm version="0.6" generator="Overpass API">
+        ...   <way id="76543">
+        ...     <bounds minlat="52.0000000" minlon="1.0000000" maxlat="52.0000000" maxlon="2.0000000"/>
+        ...     <nd ref="12" lat="52.0000000" lon="1.0000000"/>
+        ...     <nd ref="13" lat="52.0000000" lon="2.0000000"/>
+        ...   </way>
+        ...   <way id="76544">
+        ...     <nd ref="13" lat="52.0000000" lon="2.0000000"/>
+        ...     <nd ref="12" lat="52.0000000" lon="1.0000000"/>
+        ...   </way>
+        ... </osm>''', fetch_missing=False)
+        >>> parser.known_ways['76543'].nodes
+        [Node(id="12", lat="52.0000000", lon="1.0000000"), Node(id="13", lat="52.0000000", lon="2.0000000")]
+
+        A node that's in more than one way is only created once:
+
+        >>> parser.known_ways['76544'].first is parser.known_ways['76543'].last
+        True
+        """
+        node = self.known_nodes.get(node_id)
+        if node is None:
+            node = self.node_class(node_id, lat, lon)
+            if self.node_locations is not None:
+                self.node_locations.set(int(node_id), *node.fixed_point_lon_lat_tuple())
+            if self.cache_in_memory:
+                self.known_nodes[node_id] = node
+        return node
+
     def startElement(self, name, attr):
         if name in OSMXMLParser.IGNORED_TAGS:
             return
         elif name in OSMXMLParser.VALID_TOP_LEVEL_ELEMENTS:
             self.raise_if_sub_level(name)
-            element_id = attr['id']
-            if name == "node":
-                self.current_top_level_element = Node(element_id, attr['lat'], attr['lon'])
-                if self.cache_in_memory:
-                    self.known_nodes[element_id] = self.current_top_level_element
-            elif name == "way":
-                self.current_top_level_element = Way(element_id)
-                if self.cache_in_memory:
-                    self.known_ways[element_id] = self.current_top_level_element
-            elif name == "relation":
-                self.current_top_level_element = Relation(element_id)
-                if self.cache_in_memory:
-                    self.known_relations[element_id] = self.current_top_level_element
-            else:
-                # A programming error: something's been added to
-                # VALID_TOP_LEVEL_ELEMENTS which isn't dealt with.
-                assert "Unhandled top level element %s" % (name,)  # pragma: no cover
+            self.start_top_level_element(name, attr)
         else:
             # These must be sub-elements:
             self.raise_if_top_level(name)
-            if name == "tag":
-                k, v = attr['k'], attr['v']
-                self.current_top_level_element.tags[k] = v
-            elif name == "member":
-                self.raise_unless_expected_parent(name, 'relation')
-                member_type = attr['type']
-                if member_type not in OSMXMLParser.VALID_RELATION_MEMBERS:
-                    raise Exception("Unknown member type '%s' in <relation>" % (member_type,))
-                if attr['role'] not in OSMXMLParser.IGNORED_ROLES:
-                    member = self.get_known_or_fetch(member_type, attr['ref'])
-                    self.current_top_level_element.children.append((member, attr['role']))
-            elif name == "nd":
-                self.raise_unless_expected_parent(name, 'way')
-                node = self.get_known_or_fetch('node', attr['ref'])
-                if node.element_content_missing:
-                    if self.fetch_missing:
-                        # print >> sys.stderr, "A node (%s) was referenced that couldn't be found" % (attr['ref'],)
-                        pass
-                    node = OSMElement.make_missing_element('node', attr['ref'])
-                self.current_top_level_element.nodes.append(node)
-            else:
-                raise UnexpectedElementException(name, "Unhandled element <%s>" % (name,))
+            self.add_sub_element(name, attr)
 
     def endElement(self, name):
         if name in OSMXMLParser.VALID_TOP_LEVEL_ELEMENTS:
-            if self.callback:
-                self.callback(self.current_top_level_element, self)
+            self.end_top_level_element()
+
+    def lxml_element(self, element):
+        """Build a top-level element straight from an lxml element
+
+        With the lxml engine, each <node>, <way> or <relation> is
+        passed here once lxml has parsed all of it, so its attributes
+        and children are read directly rather than being replayed as
+        SAX events."""
+        self.raise_if_sub_level(element.tag)
+        self.start_top_level_element(element.tag, element.attrib)
+        if self.current_top_level_element.element_type == 'way':
+            add_node = self.current_top_level_element.add_node
+            for child in element.iterchildren(etree.Element):
+                if child.tag == 'nd' and child.get('lat') is None:
+                    add_node(self.get_nd_node(child.get('ref')))
+                else:
+                    self.add_lxml_sub_element(child)
+        else:
+            for child in element.iterchildren(etree.Element):
+                self.add_lxml_sub_element(child)
+        self.end_top_level_element()
+
+    def add_lxml_sub_element(self, child):
+        name = child.tag
+        if name in OSMXMLParser.VALID_TOP_LEVEL_ELEMENTS:
+            self.raise_if_sub_level(name)
+        elif name not in OSMXMLParser.IGNORED_TAGS:
+            self.add_sub_element(name, child.attrib)
+
+    def start_top_level_element(self, name, attr):
+        element_id = attr['id']
+        if name == "node":
+            self.current_top_level_element = self.node_class(element_id, attr['lat'], attr['lon'])
+            if self.node_locations is not None:
+                self.node_locations.set(int(element_id),
+                                        *self.current_top_level_element.fixed_point_lon_lat_tuple())
+            if self.cache_in_memory:
+                self.known_nodes[element_id] = self.current_top_level_element
+        elif name == "way":
+            self.current_top_level_element = self.way_class(element_id)
+            if self.cache_in_memory:
+                self.known_ways[element_id] = self.current_top_level_element
+        elif name == "relation":
+            self.current_top_level_element = Relation(element_id)
+            if self.cache_in_memory:
+                self.known_relations[element_id] = self.current_top_level_element
+        else:
+            # A programming error: something's been added to
+            # VALID_TOP_LEVEL_ELEMENTS which isn't dealt with.
+            assert "Unhandled top level element %s" % (name,)  # pragma: no cover
+
+    def add_sub_element(self, name, attr):
+        if name == "tag":
+            k, v = attr['k'], attr['v']
+            if self.current_top_level_element.tags is EMPTY_TAGS:
+                self.expand_compact_node()
+            self.current_top_level_element.tags[k] = v
+        elif name == "member":
+            self.raise_unless_expected_parent(name, 'relation')
+            member_type = attr['type']
+            if member_type not in OSMXMLParser.VALID_RELATION_MEMBERS:
+                raise Exception("Unknown member type '%s' in <relation>" % (member_type,))
+            if attr['role'] not in OSMXMLParser.IGNORED_ROLES:
+                member = self.get_known_or_fetch(member_type, attr['ref'])
+                self.current_top_level_element.children.append((member, attr['role']))
+        elif name == "nd":
+            self.raise_unless_expected_parent(name, 'way')
+            if 'lat' in attr:
+                node = self.get_inline_node(attr['ref'], attr['lat'], attr['lon'])
             else:
-                self.top_level_elements.append(self.current_top_level_element)
-            self.current_top_level_element = None
+                node = self.get_nd_node(attr['ref'])
+            self.current_top_level_element.add_node(node)
+        else:
+            raise UnexpectedElementException(name, "Unhandled element <%s>" % (name,))
+
+    def get_nd_node(self, node_id):
+        """Return the node for an <nd> that only gives its ID"""
+        node = self.get_way_node(node_id)
+        if node.element_content_missing:
+            if self.fetch_missing:
+                # print >> sys.stderr, "A node (%s) was referenced that couldn't be found" % (node_id,)
+                pass
+            node = OSMElement.make_missing_element('node', node_id)
+        return node
+
+    def end_top_level_element(self):
+        if self.callback:
+            self.callback(self.current_top_level_element, self)
+        else:
+            self.top_level_elements.append(self.current_top_level_element)
+        self.current_top_level_element = None
 
 
 class MinimalOSMXMLParser(ContentHandler):
@@ -1813,6 +3769,78 @@ class MinimalOSMXMLParser(ContentHandler):
             self.current_element_id = None
             self.current_tags = None
 
+    def lxml_element(self, element):
+        """Handle a whole top-level element parsed by lxml"""
+        tags = dict((child.get('k'), child.get('v')) for child in element.iterchildren('tag'))
+        self.handle_element(element.tag, element.get('id'), tags)
+
+
+def get_parsed_file_memo_statistics():
+    """Return the size, weight, hits, misses and evictions of the parsed-file memo
+
+    Every hit is a read of an on-disk cache entry that was avoided;
+    the weight is the number of bytes of dump_parsed_element data
+    held."""
+    with PARSED_FILE_MEMO_LOCK:
+        return PARSED_FILE_MEMO.statistics()
+
+
+def remember_parsed_file(memo_key, data):
+    """Add an element's data from dump_parsed_element to the parsed-file memo"""
+    with PARSED_FILE_MEMO_LOCK:
+        PARSED_FILE_MEMO.put(memo_key, data, len(data))
+
+
+def clear_parsed_file_memo():
+    with PARSED_FILE_MEMO_LOCK:
+        PARSED_FILE_MEMO.clear()
+        PARSED_FILE_MEMO.hits = PARSED_FILE_MEMO.misses = PARSED_FILE_MEMO.evictions = 0
+
+
+def get_in_memory_cache_totals(reset=False):
+    """Return the total hits, misses and evictions of parsers' in-memory caches
+
+    These are the totals for each element type over every parser
+    that's recorded them (see OSMXMLParser.record_cache_statistics),
+    including those created by fetch_osm_element.  If reset is True,
+    the totals are set back to zero.
+
+    >>> get_in_memory_cache_totals(reset=True) is not None
+    True
+    >>> parser = OSMXMLParser(fetch_missing=False, cache_limits={'node': 1000})
+    >>> parser.get_known_or_fetch('node', '1000000000000')
+    Node(id="1000000000000", missing)
+    >>> parser.record_cache_statistics()
+    >>> get_in_memory_cache_totals()['node']
+    {'hits': 0, 'misses': 1, 'evictions': 0}
+    """
+    with IN_MEMORY_CACHE_TOTALS_LOCK:
+        totals = dict((element_type, dict(counts)) for element_type, counts in IN_MEMORY_CACHE_TOTALS.items())
+        if reset:
+            IN_MEMORY_CACHE_TOTALS.clear()
+    return totals
+
+
+def get_default_node_locations():
+    """Return the node-location store set in general.yml, if there is one
+
+    If NODE_LOCATIONS_FILE is set, a DenseNodeLocations for that
+    file is opened the first time this is called, and shared by every
+    parser in this process.  Otherwise, None is returned:
+
+    >>> with patch.dict(config, {'NODE_LOCATIONS_FILE': ''}):
+    ...     print(get_default_node_locations())
+    None
+    """
+    global DEFAULT_NODE_LOCATIONS
+    filename = config.get('NODE_LOCATIONS_FILE')
+    if not filename:
+        return None
+    with DEFAULT_NODE_LOCATIONS_LOCK:
+        if DEFAULT_NODE_LOCATIONS is None:
+            DEFAULT_NODE_LOCATIONS = DenseNodeLocations(filename)
+    return DEFAULT_NODE_LOCATIONS
+
 
 def get_total_seconds(td):
     """A replacement for timedelta.total_seconds(), that's only in Python >= 2.7"""
@@ -1834,12 +3862,256 @@ def fetch_cached(element_type, element_id, verbose=False, cache_directory=None):
 
     if element_type not in ('relation', 'way', 'node'):
         raise Exception("Unknown element type '%s'" % (element_type,))
-    filename = get_cache_filename(element_type, element_id, cache_directory)
     all_dependents_query = get_query_relation_and_dependents(element_type, element_id)
-    return get_from_overpass(all_dependents_query, filename)
+    return get_from_overpass(all_dependents_query, get_element_cache(cache_directory), element_type, element_id)
+
+
+def fetch_cached_file(element_type, element_id, verbose=False, cache_directory=None):
+    """Like fetch_cached, but return a binary file object for the response
+
+    If the Overpass API is remote, a response that isn't cached yet
+    is written to the cache as it's downloaded, and then the file
+    object reads it from there, so the response is never all in
+    memory.  The file object should be closed once it's been read:
+
+    >>> tmp_cache = mkdtemp()
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get):
+    ...     with fetch_cached_file('relation', '295353', cache_directory=tmp_cache) as fp:
+    ...         handler = OSMXMLParser(fetch_missing=False, cache_directory=tmp_cache)
+    ...         parse_file_with_engine(fp, handler)
+    >>> handler.known_relations['295353']
+    Relation(id="295353", members=118)
+    >>> shutil.rmtree(tmp_cache)
+    """
+
+    if element_type not in ('relation', 'way', 'node'):
+        raise Exception("Unknown element type '%s'" % (element_type,))
+    cache = get_element_cache(cache_directory)
+    if config.get('LOCAL_OVERPASS'):
+        data = fetch_cached(element_type, element_id, verbose, cache_directory)
+        return BytesIO(data if isinstance(data, bytes) else data.encode('utf-8'))
+    fp = cache.open(element_type, element_id)
+    if fp is None:
+        with cache.open_for_writing(element_type, element_id) as out:
+            download_remote(get_query_relation_and_dependents(element_type, element_id), out)
+        fp = cache.open(element_type, element_id)
+    return fp
+
+
+def get_element_and_dependents_xml(element):
+    """Return OSM XML for an element and what a recurse down would add
+
+    That's the element itself, its member nodes and ways (or its
+    nodes, for a way) and the nodes of those ways, in the order that
+    the Overpass API would output them.  Missing nodes and ways are
+    left out, as are the members of sub-relations.
+
+    >>> w = Way('76543', nodes=[Node("13", latitude="52", longitude="2"),
+    ...                         OSMElement.make_missing_element('node', '14'),
+    ...                         Node("12", latitude="52", longitude="1")])
+    >>> r = Relation('98765')
+    >>> r.add_member(Node('76542', latitude='52', longitude='0.3'), role='admin_centre')
+    >>> r.add_member(w)
+    >>> r.add_member(Relation('98764'))
+    >>> xml = get_element_and_dependents_xml(r)
+    >>> print(etree.tostring(xml, encoding='unicode', pretty_print=True), end='') # doctest: +ELLIPSIS
+    <osm version="0.6" generator="mySociety Boundary Extractor">
+      <note>...</note>
+      <node id="12" lat="52" lon="1"/>
+      <node id="13" lat="52" lon="2"/>
+      <node id="76542" lat="52" lon="0.3"/>
+      <way id="76543">
+        <nd ref="13"/>
+        <nd ref="14"/>
+        <nd ref="12"/>
+      </way>
+      <relation id="98765">
+        <member type="node" ref="76542" role="admin_centre"/>
+        <member type="way" ref="76543" role=""/>
+        <member type="relation" ref="98764" role=""/>
+      </relation>
+    </osm>
+    """
+
+    nodes = {}
+    ways = {}
+
+    def add_nodes_of_way(way):
+        for node in way:
+            if not node.element_content_missing:
+                nodes[node.element_id] = node
+
+    if element.element_type == 'relation':
+        for member, role in element:
+            if member.element_content_missing:
+                continue
+            if member.element_type == 'node':
+                nodes[member.element_id] = member
+            elif member.element_type == 'way':
+                ways[member.element_id] = member
+                add_nodes_of_way(member)
+    elif element.element_type == 'way':
+        add_nodes_of_way(element)
+    osm = OSMElement.xml_wrapping()
+    for d in (nodes, ways):
+        for element_id in sorted(d, key=int):
+            d[element_id].to_xml(osm)
+    element.to_xml(osm)
+    return osm
+
+
+def fetch_cached_batch(element_type, element_ids, verbose=False, cache_directory=None, **parser_kwargs):
+    """Fetch several OSM elements of one type with a single Overpass query
+
+    The response is parsed without fetching anything else, and the
+    OSMXMLParser is returned.  Any other keyword arguments are passed
+    on to OSMXMLParser.  If the Overpass API is remote, the response
+    is also split up into the usual one entry per element in the
+    cache, each with the element and its dependents, so it's as if
+    each element had been fetched with fetch_cached.  An element that
+    wasn't found gets an empty response, just as it would from
+    fetch_cached.  A remote response is downloaded to a temporary
+    file and parsed from there, so it's never all in memory.
+
+    >>> tmp_cache = mkdtemp()
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get) as mock_get:
+    ...     parser = fetch_cached_batch('relation',
+    ...                                 ['295353', '58446', '10000000000'],
+    ...                                 cache_directory=tmp_cache)
+    >>> mock_get.call_count
+    1
+    >>> sorted(parser.known_relations)
+    ['295353', '58446']
+
+    Now fetching a single element just reads its file from the cache:
+
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get) as mock_get:
+    ...     fetch_osm_element('relation', '295353', cache_directory=tmp_cache, visited=set())
+    ...     fetch_osm_element('relation', '10000000000', cache_directory=tmp_cache, visited=set())
+    Relation(id="295353", members=118)
+    >>> mock_get.call_count
+    0
+
+    Remove the temporary directory created for these doctests:
+    >>> shutil.rmtree(tmp_cache)
+    """
+
+    if element_type not in ('relation', 'way', 'node'):
+        raise Exception("Unknown element type '%s'" % (element_type,))
+    element_ids = [str(element_id) for element_id in element_ids]
+    if verbose:
+        print("fetch_cached_batch(%s, %d elements)" % (element_type, len(element_ids)))
+    query = get_query_elements_and_dependents(element_type, element_ids)
+    if config.get('LOCAL_OVERPASS'):
+        return parse_xml_string(get_osm3s(query), False, cache_directory=cache_directory, **parser_kwargs)
+    parser = OSMXMLParser(False, cache_directory=cache_directory, **parser_kwargs)
+    with TemporaryFile() as fp:
+        download_remote(query, fp)
+        fp.seek(0)
+        parse_file_with_engine(fp, parser, parser.engine)
+    responses = split_batch_response(parser, element_type, element_ids)
+    get_element_cache(cache_directory).put_many(
+        (element_type, element_id, responses[element_id]) for element_id in element_ids)
+    return parser
+
+
+def split_batch_response(parser, element_type, element_ids):
+    """Split up the parsed response to a query for several elements
+
+    This returns a dictionary mapping each of element_ids to the XML
+    that a query for that element alone would have returned, given a
+    parser that's parsed the response to
+    get_query_elements_and_dependents without fetching anything.  An
+    element that wasn't in the response gets an empty response.
+
+    >>> parser = parse_xml_string('''<?xml version="1.0" encoding="UTF-8"?>
+    ... <osm version="0.6" generator="Overpass API">
+    ...   <node id="12" lat="52" lon="1"/>
+    ...   <node id="13" lat="52" lon="2"/>
+    ...   <way id="76543"><nd ref="12"/><nd ref="13"/></way>
+    ...   <way id="76544"><nd ref="13"/></way>
+    ... </osm>''', fetch_missing=False)
+    >>> responses = split_batch_response(parser, 'way', ['76544', '76545'])
+    >>> len(parse_xml_string(responses['76544'], fetch_missing=False))
+    2
+    >>> len(parse_xml_string(responses['76545'], fetch_missing=False))
+    0
+    """
+    known = dict((e.element_id, e) for e in parser.top_level_elements if e.element_type == element_type)
+    responses = {}
+    for element_id in element_ids:
+        if element_id in known:
+            xml = get_element_and_dependents_xml(known[element_id])
+        else:
+            xml = OSMElement.xml_wrapping()
+        data = etree.tostring(xml, encoding='utf-8', xml_declaration=True, pretty_print=True)
+        responses[element_id] = data.decode('utf-8')
+    return responses
 
 
-def parse_xml_minimal(s, element_handler):
+def fetch_missing_batched(element, parser, batch_size=DEFAULT_OVERPASS_BATCH_SIZE, verbose=False):
+    """Fetch the missing parts of element in batches, and fill them in
+
+    Rather than one query for each missing member, node or
+    sub-relation, the missing elements are gathered with
+    get_missing_elements and fetched with fetch_cached_batch in
+    queries of up to batch_size elements of the same type.  Then
+    they're filled in with reconstruct_missing, via parser, and the
+    whole thing repeats for anything that was missing from what was
+    just fetched, such as the members of a sub-relation.  Returns the
+    list of element type, id tuples that are still missing.
+
+    >>> tmp_cache = mkdtemp()
+    >>> r = Relation('1')
+    >>> r.add_member(OSMElement.make_missing_element('relation', '295353'))
+    >>> r.add_member(OSMElement.make_missing_element('node', '1000000000000'))
+    >>> r.add_member(OSMElement.make_missing_element('node', '1000000000001'))
+    >>> parser = OSMXMLParser(fetch_missing=False, cache_directory=tmp_cache)
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get) as mock_get:
+    ...     fetch_missing_batched(r, parser)
+    [('node', '1000000000000'), ('node', '1000000000001')]
+    >>> mock_get.call_count
+    2
+    >>> r[0]
+    (Relation(id="295353", members=118), '')
+
+    Remove the temporary directory created for these doctests:
+    >>> shutil.rmtree(tmp_cache)
+    """
+
+    missing = get_missing_element_cache(parser.cache_directory)
+    attempted = set()
+    while True:
+        to_fetch = {}
+        for t in element.get_missing_elements():
+            if t not in attempted:
+                attempted.add(t)
+                if not missing.is_missing(*t):
+                    to_fetch.setdefault(t[0], []).append(t[1])
+        if not to_fetch:
+            break
+        for element_type, element_ids in sorted(to_fetch.items()):
+            for i in range(0, len(element_ids), batch_size):
+                batch = element_ids[i:i + batch_size]
+                fetched = fetch_cached_batch(element_type,
+                                             batch,
+                                             verbose,
+                                             parser.cache_directory,
+                                             **parser.nested_parser_options())
+                found = set(e.element_id for e in fetched.top_level_elements if e.element_type == element_type)
+                for element_id in batch:
+                    if element_id not in found:
+                        missing.add(element_type, element_id)
+                if parser.cache_in_memory:
+                    for name in ('known_nodes', 'known_ways', 'known_relations'):
+                        known = getattr(parser, name)
+                        for element_id, e in getattr(fetched, name).items():
+                            known.setdefault(element_id, e)
+        element.reconstruct_missing(parser, {})
+    return element.get_missing_elements()
+
+
+def parse_xml_minimal(s, element_handler, engine=None):
     """Parse some OSM XML just to get type, id and tags
 
     >>> def output(type, id, tags):
@@ -1864,13 +4136,442 @@ def parse_xml_minimal(s, element_handler):
     type: node id: 312203528 tags: {}
     type: way id: 28421671 tags: {}
     type: relation id: 3123205528 tags: {'name:en': 'Whatever'}
+
+    The lxml engine gives the same output:
+
+    >>> parse_xml_minimal(example_xml, output, engine='lxml')
+    type: node id: 291974462 tags: {}
+    type: node id: 312203528 tags: {}
+    type: way id: 28421671 tags: {}
+    type: relation id: 3123205528 tags: {'name:en': 'Whatever'}
     """
-    fp = StringIO(s)
     parser = MinimalOSMXMLParser(element_handler)
-    xml.sax.parse(fp, parser)
+    parse_string_with_engine(s, parser, engine)
+
+
+def get_parser_engine(engine=None):
+    """Return the name of the XML parser engine to use
+
+    If no engine is specified, the OSM_XML_PARSER setting from
+    general.yml is used, falling back to 'sax':
+
+    >>> get_parser_engine('lxml')
+    'lxml'
+    >>> with patch.dict(config, {'OSM_XML_PARSER': 'lxml'}):
+    ...     get_parser_engine()
+    'lxml'
+    >>> with patch.dict(config, {}, clear=True):
+    ...     get_parser_engine()
+    'sax'
+
+    An unknown engine is an error:
+
+    >>> get_parser_engine('regex')
+    Traceback (most recent call last):
+      ...
+    Exception: Unknown XML parser engine 'regex'
+    """
+    if engine is None:
+        engine = config.get('OSM_XML_PARSER') or 'sax'
+    if engine not in PARSER_ENGINES:
+        raise Exception("Unknown XML parser engine '%s'" % (engine,))
+    return engine
+
+
+def iterparse_osm_xml(source, handler):
+    """Feed OSM XML to a handler using lxml's iterparse
+
+    source may be a filename or a file object open in binary mode.
+    If the handler has an lxml_element method, as OSMXMLParser and
+    MinimalOSMXMLParser do, lxml only reports the end of each
+    top-level <node>, <way> or <relation>, which is passed whole to
+    that method.  Otherwise handler.startElement and
+    handler.endElement are called in the same order as xml.sax would
+    call them.  Either way, once each top-level element has ended, it
+    is cleared and removed from the tree, so memory use doesn't grow
+    with the size of the document.
+
+    >>> class PrintingHandler:
+    ...     def startElement(self, name, attr):
+    ...         print("start", name, sorted(attr.items()))
+    ...     def endElement(self, name):
+    ...         print("end", name)
+    >>> example_xml = b'''<?xml version="1.0" encoding="UTF-8"?>
+    ... <osm version="0.6">
+    ...   <node id="291974462" lat="55.0548850" lon="-2.9544991"/>
+    ...   <way id="28421671">
+    ...     <nd ref="291974462"/>
+    ...     <!-- a comment that should be ignored -->
+    ...     <tag k="name" v="Somewhere"/>
+    ...   </way>
+    ... </osm>'''
+    >>> iterparse_osm_xml(BytesIO(example_xml), PrintingHandler())
+    start osm [('version', '0.6')]
+    start node [('id', '291974462'), ('lat', '55.0548850'), ('lon', '-2.9544991')]
+    end node
+    start way [('id', '28421671')]
+    start nd [('ref', '291974462')]
+    end nd
+    start tag [('k', 'name'), ('v', 'Somewhere')]
+    end tag
+    end way
+    end osm
+
+    >>> class ElementHandler:
+    ...     def lxml_element(self, element):
+    ...         print(element.tag, element.get('id'), len(element))
+    >>> iterparse_osm_xml(BytesIO(example_xml), ElementHandler())
+    node 291974462 0
+    way 28421671 3
+
+    Only elements that are directly inside the root element are
+    passed to lxml_element, so misplaced ones are still reported:
+
+    >>> iterparse_osm_xml(BytesIO(b'''<osm>
+    ...   <note>Some text</note>
+    ...   <way id="1"><node id="2" lat="0" lon="0"/></way>
+    ... </osm>'''), OSMXMLParser(fetch_missing=False)) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    UnexpectedElementException: Should never get a new <node> when still in a top-level element
+    >>> iterparse_osm_xml(BytesIO(b'''<osm>
+    ...   <nd ref="1"/>
+    ...   <node id="2" lat="0" lon="0"/>
+    ... </osm>'''), OSMXMLParser(fetch_missing=False)) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    UnexpectedElementException: Should never get a <nd> at the top level
+
+    That includes anything after the last node, way or relation, such
+    as the remark that Overpass adds when a query times out, so an
+    incomplete response is never taken for a complete one:
+
+    >>> iterparse_osm_xml(BytesIO(b'''<osm>
+    ...   <node id="2" lat="0" lon="0"/>
+    ...   <remark> runtime error: Query timed out </remark>
+    ... </osm>'''), OSMXMLParser(fetch_missing=False)) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    UnexpectedElementException: Should never get a <remark> at the top level
+    """
+    if hasattr(handler, 'lxml_element'):
+        events = etree.iterparse(source, events=('end',), tag=LXML_TOP_LEVEL_TAGS)
+        dispatch_lxml_elements(events, handler)
+        check_lxml_top_level(events.root)
+    else:
+        dispatch_lxml_events(etree.iterparse(source, events=('start', 'end')), handler)
+
+
+# The elements that are passed whole to a handler's lxml_element method:
+LXML_TOP_LEVEL_TAGS = sorted(OSMXMLParser.VALID_TOP_LEVEL_ELEMENTS)
+
+
+def dispatch_lxml_elements(events, handler):
+    """Pass each top-level element from lxml's end events to handler.lxml_element
+
+    The events must only be for elements in LXML_TOP_LEVEL_TAGS.  As
+    each top-level element is passed on, it and any earlier siblings
+    are removed from the tree; the siblings must be elements that
+    OSMXMLParser ignores.  This is the part of iterparse_osm_xml
+    that's shared with LxmlIncrementalParser.
+    """
+    for event, element in events:
+        parent = element.getparent()
+        if parent is None or parent.getparent() is not None:
+            # This is nested in another element, which will be
+            # passed to the handler (and complain about it) whole.
+            continue
+        while parent[0] is not element:
+            raise_if_unexpected_top_level(parent[0])
+            del parent[0]
+        handler.lxml_element(element)
+        element.clear()
+        del parent[0]
 
 
-def parse_xml(filename, fetch_missing=True):
+def raise_if_unexpected_top_level(element):
+    """Raise UnexpectedElementException unless OSMXMLParser ignores element at the top level"""
+    if isinstance(element.tag, str) and element.tag not in OSMXMLParser.IGNORED_TAGS:
+        raise UnexpectedElementException(
+            element.tag, "Should never get a <%s> at the top level" % (element.tag,))
+
+
+def check_lxml_top_level(root):
+    """Check what's left in the root element once dispatch_lxml_elements is done
+
+    Elements after the last one in LXML_TOP_LEVEL_TAGS never come as
+    events, so they're checked here instead."""
+    if root is not None:
+        for element in root:
+            raise_if_unexpected_top_level(element)
+
+
+def dispatch_lxml_events(events, handler, depth=0):
+    """Call handler's methods for lxml's start and end events
+
+    This is the part of iterparse_osm_xml that's shared with
+    LxmlIncrementalParser.  depth is how deeply nested in the document
+    the events start, and the depth after the last event is returned.
+    """
+    for event, element in events:
+        if event == 'start':
+            depth += 1
+            handler.startElement(element.tag, element.attrib)
+        else:
+            depth -= 1
+            handler.endElement(element.tag)
+            if depth == 1:
+                # This is the end of a top-level element, so it and
+                # any earlier siblings can be discarded:
+                element.clear()
+                parent = element.getparent()
+                while element.getprevious() is not None:
+                    del parent[0]
+    return depth
+
+
+class LxmlIncrementalParser(object):
+
+    """Like xml.sax's IncrementalParser, but using lxml
+
+    Data is given to it with feed(), and the handler is passed the
+    elements as they're parsed, as with iterparse_osm_xml.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.whole_elements = hasattr(handler, 'lxml_element')
+        if self.whole_elements:
+            self.parser = etree.XMLPullParser(events=('end',), tag=LXML_TOP_LEVEL_TAGS)
+        else:
+            self.parser = etree.XMLPullParser(events=('start', 'end'))
+        self.depth = 0
+
+    def dispatch(self):
+        if self.whole_elements:
+            dispatch_lxml_elements(self.parser.read_events(), self.handler)
+        else:
+            self.depth = dispatch_lxml_events(self.parser.read_events(), self.handler, self.depth)
+
+    def feed(self, data):
+        self.parser.feed(data)
+        self.dispatch()
+
+    def close(self):
+        root = self.parser.close()
+        self.dispatch()
+        if self.whole_elements:
+            check_lxml_top_level(root)
+
+
+def make_incremental_parser(handler, engine=None):
+    """Return an object whose feed() method parses OSM XML bit by bit
+
+    Its close() method must be called once all the data has been
+    fed to it.  The elements are passed to the SAX-style handler as
+    they're parsed, with either engine.
+    """
+    if get_parser_engine(engine) == 'lxml':
+        return LxmlIncrementalParser(handler)
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(handler)
+    return parser
+
+
+def iter_xml_minimal(fp, engine=None, chunk_size=64 * 1024):
+    """Yield the type, id and tags of each top-level element in a file
+
+    This is like parse_xml_minimal, but it reads the binary file
+    object fp a chunk at a time, and is a generator, so the elements
+    can be dealt with while the file is still being read (e.g. from
+    stream_osm3s) and memory use doesn't depend on the size of the
+    file:
+
+    >>> example_xml = b'''<?xml version="1.0" encoding="UTF-8"?>
+    ... <osm version="0.6" generator="Overpass API">
+    ...   <node id="291974462" lat="55.0548850" lon="-2.9544991"/>
+    ...   <relation id="3123205528">
+    ...     <member type="node" ref="291974462" role="admin_centre"/>
+    ...     <tag k="name:en" v="Whatever"/>
+    ...   </relation>
+    ... </osm>'''
+    >>> for engine in PARSER_ENGINES:
+    ...     print(list(iter_xml_minimal(BytesIO(example_xml), engine=engine, chunk_size=16)))
+    [('node', '291974462', {}), ('relation', '3123205528', {'name:en': 'Whatever'})]
+    [('node', '291974462', {}), ('relation', '3123205528', {'name:en': 'Whatever'})]
+    """
+    found = deque()
+    parser = make_incremental_parser(MinimalOSMXMLParser(lambda *t: found.append(t)), engine)
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        while found:
+            yield found.popleft()
+    parser.close()
+    while found:
+        yield found.popleft()
+
+
+def is_osm_json(head):
+    """Return whether the start of an Overpass response is JSON rather than XML
+
+    >>> is_osm_json(b'  {"version": 0.6'), is_osm_json('<?xml version="1.0"?>')
+    (True, False)
+    """
+    return head.lstrip()[:1] in ('{', b'{')
+
+
+def feed_osm_json(data, handler):
+    """Decode an Overpass JSON response and feed it to a SAX-style handler
+
+    The response (a str or bytes) is decoded with orjson if it's
+    installed, or the json module otherwise.  Then the handler's
+    startElement and endElement methods are called just as they would
+    be for the equivalent XML response, so the same elements are
+    built.  Coordinates are given with 7 decimal places, as Overpass
+    gives them in XML:
+
+    >>> handler = OSMXMLParser(fetch_missing=False)
+    >>> feed_osm_json('''{"version": 0.6, "elements": [
+    ...   {"type": "node", "id": 291974462, "lat": 55.054885, "lon": -2.9544991},
+    ...   {"type": "way", "id": 28421671, "nodes": [291974462], "tags": {"name": "Somewhere"}},
+    ...   {"type": "relation", "id": 3123205528, "members": [{"type": "way", "ref": 28421671, "role": "inner"}]}
+    ... ]}''', handler)
+    >>> for e in handler:
+    ...     print(e)
+    Node(id="291974462", lat="55.0548850", lon="-2.9544991")
+    Way(id="28421671", nodes=1)
+    Relation(id="3123205528", members=1)
+    >>> handler.known_ways['28421671'].tags
+    {'name': 'Somewhere'}
+
+    The geometry of a way, from a query with inline geometry, gives
+    the locations of its nodes:
+
+    >>> feed_osm_json('''{"elements": [{"type": "way", "id": 28421672, "nodes": [291974463],
+    ...                                  "geometry": [{"lat": 55.1, "lon": -2.9}]}]}''', handler)
+    >>> handler.known_ways['28421672'].nodes
+    [Node(id="291974463", lat="55.1000000", lon="-2.9000000")]
+
+    Anything that isn't a node, way or relation is as unexpected as
+    it would be in XML:
+
+    >>> feed_osm_json('{"elements": [{"type": "area", "id": 1}]}',
+    ...               handler) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    UnexpectedElementException: Should never get a <area> at the top level
+
+    So is a remark, which is how Overpass reports an error such as a
+    timeout in JSON, and a response with no elements at all isn't
+    taken for an empty one.  Either way the handler is given nothing:
+
+    >>> feed_osm_json('''{"elements": [{"type": "node", "id": 2, "lat": 0, "lon": 0}],
+    ...                 "remark": "runtime error: Query timed out"}''',
+    ...               handler) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    UnexpectedElementException: Should never get a <remark> at the top level: runtime error: Query timed out
+    >>> feed_osm_json('{"version": 0.6}', handler)
+    Traceback (most recent call last):
+      ...
+    Exception: No elements in the Overpass JSON response
+    >>> '2' in handler.known_nodes
+    False
+    """
+    document = orjson.loads(data) if orjson is not None else json.loads(data)
+    if 'remark' in document:
+        raise UnexpectedElementException(
+            'remark', "Should never get a <remark> at the top level: %s" % (document['remark'],))
+    if 'elements' not in document:
+        raise Exception("No elements in the Overpass JSON response")
+    start, end = handler.startElement, handler.endElement
+    start('osm', {'version': str(document.get('version', '0.6'))})
+    for e in document['elements']:
+        element_type = e['type']
+        if element_type == 'node':
+            start('node', {'id': str(e['id']), 'lat': '%.7f' % (e['lat'],), 'lon': '%.7f' % (e['lon'],)})
+        else:
+            start(element_type, {'id': str(e['id'])})
+        if element_type == 'way':
+            geometry = e.get('geometry') or ()
+            for i, node_id in enumerate(e.get('nodes', ())):
+                location = geometry[i] if i < len(geometry) else None
+                if location:
+                    start('nd', {'ref': str(node_id),
+                                 'lat': '%.7f' % (location['lat'],),
+                                 'lon': '%.7f' % (location['lon'],)})
+                else:
+                    start('nd', {'ref': str(node_id)})
+                end('nd')
+        elif element_type == 'relation':
+            for member in e.get('members', ()):
+                start('member', {'type': member['type'], 'ref': str(member['ref']), 'role': member['role']})
+                end('member')
+        for k, v in e.get('tags', {}).items():
+            start('tag', {'k': k, 'v': v})
+            end('tag')
+        end(element_type)
+    end('osm')
+
+
+class PrefixedFile(object):
+
+    """A file object that reads prefix, and then the rest of fp
+
+    This is for putting back what was read to find out what's in a
+    file that can't seek.
+    """
+
+    def __init__(self, prefix, fp):
+        self.prefix = prefix
+        self.fp = fp
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fp.read(size)
+        if size is None or size < 0:
+            data = self.prefix + self.fp.read()
+        else:
+            data = self.prefix[:size]
+        self.prefix = self.prefix[len(data):]
+        return data
+
+    def close(self):
+        self.fp.close()
+
+
+def parse_string_with_engine(s, handler, engine=None):
+    """Parse OSM XML (or JSON) in a string (or bytes) with the SAX-style handler"""
+    if is_osm_json(s[:64]):
+        feed_osm_json(s, handler)
+    elif get_parser_engine(engine) == 'lxml':
+        if not isinstance(s, bytes):
+            s = s.encode('utf-8')
+        parse_file_with_engine(BytesIO(s), handler, engine)
+    else:
+        parse_file_with_engine(BytesIO(s) if isinstance(s, bytes) else StringIO(s), handler, engine)
+
+
+def parse_file_with_engine(fp, handler, engine=None):
+    """Parse OSM XML (or JSON) from a file object with the SAX-style handler
+
+    For the lxml engine, fp must be open in binary mode.  A JSON
+    response is read into memory to be decoded."""
+    head = fp.read(64)
+    if is_osm_json(head):
+        feed_osm_json(head + fp.read(), handler)
+        return
+    fp = PrefixedFile(head, fp)
+    if get_parser_engine(engine) == 'lxml':
+        iterparse_osm_xml(fp, handler)
+    else:
+        xml.sax.parse(fp, handler)
+
+
+def parse_xml(filename, fetch_missing=True, **parser_kwargs):
     """Completely parse an OSM XML file
 
     >>> example_xml = '''<?xml version="1.0" encoding="UTF-8"?>
@@ -1897,38 +4598,121 @@ def parse_xml(filename, fetch_missing=True):
     Node(id="312203528", lat="54.4600000", lon="-5.0596341")
     Way(id="28421671", nodes=2)
     Relation(id="3123205528", members=1)
+
+    The same file can be parsed with lxml's iterparse instead of
+    xml.sax, giving the same elements:
+
+    >>> with NamedTemporaryFile(delete=False) as ntf:
+    ...     _ = ntf.write(example_xml.encode('utf-8'))
+    >>> parser = parse_xml(ntf.name, fetch_missing=False, engine='lxml')
+    >>> os.remove(ntf.name)
+    >>> for top_level_element in parser:
+    ...     print(top_level_element)
+    Node(id="291974462", lat="55.0548850", lon="-2.9544991")
+    Node(id="312203528", lat="54.4600000", lon="-5.0596341")
+    Way(id="28421671", nodes=2)
+    Relation(id="3123205528", members=1)
+    >>> parser.known_relations['3123205528'].tags
+    {'name:en': 'Whatever'}
     """
-    parser = OSMXMLParser(fetch_missing)
-    with open(filename) as fp:
-        xml.sax.parse(fp, parser)
+    parser = OSMXMLParser(fetch_missing, **parser_kwargs)
+    if parser.engine == 'lxml':
+        iterparse_osm_xml(filename, parser)
+    else:
+        with open(filename) as fp:
+            xml.sax.parse(fp, parser)
     return parser
 
 
 def parse_xml_string(s, *parser_args, **parser_kwargs):
-    fp = StringIO(s)
+    """Completely parse OSM XML in a string
+
+    Any arguments are passed on to OSMXMLParser, including engine,
+    which selects the XML parser to use.  With the lxml engine,
+    callbacks are made in the same order as with xml.sax:
+
+    >>> example_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+    ... <osm version="0.6" generator="Overpass API">
+    ...   <node id="291974462" lat="55.0548850" lon="-2.9544991"/>
+    ...   <node id="312203528" lat="54.4600000" lon="-5.0596341"/>
+    ...   <way id="28421671">
+    ...     <nd ref="291974462"/>
+    ...     <nd ref="312203528"/>
+    ...   </way>
+    ... </osm>
+    ... '''
+    >>> def test(element, parser):
+    ...    print("got element:", element)
+    >>> parser = parse_xml_string(example_xml, fetch_missing=False, callback=test, engine='lxml')
+    got element: Node(id="291974462", lat="55.0548850", lon="-2.9544991")
+    got element: Node(id="312203528", lat="54.4600000", lon="-5.0596341")
+    got element: Way(id="28421671", nodes=2)
+
+    Unexpected elements are still reported:
+
+    >>> parse_xml_string('''<?xml version="1.0" encoding="UTF-8"?>
+    ... <osm version="0.6" generator="Overpass API">
+    ...   <node id="123" lat="52" lon="0">
+    ...     <member type="way" ref="345" role=""/>
+    ...   </node>
+    ... </osm>''', fetch_missing=False, engine='lxml') # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    UnexpectedElementException: Didn't expect to find <member> in a <node>, can only be in <relation>
+
+    With compact_nodes, nodes without tags are parsed as CompactNode
+    objects, while those with tags are still Nodes:
+
+    >>> parser = parse_xml_string('''<?xml version="1.0" encoding="UTF-8"?>
+    ... <osm version="0.6" generator="Overpass API">
+    ...   <node id="291974462" lat="55.0548850" lon="-2.9544991"/>
+    ...   <node id="312203528" lat="54.4600000" lon="-5.0596341">
+    ...     <tag k="name" v="Somewhere"/>
+    ...   </node>
+    ... </osm>''', fetch_missing=False, compact_nodes=True)
+    >>> [type(e).__name__ for e in parser]
+    ['CompactNode', 'Node']
+    >>> parser.known_nodes['312203528'].tags
+    {'name': 'Somewhere'}
+
+    With array_ways, ways are parsed as ArrayWay objects:
+
+    >>> parser = parse_xml_string(example_xml, fetch_missing=False, array_ways=True)
+    >>> way = parser.known_ways['28421671']
+    >>> type(way).__name__, way.node_ids
+    ('ArrayWay', array('q', [291974462, 312203528]))
+    """
     parser = OSMXMLParser(*parser_args, **parser_kwargs)
-    xml.sax.parse(fp, parser)
+    parse_string_with_engine(s, parser, parser.engine)
     return parser
 
 
-def fetch_osm_element(element_type, element_id, fetch_missing=True, verbose=False, cache_directory=None, visited=None):
+def fetch_osm_element(element_type, element_id, fetch_missing=True, verbose=False, cache_directory=None, visited=None,
+                      batch_size=None, **parser_kwargs):
     """Fetch and parse a particular OSM element recursively
 
     More data is fetched from the API if required.  'element_type'
-    should be one of 'relation', 'way' or 'node'.
+    should be one of 'relation', 'way' or 'node'.  Any other keyword
+    arguments are passed on to OSMXMLParser.
+
+    If batch_size is more than zero, anything missing from the
+    element is fetched afterwards by fetch_missing_batched, in
+    queries of up to batch_size elements, rather than with one query
+    per element as it's parsed.  If batch_size is None, the
+    OVERPASS_BATCH_SIZE setting is used, which defaults to 0.
 
     For example, you could request the relation representing Scotland
     with:
 
     >>> tmp_cache = mkdtemp()
-    >>> with patch.object(requests, 'get', side_effect=fake_requests_get):
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get):
     ...     fetch_osm_element("relation", "58446", cache_directory=tmp_cache)
     Relation(id="58446", members=70)
 
     Or do the same, more verbosely, with:
 
     >>> tmp_cache2 = mkdtemp()
-    >>> with patch.object(requests, 'get', side_effect=fake_requests_get):
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get):
     ...     fetch_osm_element("relation", "58446", verbose=True, cache_directory=tmp_cache2, visited=set())
     fetch_osm_element(relation, 58446)
     Relation(id="58446", members=70)
@@ -1937,11 +4721,30 @@ def fetch_osm_element(element_type, element_id, fetch_missing=True, verbose=Fals
     exception, but at the moment just returns None
 
     >>> tmp_cache3 = mkdtemp()
-    >>> with patch.object(requests, 'get', side_effect=fake_requests_get):
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get):
     ...     fetch_osm_element('relation', '10000000000', cache_directory=tmp_cache3)
 
+    Responses can be requested in JSON rather than XML, which also
+    gives the same result:
+
+    >>> tmp_cache5 = mkdtemp()
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get), \\
+    ...         patch.dict(config, {'OVERPASS_OUTPUT': 'json'}):
+    ...     fetch_osm_element("relation", "58446", cache_directory=tmp_cache5, visited=set())
+    Relation(id="58446", members=70)
+    >>> get_element_cache(tmp_cache5).get('relation', '58446')[:12]
+    '{"version": '
+    >>> shutil.rmtree(tmp_cache5)
+
+    Fetching in batches gives the same result:
+
+    >>> tmp_cache4 = mkdtemp()
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get):
+    ...     fetch_osm_element("relation", "58446", cache_directory=tmp_cache4, visited=set(), batch_size=50)
+    Relation(id="58446", members=70)
+
     Remove the temporary directories created for these doctests:
-    >>> for d in (tmp_cache, tmp_cache2, tmp_cache3):
+    >>> for d in (tmp_cache, tmp_cache2, tmp_cache3, tmp_cache4):
     ...     shutil.rmtree(d)
     """
 
@@ -1949,27 +4752,522 @@ def fetch_osm_element(element_type, element_id, fetch_missing=True, verbose=Fals
     if verbose:
         print("fetch_osm_element(%s, %s)" % (element_type, element_id))
 
-    # Prevent circular inclusion of relations
-    global CACHE_VISITED
-    if visited is not None:
-        CACHE_VISITED = visited
-    if element_id in CACHE_VISITED:
+    # Prevent circular inclusion of relations.  The visited set is
+    # shared by the parsers of everything fetched for one element, so
+    # that elements can be fetched concurrently in different threads:
+    top_level = not visited
+    if visited is None:
+        visited = set()
+    if element_id in visited:
         print("  SEEN ALREADY...")
         return None
     if element_type == 'relation':
-        CACHE_VISITED.add(element_id)
+        visited.add(element_id)
+
+    if batch_size is None:
+        batch_size = config.get('OVERPASS_BATCH_SIZE') or 0
+    batched = fetch_missing and batch_size > 0
+    parsed = OSMXMLParser(fetch_missing and not batched,
+                          cache_directory=cache_directory,
+                          visited=visited,
+                          **parser_kwargs)
+
+    # If it's been fetched and parsed completely before, there may be
+    # a pre-parsed version:
+    cache = get_element_cache(cache_directory)
+    result, _ = parsed.get_from_parsed_cache(cache, element_type, element_id)
+    if result is not None:
+        if top_level:
+            record_dependencies(result, cache_directory)
+        return result
 
-    # Make sure we have the XML file for that relation, node or way:
-    xml = fetch_cached(element_type, element_id, verbose, cache_directory)
-    try:
-        parsed = parse_xml_string(xml, fetch_missing)
-    except UnexpectedElementException:
-        raise
+    # Make sure we have the XML file for that relation, node or way,
+    # and parse it from there:
+    with fetch_cached_file(element_type, element_id, verbose, cache_directory) as fp:
+        parse_file_with_engine(fp, parsed, parsed.engine)
     # Sometimes we seem to have an empty element returned, in which
-    # case just return None:
+    # case remember that it's missing and just return None:
+    missing = get_missing_element_cache(cache_directory)
     if not len(parsed):
+        missing.add(element_type, element_id)
         return None
-    return parsed.get_known_or_fetch(element_type, element_id)
+    missing.discard(element_type, element_id)
+    result = parsed.get_known_or_fetch(element_type, element_id)
+    if batched:
+        fetch_missing_batched(result, parsed, batch_size, verbose)
+    parsed.add_to_parsed_cache(cache, result)
+    parsed.record_cache_statistics()
+    if top_level:
+        record_dependencies(result, cache_directory)
+    return result
+
+
+def get_dependencies(element):
+    """Return the set of (element_type, element_id) of what a boundary is made of
+
+    For a relation, that's the ways that Relation.way_iterator finds
+    (inner and outer), the sub-relations it goes through and the
+    nodes of all the ways.  For a way, it's just its nodes:
+
+    >>> r = Relation('98765')
+    >>> r.add_member(Way('76543', nodes=[Node('12', latitude='52', longitude='1'),
+    ...                                  Node('13', latitude='52', longitude='2')]))
+    >>> sub_relation = Relation('98764')
+    >>> sub_relation.add_member(Way('76544'))
+    >>> r.add_member(sub_relation)
+    >>> r.add_member(Node('14', latitude='52', longitude='1.5'), role='admin_centre')
+    >>> sorted(get_dependencies(r))
+    [('node', 12), ('node', 13), ('relation', 98764), ('way', 76543), ('way', 76544)]
+    """
+    if element.element_type == 'way':
+        ways = [element]
+        dependencies = set()
+    else:
+        relations = set()
+        ways = list(element.way_iterator(False, relations)) + list(element.way_iterator(True, relations))
+        dependencies = set(('relation', int(r.element_id)) for r in relations)
+        dependencies.update(('way', int(w.element_id)) for w in ways)
+    for way in ways:
+        if isinstance(way, ArrayWay):
+            dependencies.update(('node', node_id) for node_id in way.node_ids)
+        else:
+            dependencies.update(('node', int(node.element_id)) for node in way)
+    return dependencies
+
+
+def record_dependencies(element, cache_directory=None):
+    """Add what a way or relation is made of to the dependency index, if DEPENDENCY_INDEX is set
+
+    This is done for each way and relation that fetch_osm_element
+    fetches for itself (rather than as part of another element), so
+    as boundaries are fetched the index learns which boundaries each
+    node, way and relation is part of.  The index is only written to
+    disk by DependencyIndex.flush().
+    """
+    if not config.get('DEPENDENCY_INDEX') or element is None or element.element_type == 'node':
+        return
+    get_dependency_index(cache_directory).add(
+        element.element_type, element.element_id, get_dependencies(element))
+
+
+def invalidate_dependents(element_type_ids, cache_directory=None):
+    """Remove the cached responses made out of date by changes to elements
+
+    The boundaries made of any of the elements are found in the
+    dependency index, and the responses for them, for everything
+    they're made of (apart from nodes) and for the elements
+    themselves are removed from the element cache, so they'll be
+    fetched again.  The set of (element_type, element_id) of the
+    boundaries affected, including any of the elements that are
+    boundaries themselves, is returned.
+
+    >>> tmp_cache = mkdtemp()
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get), \\
+    ...         patch.dict(config, {'DEPENDENCY_INDEX': True}):
+    ...     fetch_osm_element('relation', '58446', cache_directory=tmp_cache)
+    Relation(id="58446", members=70)
+    >>> get_dependency_index(tmp_cache).flush()
+    >>> invalidate_dependents([('node', 1000000000000), ('node', 312214936)], tmp_cache)
+    {('relation', 58446)}
+    >>> ('relation', '58446') in get_element_cache(tmp_cache)
+    False
+    >>> shutil.rmtree(tmp_cache)
+    """
+    index = get_dependency_index(cache_directory)
+    element_type_ids = set((element_type, int(element_id)) for element_type, element_id in element_type_ids)
+    affected = index.boundaries_using(element_type_ids)
+    affected.update(k for k in element_type_ids if k[0] != 'node' and index.members_of(*k))
+    stale = set(element_type_ids) | affected
+    for boundary_type, boundary_id in affected:
+        stale.update(k for k in index.members_of(boundary_type, boundary_id) if k[0] != 'node')
+    get_element_cache(cache_directory).remove_many((t, str(i)) for t, i in stale)
+    missing = get_missing_element_cache(cache_directory)
+    for element_type, element_id in element_type_ids:
+        missing.discard(element_type, element_id)
+    clear_parsed_file_memo()
+    return affected
+
+
+def get_fetch_concurrency(max_workers=None):
+    """Return the number of elements to fetch at once
+
+    If max_workers is None, the FETCH_CONCURRENCY setting is used,
+    which defaults to 2:
+
+    >>> get_fetch_concurrency(8)
+    8
+    >>> with patch.dict(config, {'FETCH_CONCURRENCY': 4}):
+    ...     get_fetch_concurrency()
+    4
+    """
+    if max_workers is None:
+        max_workers = config.get('FETCH_CONCURRENCY') or 2
+    return max_workers
+
+
+def map_concurrently(f, args_list, max_workers=None):
+    """Call f(*args) for each tuple in args_list in a pool of threads
+
+    This is for work that spends most of its time waiting for the
+    Overpass API.  At most max_workers calls run at once (see
+    get_fetch_concurrency), and only a few more are queued up than
+    that, so args_list can be a long iterator.  Pairs of the args and
+    a completed Future are yielded in the order of args_list; the
+    Future's result() returns what f returned, or raises whatever
+    exception f raised:
+
+    >>> def divide(a, b):
+    ...     return a / b
+    >>> for args, future in map_concurrently(divide, [(1, 2), (1, 0), (3, 1)], max_workers=2):
+    ...     try:
+    ...         print(args, future.result())
+    ...     except ZeroDivisionError:
+    ...         print(args, "failed")
+    (1, 2) 0.5
+    (1, 0) failed
+    (3, 1) 3.0
+    """
+    max_workers = get_fetch_concurrency(max_workers)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for args in args_list:
+            pending.append((args, executor.submit(f, *args)))
+            if len(pending) >= 2 * max_workers:
+                args, future = pending.popleft()
+                future.exception()
+                yield args, future
+        while pending:
+            args, future = pending.popleft()
+            future.exception()
+            yield args, future
+
+
+def fetch_cached_concurrently(element_type_id_tuples, max_workers=None, verbose=False, cache_directory=None):
+    """Call fetch_cached for each (element_type, element_id) concurrently
+
+    Yields pairs of each (element_type, element_id) tuple and a
+    completed Future, as map_concurrently does:
+
+    >>> tmp_cache = mkdtemp()
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get) as mock_get:
+    ...     for t, future in fetch_cached_concurrently([('relation', '58446'), ('relation', '295353')],
+    ...                                                cache_directory=tmp_cache):
+    ...         print(t, future.result().count('<way '), 'ways')
+    ('relation', '58446') 68 ways
+    ('relation', '295353') 117 ways
+    >>> shutil.rmtree(tmp_cache)
+    """
+    return map_concurrently(
+        lambda element_type, element_id: fetch_cached(element_type, element_id, verbose, cache_directory),
+        element_type_id_tuples,
+        max_workers)
+
+
+def fetch_osm_elements_concurrently(element_type_id_tuples, max_workers=None, **kwargs):
+    """Call fetch_osm_element for each (element_type, element_id) concurrently
+
+    Each element is fetched with its own set of visited relations.
+    Any keyword arguments are passed on to fetch_osm_element.  Yields
+    pairs of each (element_type, element_id) tuple and a completed
+    Future, as map_concurrently does:
+
+    >>> tmp_cache = mkdtemp()
+    >>> with patch.object(requests.Session, 'get', side_effect=fake_requests_get):
+    ...     for t, future in fetch_osm_elements_concurrently([('relation', '58446'),
+    ...                                                       ('relation', '10000000000'),
+    ...                                                       ('relation', '295353')],
+    ...                                                      cache_directory=tmp_cache):
+    ...         print(t, future.result())
+    ('relation', '58446') Relation(id="58446", members=70)
+    ('relation', '10000000000') None
+    ('relation', '295353') Relation(id="295353", members=118)
+    >>> shutil.rmtree(tmp_cache)
+    """
+    return map_concurrently(
+        lambda element_type, element_id: fetch_osm_element(element_type, element_id, visited=set(), **kwargs),
+        element_type_id_tuples,
+        max_workers)
+
+
+def get_pbf_processes(processes=None):
+    """Return the number of processes to decode .osm.pbf blocks in
+
+    If processes is None, the PBF_PROCESSES setting is used, which
+    defaults to the number of CPUs.
+    """
+    if processes is None:
+        processes = config.get('PBF_PROCESSES') or os.cpu_count() or 1
+    return processes
+
+
+def read_boundaries_from_pbf(filename, tag_filters, processes=None, **parser_kwargs):
+    """Read boundaries and everything they're made of from an .osm.pbf file
+
+    This needs no Overpass API at all: the relations and ways whose
+    tags match one of tag_filters (dictionaries of tags that must all
+    be present) are found in a PBF extract of OpenStreetMap, and then
+    their members and nodes, as PBFExtract does.  They're parsed into
+    an OSMXMLParser as if they'd been fetched, so the elements that
+    are returned, in the order they're in the file, can be given to
+    get_kml_for_osm_element_no_fetch.  The nodes go straight from the
+    file to the parser, so the parser's elements are the only copy of
+    them; compact_nodes and array_ways (or the COMPACT_NODES and
+    ARRAY_WAYS settings) make those much smaller.  Any keyword
+    arguments are passed on to the OSMXMLParser:
+
+    >>> tmp_directory = mkdtemp()
+    >>> fixture = os.path.join(dirname(__file__), '..', 'mapit_global', 'tests',
+    ...                        'overpass-responses', 'relation-295353.xml')
+    >>> with open(fixture) as f:
+    ...     response = f.read()
+    >>> filename = os.path.join(tmp_directory, 'extract.osm.pbf')
+    >>> with open(filename, 'wb') as fp:
+    ...     xml_to_pbf(response, fp)
+    >>> boundaries = read_boundaries_from_pbf(
+    ...     filename, [{'boundary': 'administrative', 'admin_level': '8'}], processes=2)
+    >>> boundaries[-1]
+    Relation(id="295353", members=118)
+
+    As with get_query_relations_and_ways, ways with the tags are
+    boundaries too, even if (as here) they're only parts of a
+    relation's boundary:
+
+    >>> len(boundaries), boundaries[0]
+    (72, Way(id="42718007", nodes=177))
+
+    The ways are just as they'd be from the Overpass response:
+
+    >>> from_overpass = parse_xml_string(response, fetch_missing=False).known_relations['295353']
+    >>> def coordinates(relation):
+    ...     return [w.lon_lat_tuples() for w in relation.way_iterator(False)]
+    >>> coordinates(boundaries[-1]) == coordinates(from_overpass)
+    True
+    >>> shutil.rmtree(tmp_directory)
+    """
+    extract = PBFExtract(filename, tag_filters, OSMXMLParser.IGNORED_ROLES, get_pbf_processes(processes))
+    parser_kwargs.setdefault('cache_limits', {})
+    parser = OSMXMLParser(fetch_missing=False, callback=lambda element, parser: None, **parser_kwargs)
+    extract.feed(parser)
+    known = {'way': parser.known_ways, 'relation': parser.known_relations}
+    return [known[element_type][str(element_id)] for element_type, element_id in extract.boundaries]
+
+
+def load_element_store(store, tag_filters, engine=None, chunk_size=1024 * 1024):
+    """Fetch every boundary and what they're made of into an ElementStore
+
+    This makes the one query from get_query_boundaries_and_dependents,
+    and streams the response into the store (after removing whatever
+    was in it) as it arrives, so it's never all in memory.  After
+    that, get_element_from_store can make any of the boundaries with
+    no more queries.  The counts of elements of each type that were
+    loaded are returned:
+
+    >>> tmp_cache = mkdtemp()
+    >>> store = get_element_store(tmp_cache)
+    >>> fixture = os.path.join(dirname(__file__), '..', 'mapit_global', 'tests',
+    ...                        'overpass-responses', 'relation-295353.xml')
+    >>> with patch.dict(config, {'LOCAL_OVERPASS': True}), \\
+    ...         patch.object(sys.modules[__name__], 'get_osm3s_command', return_value=['cat', fixture]):
+    ...     load_element_store(store, [{'boundary': 'administrative', 'admin_level': '8'}])
+    {'node': 5588, 'way': 117, 'relation': 1}
+    >>> len(list(store.boundaries({'admin_level': '8'})))
+    72
+    >>> relation = get_element_from_store(store, 'relation', '295353')
+    >>> relation
+    Relation(id="295353", members=118)
+    >>> with open(fixture) as f:
+    ...     from_overpass = parse_xml_string(f.read(), fetch_missing=False).known_relations['295353']
+    >>> def coordinates(relation):
+    ...     return [w.lon_lat_tuples() for w in relation.way_iterator(False)]
+    >>> coordinates(relation) == coordinates(from_overpass)
+    True
+    >>> get_element_from_store(store, 'relation', '10000000000') is None
+    True
+    >>> store.close()
+    >>> shutil.rmtree(tmp_cache)
+    """
+    store.clear()
+    loader = ElementStoreLoader(store, tag_filters)
+    stream_query(get_query_boundaries_and_dependents(tag_filters), loader, engine, chunk_size)
+    loader.close()
+    return loader.counts
+
+
+def stream_query(query_xml, handler, engine=None, chunk_size=1024 * 1024):
+    """Run an Overpass query, parsing the response with a SAX-style handler as it arrives
+
+    This uses osm3s_query if LOCAL_OVERPASS is set, and the remote
+    Overpass API otherwise, without caching the response.
+    """
+    parser = make_incremental_parser(handler, engine)
+    if config.get('LOCAL_OVERPASS'):
+        with stream_osm3s(query_xml) as fp:
+            while True:
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+    else:
+        download_remote(query_xml, IncrementalParserFile(parser), chunk_size=chunk_size)
+    parser.close()
+
+
+class IncrementalParserFile(object):
+
+    """A file object that parses whatever's written to it"""
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def write(self, data):
+        self.parser.feed(data)
+
+
+def get_element_from_store(store, element_type, element_id, **parser_kwargs):
+    """Make an element from what's in an ElementStore, with no queries at all
+
+    Everything it's made of is parsed into an OSMXMLParser (which is
+    given any keyword arguments) as if it were an Overpass response
+    for the element, so it's just what fetch_osm_element would
+    return.  If the element isn't in the store, None is returned.
+    """
+    parser_kwargs.setdefault('cache_limits', {})
+    parser = OSMXMLParser(fetch_missing=False, callback=lambda element, parser: None, **parser_kwargs)
+    store.feed(element_type, int(element_id), parser)
+    known = {'node': parser.known_nodes, 'way': parser.known_ways, 'relation': parser.known_relations}
+    return known[element_type].get(str(element_id))
+
+
+def get_missing_from_store(store, element_type_ids):
+    """Return the set of (element_type, element_id) that the elements need but that aren't stored"""
+    missing = set()
+    for element_type, element_id in element_type_ids:
+        nodes, ways, relations = store.dependents(element_type, element_id)
+        found = {'node': nodes, 'way': ways, 'relation': relations}
+        if element_id not in found[element_type]:
+            missing.add((element_type, element_id))
+        for members, tags in relations.values():
+            missing.update((t, i) for t, i, role in members if i not in found[t])
+        for refs, tags in ways.values():
+            missing.update(('node', i) for i in refs if i not in nodes)
+    return missing
+
+
+def fetch_missing_into_store(store, element_type_ids, tag_filters=(), batch_size=DEFAULT_OVERPASS_BATCH_SIZE,
+                             engine=None):
+    """Fetch whatever the elements need that isn't in an ElementStore into it
+
+    The queries are made in batches, as with fetch_missing_batched,
+    and repeated for the members of any newly fetched relations.
+    Anything that the Overpass API doesn't have is only asked for
+    once.  The number of elements fetched is returned.
+    """
+    asked = set()
+    fetched = 0
+    while True:
+        missing = sorted(get_missing_from_store(store, element_type_ids) - asked)
+        if not missing:
+            return fetched
+        asked.update(missing)
+        for i in range(0, len(missing), batch_size):
+            loader = ElementStoreLoader(store, tag_filters)
+            stream_query(get_query_elements_and_dependents(missing[i:i + batch_size], geometry=False), loader, engine)
+            loader.close()
+            fetched += sum(loader.counts.values())
+
+
+def refresh_element_cache_from_store(store, element_type_ids, cache_directory=None):
+    """Replace the cached responses for elements with what's in an ElementStore
+
+    Only elements that are already in the element cache are updated,
+    each with the response that fetch_cached would now get for it;
+    see get_element_and_dependents_xml.  Any pre-parsed versions are
+    removed, and any record of their being missing is forgotten.
+    Returns the number of cached responses that were replaced.
+
+    >>> tmp_cache = mkdtemp()
+    >>> cache = get_element_cache(tmp_cache)
+    >>> cache.put('way', '10', '<osm/>')
+    >>> store = get_element_store(tmp_cache)
+    >>> store.put_many([('node', 1, (520000000, 10000000), {}),
+    ...                 ('node', 2, (520000000, 20000000), {}),
+    ...                 ('way', 10, [1, 2], {'boundary': 'administrative'})])
+    >>> refresh_element_cache_from_store(store, [('way', 10), ('node', 1)], tmp_cache)
+    1
+    >>> fetch_osm_element('way', '10', fetch_missing=False, cache_directory=tmp_cache)
+    Way(id="10", nodes=2)
+    >>> store.close()
+    >>> shutil.rmtree(tmp_cache)
+    """
+    cache = get_element_cache(cache_directory)
+    missing = get_missing_element_cache(cache_directory)
+    responses = []
+    for element_type, element_id in element_type_ids:
+        element_id = str(element_id)
+        missing.discard(element_type, element_id)
+        if (element_type, element_id) not in cache:
+            continue
+        element = get_element_from_store(store, element_type, element_id)
+        if element is None:
+            xml = OSMElement.xml_wrapping()
+        else:
+            xml = get_element_and_dependents_xml(element)
+        data = etree.tostring(xml, encoding='utf-8', xml_declaration=True, pretty_print=True)
+        responses.append((element_type, element_id, data.decode('utf-8')))
+    cache.put_many(responses)
+    clear_parsed_file_memo()
+    return len(responses)
+
+
+def apply_osm_changes(store, filenames, tag_filters, cache_directory=None, engine=None):
+    """Bring an ElementStore up to date with OsmChange files, returning the boundaries affected
+
+    The changes in each file are applied in turn with
+    apply_osm_change (which also updates the node-location store, if
+    NODE_LOCATIONS_FILE is set), anything that the changed
+    boundaries now need but that isn't stored is fetched, and the
+    cached responses for the changed elements, and for everything
+    they're part of, are replaced.  This returns a dictionary mapping
+    the (element_type, element_id) of each boundary that was changed,
+    or that is made of anything that was, to its tags, and the set of
+    ways and relations that were changed and are no longer
+    boundaries.
+
+    >>> tmp_cache = mkdtemp()
+    >>> store = get_element_store(tmp_cache)
+    >>> store.put_many([('node', 1, (520000000, 10000000), {}),
+    ...                 ('node', 2, (520000000, 20000000), {}),
+    ...                 ('node', 3, (510000000, 20000000), {}),
+    ...                 ('way', 10, [1, 2, 3, 1], {}),
+    ...                 ('way', 11, [1, 2], {'boundary': 'administrative'}),
+    ...                 ('relation', 20, [('way', 10, 'outer')], {'boundary': 'administrative'})])
+    >>> store.add_boundaries([('relation', 20, {'boundary': 'administrative'}),
+    ...                       ('way', 11, {'boundary': 'administrative'})])
+    >>> osc = os.path.join(tmp_cache, 'change.osc')
+    >>> with open(osc, 'w') as f:
+    ...     _ = f.write('''<?xml version="1.0" encoding="UTF-8"?>
+    ... <osmChange version="0.6">
+    ...   <modify>
+    ...     <node id="3" lat="51.5" lon="2"/>
+    ...     <way id="11"><nd ref="1"/><nd ref="2"/></way>
+    ...   </modify>
+    ... </osmChange>''')
+    >>> apply_osm_changes(store, [osc], [{'boundary': 'administrative'}], tmp_cache)
+    ({('relation', 20): {'boundary': 'administrative'}}, {('way', 11)})
+    >>> store.close()
+    >>> shutil.rmtree(tmp_cache)
+    """
+    changed = set()
+    for filename in filenames:
+        with open(filename, 'rb') as fp:
+            changed |= apply_osm_change(store, fp, tag_filters, get_default_node_locations())
+    users = store.users(changed)
+    affected = store.boundary_tags(users)
+    no_longer_boundaries = set(k for k in changed if k[0] != 'node' and k not in affected)
+    if fetch_missing_into_store(store, affected, tag_filters, engine=engine):
+        users = store.users(users)
+    refresh_element_cache_from_store(store, sorted(users), cache_directory)
+    return affected, no_longer_boundaries
 
 
 class EndpointToWayMap:
@@ -2087,13 +5385,196 @@ class UnclosedBoundariesException(Exception):
         self.detailed_error = detailed_error
 
 
+class EndpointIndex(object):
+
+    """Maps the integer IDs of endpoint nodes to the chains that end there
+
+    This does the same job as EndpointToWayMap for RingAssembler, but
+    the keys are the nodes' IDs as ints (see Way.end_node_ids), which
+    hash and compare much faster than Node objects, and the chains
+    are stored directly as the values.  Each endpoint can only have
+    one chain:
+
+    >>> index = EndpointIndex()
+    >>> chain = [12, 14, 0, 0]
+    >>> index.add(chain)
+    >>> index.get(14) is chain, index.get(13), len(index)
+    (True, None, 2)
+    >>> index.add([14, 15, 1, 1])
+    Traceback (most recent call last):
+      ...
+    Exception: Call to add_way would overwrite existing way(s)
+    >>> index.remove(chain)
+    >>> len(index)
+    0
+    """
+
+    __slots__ = ('slots',)
+
+    def __init__(self):
+        self.slots = {}
+
+    def add(self, chain):
+        """Add a chain, a list that starts with its first and last endpoints"""
+        slots = self.slots
+        if chain[0] in slots or chain[1] in slots:
+            raise Exception("Call to add_way would overwrite existing way(s)")
+        slots[chain[0]] = chain
+        slots[chain[1]] = chain
+
+    def remove(self, chain):
+        del self.slots[chain[0]]
+        del self.slots[chain[1]]
+
+    def get(self, node_id):
+        """Return the chain with an endpoint at node_id, or None"""
+        return self.slots.get(node_id)
+
+    def chains(self):
+        """Return each chain once"""
+        return list(dict((id(chain), chain) for chain in self.slots.values()).values())
+
+    def __len__(self):
+        return len(self.slots)
+
+
+class RingAssembler(object):
+
+    """Joins open ways into closed rings, in time linear in their total length
+
+    Ways are added one at a time, and joined to the chains of ways
+    already added that they share an endpoint with, just as repeated
+    calls to Way.join would join them, but only each chain's
+    endpoints and the links between its ways are kept track of as
+    that's done.  No nodes are copied until rings() walks the links
+    of each closed chain, appending the nodes of each way (forwards
+    or backwards) to the ring once.
+
+    For example, with the sides of a square, added in an order that
+    means they can't all be joined straight away:
+
+    >>> top_left = Node("12", latitude="52", longitude="1")
+    >>> top_right = Node("13", latitude="52", longitude="2")
+    >>> bottom_right = Node("14", latitude="51", longitude="2")
+    >>> bottom_left = Node("15", latitude="51", longitude="1")
+    >>> assembler = RingAssembler()
+    >>> assembler.add(Way("1", nodes=[top_left, top_right]))
+    >>> assembler.add(Way("2", nodes=[bottom_left, bottom_right]))
+    >>> assembler.add(Way("3", nodes=[bottom_right, top_right]))
+    >>> assembler.open_chains()
+    [Way(id="None", nodes=4)]
+    >>> assembler.add(Way("4", nodes=[top_left, bottom_left]))
+    >>> assembler.open_chains()
+    []
+    >>> [ring] = assembler.rings()
+    >>> [n.element_id for n in ring]
+    ['15', '14', '13', '12', '15']
+
+    ArrayWays are joined into an ArrayWay, by extending its arrays:
+
+    >>> assembler = RingAssembler()
+    >>> for nodes in ([top_left, top_right, bottom_right], [bottom_left, bottom_right], [bottom_left, top_left]):
+    ...     assembler.add(ArrayWay(None, nodes=nodes))
+    >>> [ring] = assembler.rings()
+    >>> ring, ring.node_ids
+    (Way(id="None", nodes=5), array('q', [12, 13, 14, 15, 12]))
+    >>> isinstance(ring, ArrayWay)
+    True
+    """
+
+    def __init__(self):
+        # The open ways added so far, each with the IDs of its end
+        # nodes and the index of the way linked to it at each end:
+        self.ways = []
+        self.ends = []
+        self.links = []
+        # The chains, each a list of [first endpoint, last endpoint,
+        # index of the way at the first end, index of the way at the
+        # last end], by their endpoints:
+        self.endpoints = EndpointIndex()
+        # The rings in the order they're completed: each is either a
+        # closed way that was added, or a closed chain:
+        self.closed = []
+
+    def add(self, way):
+        """Add a way, joining it to any chains that it shares an endpoint with"""
+        first, last = way.end_node_ids()
+        if first == last:
+            self.closed.append(way)
+            return
+        index = len(self.ways)
+        self.ways.append(way)
+        self.ends.append((first, last))
+        self.links.append([None, None])
+        joined = [first, last, index, index]
+        endpoints = self.endpoints
+        for chain in [c for c in (endpoints.get(first), endpoints.get(last)) if c is not None]:
+            endpoints.remove(chain)
+            # The same cases, in the same order, as in Way.join:
+            if joined[0] == chain[0]:
+                self.link(joined[2], chain[2], joined[0])
+                joined = [chain[1], joined[1], chain[3], joined[3]]
+            elif joined[0] == chain[1]:
+                self.link(joined[2], chain[3], joined[0])
+                joined = [chain[0], joined[1], chain[2], joined[3]]
+            elif joined[1] == chain[0]:
+                self.link(joined[3], chain[2], joined[1])
+                joined = [joined[0], chain[1], joined[2], chain[3]]
+            else:
+                self.link(joined[3], chain[3], joined[1])
+                joined = [joined[0], chain[0], joined[2], chain[2]]
+            if joined[0] == joined[1]:
+                self.closed.append(joined)
+                return
+        endpoints.add(joined)
+
+    def link(self, a, b, endpoint):
+        """Record that ways a and b are joined at endpoint"""
+        self.links[a][0 if self.ends[a][0] == endpoint else 1] = b
+        self.links[b][0 if self.ends[b][0] == endpoint else 1] = a
+
+    def walk(self, chain):
+        """Return a way with the nodes of a chain, from its first endpoint to its last"""
+        start, end, index, last_index = chain
+        array_ways = all(isinstance(self.ways[i], ArrayWay) for i in (index, last_index))
+        if array_ways:
+            result = ArrayWay.from_arrays(None, array('q'), array('d'), array('d'))
+        else:
+            result = Way(None, [])
+        node = start
+        skip = 0
+        while True:
+            way = self.ways[index]
+            forwards = self.ends[index][0] == node
+            if array_ways:
+                for joined_array, way_array in zip(result.arrays(), ArrayWay.from_way(way).arrays()):
+                    joined_array.extend(way_array[skip:] if forwards else way_array[::-1][skip:])
+            else:
+                nodes = way.nodes
+                result.nodes.extend(nodes[skip:] if forwards else nodes[len(nodes) - 1 - skip::-1])
+            if index == last_index:
+                return result
+            end_number = 1 if forwards else 0
+            node = self.ends[index][end_number]
+            index = self.links[index][end_number]
+            skip = 1
+
+    def open_chains(self):
+        """Return a way for each chain that isn't closed"""
+        return [self.walk(chain) for chain in self.endpoints.chains()]
+
+    def rings(self):
+        """Return the closed rings, in the order they were completed"""
+        return [ring if isinstance(ring, OSMElement) else self.walk(ring) for ring in self.closed]
+
+
 def join_way_soup(ways):
     """Join an iterable collection of ways into closed ways
 
     Two ways can be joined when the share a start or end node.  This
     function will try to join the given ways into a series of closed
-    loops.  If there are any unclosed loops left at the end, they are
-    reported to standard error and an exception is thrown.
+    loops, with a RingAssembler.  If there are any unclosed loops left
+    at the end, an exception is thrown, with a description of them.
 
     For example, if we create some points in a square:
 
@@ -2177,53 +5658,134 @@ def join_way_soup(ways):
     [Way(id="8", nodes=5), Way(id="None", nodes=5)]
     """
 
-    closed_ways = []
-    endpoints_to_ways = EndpointToWayMap()
+    assembler = RingAssembler()
     for way in ways:
         if way.element_content_missing:
             continue
-        if way.closed():
-            closed_ways.append(way)
-            continue
-        # Are there any existing ways we can join this to?
-        to_join_to = endpoints_to_ways.get_from_either_end(way)
-        if to_join_to:
-            joined = way
-            for existing_way in to_join_to:
-                joined = joined.join(existing_way)
-                endpoints_to_ways.remove_way(existing_way)
-                if joined.closed():
-                    closed_ways.append(joined)
-                    break
-            if not joined.closed():
-                endpoints_to_ways.add_way(joined)
-        else:
-            endpoints_to_ways.add_way(way)
-    if endpoints_to_ways.number_of_endpoints():
+        assembler.add(way)
+    open_chains = assembler.open_chains()
+    if open_chains:
+        endpoints_to_ways = EndpointToWayMap()
+        for chain in open_chains:
+            endpoints_to_ways.add_way(chain)
         raise UnclosedBoundariesException(endpoints_to_ways.pretty())
-    return closed_ways
+    return assembler.rings()
 
 
-def fake_requests_get(url, params):
+def fake_requests_get(url, params, **kwargs):
     if url != 'http://overpass-api.de/api/interpreter':
         msg = "Unknown URL {url} - maybe it needs to be faked in tests?"
         raise Exception(msg.format(url=url))
-    m = re.search(r'(?sm)ref="(?P<id>.*?)" type="(?P<type>.*?)"', params['data'])
-    if not m:
+    matches = re.findall(r'(?sm)ref="(?P<id>.*?)" type="(?P<type>.*?)"', params['data'])
+    if not matches:
         print(params['data'])
         msg = "Couldn't find the OSM object type and ID in the request"
         raise Exception(msg)
-    osm_type = m.group('type')
-    osm_id = m.group('id')
-    filename = join(
-        dirname(__file__),
-        '..',
-        'mapit_global',
-        'tests',
-        'overpass-responses',
-        '{type}-{id}.xml'.format(type=osm_type, id=osm_id))
-    with open(filename, 'r') as f:
-        return Mock(text=f.read())
+    responses = []
+    for osm_id, osm_type in matches:
+        filename = join(
+            dirname(__file__),
+            '..',
+            'mapit_global',
+            'tests',
+            'overpass-responses',
+            '{type}-{id}.xml'.format(type=osm_type, id=osm_id))
+        with open(filename, 'r') as f:
+            responses.append(f.read())
+    if 'output="json"' in params['data']:
+        responses = [xml_to_overpass_json(response) for response in responses]
+    if len(responses) == 1:
+        return fake_response(responses[0])
+    # For a query with several IDs, merge the responses for each one:
+    if 'output="json"' in params['data']:
+        documents = [json.loads(response) for response in responses]
+        seen = set()
+        elements = []
+        for document in documents:
+            for e in document['elements']:
+                if (e['type'], e['id']) not in seen:
+                    seen.add((e['type'], e['id']))
+                    elements.append(e)
+        return fake_response(json.dumps({'version': 0.6, 'elements': elements}))
+    merged = etree.fromstring(responses[0].encode('utf-8'))
+    seen = set((e.tag, e.get('id')) for e in merged)
+    for response in responses[1:]:
+        for e in etree.fromstring(response.encode('utf-8')):
+            if e.tag in OSMXMLParser.VALID_TOP_LEVEL_ELEMENTS and (e.tag, e.get('id')) not in seen:
+                seen.add((e.tag, e.get('id')))
+                merged.append(e)
+    return fake_response(etree.tostring(merged, encoding='unicode'))
+
+
+def xml_to_overpass_json(s):
+    """Convert an Overpass XML response into the equivalent JSON response
+
+    This is for faking JSON responses in tests and benchmarks:
+
+    >>> elements = json.loads(xml_to_overpass_json('''<osm version="0.6">
+    ...   <node id="12" lat="52.0000000" lon="0.1000000"><tag k="name" v="Here"/></node>
+    ...   <way id="34"><nd ref="12"/></way>
+    ...   <relation id="56"><member type="way" ref="34" role="outer"/></relation>
+    ... </osm>'''))['elements']
+    >>> elements[0]
+    {'type': 'node', 'id': 12, 'lat': 52.0, 'lon': 0.1, 'tags': {'name': 'Here'}}
+    >>> elements[1]
+    {'type': 'way', 'id': 34, 'nodes': [12]}
+    >>> elements[2]['members']
+    [{'type': 'way', 'ref': 34, 'role': 'outer'}]
+    """
+    root = etree.fromstring(s.encode('utf-8') if isinstance(s, str) else s)
+    elements = []
+    for e in root:
+        if e.tag not in OSMXMLParser.VALID_TOP_LEVEL_ELEMENTS:
+            continue
+        d = {'type': e.tag, 'id': int(e.get('id'))}
+        if e.tag == 'node':
+            d['lat'] = float(e.get('lat'))
+            d['lon'] = float(e.get('lon'))
+        elif e.tag == 'way':
+            d['nodes'] = [int(nd.get('ref')) for nd in e.iter('nd')]
+            if any(nd.get('lat') for nd in e.iter('nd')):
+                d['geometry'] = [{'lat': float(nd.get('lat')), 'lon': float(nd.get('lon'))} for nd in e.iter('nd')]
+        else:
+            d['members'] = [{'type': m.get('type'), 'ref': int(m.get('ref')), 'role': m.get('role')}
+                            for m in e.iter('member')]
+        tags = dict((t.get('k'), t.get('v')) for t in e.iter('tag'))
+        if tags:
+            d['tags'] = tags
+        elements.append(d)
+    return json.dumps({'version': 0.6, 'elements': elements})
+
+
+def xml_to_pbf(s, fp):
+    """Write an Overpass XML response to fp as an .osm.pbf file
+
+    This is for making PBF files for tests and benchmarks from the
+    Overpass responses that the tests use.
+    """
+    root = etree.fromstring(s.encode('utf-8') if isinstance(s, str) else s)
+    elements = []
+    for e in root:
+        if e.tag not in OSMXMLParser.VALID_TOP_LEVEL_ELEMENTS:
+            continue
+        if e.tag == 'node':
+            value = (int(round(float(e.get('lat')) * 1e7)), int(round(float(e.get('lon')) * 1e7)))
+        elif e.tag == 'way':
+            value = [int(nd.get('ref')) for nd in e.iter('nd')]
+        else:
+            value = [(m.get('type'), int(m.get('ref')), m.get('role')) for m in e.iter('member')]
+        tags = dict((t.get('k'), t.get('v')) for t in e.iter('tag'))
+        elements.append((e.tag, int(e.get('id')), value, tags))
+    elements.sort(key=lambda e: (('node', 'way', 'relation').index(e[0]), e[1]))
+    write_pbf(fp, elements)
+
+
+def fake_response(text):
+    """Return a successful requests.Response-like Mock with text as its body"""
+    data = text.encode('utf-8')
+    return Mock(status_code=200,
+                text=text,
+                iter_content=lambda chunk_size=1: (data[i:i + chunk_size] for i in range(0, len(data), chunk_size)))
 
 
 if __name__ == "__main__":
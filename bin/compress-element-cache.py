@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# This script recompresses every cached Overpass response in place,
+# using several processes, e.g. after setting CACHE_COMPRESSION in
+# general.yml:
+#
+#   bin/compress-element-cache.py --compression=zstd
+#
+# Responses that are already compressed that way are left alone, and
+# pre-parsed elements are kept, since the responses are unchanged.
+# A response that's fetched again while its batch is being
+# recompressed is skipped rather than overwritten with the old one,
+# but that's only checked just before the batch is written, so it's
+# best not to run this while the cache is being written to.
+
+from itertools import islice
+from multiprocessing import Pool
+import sys
+
+from boundaries import config, get_default_cache_directory
+from element_cache import COMPRESSIONS, ELEMENT_CACHE_BACKENDS, compress, decompress, detect_compression
+
+
+def recompress(args):
+    """Return (element_type, element_id, data) recompressed, or None if it needn't change
+
+    data is None if the element was removed from the cache before it
+    could be read."""
+    element_type, element_id, data, compression = args
+    if data is None or detect_compression(data) == compression:
+        return None
+    return element_type, element_id, compress(decompress(data), compression)
+
+
+def compress_cache(cache, compression, processes=None, batch_size=1000, verbose=False):
+    """Recompress every element in cache, returning the numbers seen and changed"""
+    seen = changed = 0
+    # The keys are all read first, since with the SQLite backend the
+    # cursor would otherwise be reading the table that's written to:
+    keys = iter(list(cache.keys()))
+    with Pool(processes) as pool:
+        while True:
+            batch = [(element_type, element_id, cache.get_raw(element_type, element_id), compression)
+                     for element_type, element_id in islice(keys, batch_size)]
+            if not batch:
+                break
+            # Skip any response that's been replaced since it was read:
+            recompressed = [t for (element_type, element_id, data, _), t in zip(batch, pool.map(recompress, batch))
+                            if t is not None and cache.get_raw(element_type, element_id) == data]
+            cache.put_many_raw(recompressed, keep_parsed=True)
+            seen += len(batch)
+            changed += len(recompressed)
+            if verbose:
+                print("Recompressed %d of %d elements" % (changed, seen))
+    return seen, changed
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--cache-directory", dest="cache_directory",
+                      default=get_default_cache_directory(),
+                      help="The cache directory (default data/new-cache)")
+    parser.add_option("--backend", dest="backend",
+                      default=config.get('CACHE_BACKEND') or 'directory',
+                      help="The cache backend (default CACHE_BACKEND from general.yml)")
+    parser.add_option("--compression", dest="compression",
+                      default=config.get('CACHE_COMPRESSION') or 'none',
+                      help="'gzip', 'zstd' or 'none' (default CACHE_COMPRESSION from general.yml)")
+    parser.add_option("--processes", dest="processes", type="int",
+                      help="The number of processes to use (default: one per CPU)")
+    parser.add_option("--verbose", dest="verbose",
+                      default=False, action='store_true',
+                      help="Report progress")
+
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.print_help(file=sys.stderr)
+        sys.exit(1)
+
+    if options.backend not in ELEMENT_CACHE_BACKENDS:
+        print("Unknown cache backend '%s'" % (options.backend,), file=sys.stderr)
+        sys.exit(1)
+
+    compression = None if options.compression == 'none' else options.compression
+    if compression not in COMPRESSIONS:
+        print("Unknown compression '%s'" % (options.compression,), file=sys.stderr)
+        sys.exit(1)
+
+    cache = ELEMENT_CACHE_BACKENDS[options.backend](options.cache_directory)
+    seen, changed = compress_cache(cache, compression, options.processes, verbose=options.verbose)
+    print("Recompressed %d of the %d elements in the cache" % (changed, seen))
@@ -0,0 +1,306 @@
+from array import array
+import fcntl
+import mmap
+import os
+import threading
+
+# The following are only used by doctests, hence noqa
+import shutil  # noqa
+from tempfile import mkdtemp  # noqa
+
+ELEMENT_TYPES = ('node', 'way', 'relation')
+ELEMENT_TYPE_CODES = dict((element_type, i) for i, element_type in enumerate(ELEMENT_TYPES))
+
+
+def pack_element(element_type, element_id):
+    """Pack an element's type and ID into one integer
+
+    The ID is shifted left by two bits, and the low bits hold the
+    type, so that the keys of elements of different types never
+    clash:
+
+    >>> pack_element('way', 5)
+    21
+    >>> unpack_element(21)
+    ('way', 5)
+    """
+    return int(element_id) << 2 | ELEMENT_TYPE_CODES[element_type]
+
+
+def unpack_element(key):
+    """Return the (element_type, element_id) that pack_element packed into key"""
+    return ELEMENT_TYPES[key & 3], key >> 2
+
+
+class SortedPairsFile(object):
+
+    """A read-only, memory-mapped file of sorted pairs of 64 bit integers
+
+    The pairs are stored one after the other, in native byte order,
+    sorted by their first and then their second values, so the
+    second values paired with a given first value can be found by a
+    binary search of the file without reading it all into memory.
+    The file is written with write_sorted_pairs:
+
+    >>> tmp_directory = mkdtemp()
+    >>> filename = os.path.join(tmp_directory, 'pairs')
+    >>> write_sorted_pairs(filename, [(1, 10), (3, 30), (3, 31), (7, 70)])
+    >>> pairs = SortedPairsFile(filename)
+    >>> len(pairs), list(pairs.lookup(3)), list(pairs.lookup(4)), list(pairs.lookup(8))
+    (4, [30, 31], [], [])
+    >>> list(pairs)
+    [(1, 10), (3, 30), (3, 31), (7, 70)]
+
+    A file that doesn't exist is treated as an empty one:
+
+    >>> len(SortedPairsFile(os.path.join(tmp_directory, 'nothing')))
+    0
+    >>> pairs.close()
+    >>> shutil.rmtree(tmp_directory)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mm = None
+        self.view = memoryview(array('q'))
+        try:
+            with open(filename, 'rb') as f:
+                if os.fstat(f.fileno()).st_size > 0:
+                    self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.view = memoryview(self.mm).cast('q')
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self.view) // 2
+
+    def __iter__(self):
+        view = self.view
+        for i in range(0, len(view), 2):
+            yield view[i], view[i + 1]
+
+    def find(self, pair):
+        """Return the index of the first pair that isn't less than pair"""
+        view = self.view
+        first, second = pair
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if (view[2 * middle], view[2 * middle + 1]) < (first, second):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def merged(self, removed, added):
+        """Return an array of these pairs, without those in removed and with those in added
+
+        removed and added must be sorted.  Only the pairs around the
+        changes are looked at one by one; the runs of pairs between
+        them are copied a slice at a time:
+
+        >>> tmp_directory = mkdtemp()
+        >>> filename = os.path.join(tmp_directory, 'pairs')
+        >>> write_sorted_pairs(filename, [(1, 10), (3, 30), (3, 31), (7, 70)])
+        >>> pairs = SortedPairsFile(filename)
+        >>> merged = pairs.merged([(3, 30), (5, 50)], [(0, 1), (3, 30), (4, 40), (9, 90)])
+        >>> [tuple(merged[i:i + 2]) for i in range(0, len(merged), 2)]
+        [(0, 1), (1, 10), (3, 30), (3, 31), (4, 40), (7, 70), (9, 90)]
+        >>> pairs.close()
+        >>> shutil.rmtree(tmp_directory)
+        """
+        view = self.view
+        result = array('q')
+        position = 0
+        # Where a pair is both removed and added, it's removed first:
+        changes = sorted([(tuple(pair), 0) for pair in removed] + [(tuple(pair), 1) for pair in added])
+        for pair, is_added in changes:
+            i = max(self.find(pair), position)
+            result.frombytes(view[2 * position:2 * i].cast('B'))
+            position = i
+            if is_added:
+                result.extend(pair)
+            elif i < len(self) and (view[2 * i], view[2 * i + 1]) == pair:
+                position = i + 1
+        result.frombytes(view[2 * position:].cast('B'))
+        return result
+
+    def lookup(self, first):
+        """Yield the second value of every pair whose first value is first"""
+        view = self.view
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if view[2 * middle] < first:
+                low = middle + 1
+            else:
+                high = middle
+        while low < len(self) and view[2 * low] == first:
+            yield view[2 * low + 1]
+            low += 1
+
+    def close(self):
+        self.view.release()
+        self.view = memoryview(array('q'))
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+
+def write_sorted_pairs(filename, pairs, chunk_size=65536):
+    """Write already sorted pairs to filename for SortedPairsFile
+
+    pairs can be an iterable of pairs, or an array of 64 bit integers
+    with the values of each pair one after the other, which is written
+    as it is.
+
+    The pairs are written to a temporary file, which then replaces
+    filename, so readers never see a partly written file.
+    """
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        if isinstance(pairs, array):
+            pairs.tofile(f)
+        else:
+            chunk = array('q')
+            for first, second in pairs:
+                chunk.append(first)
+                chunk.append(second)
+                if len(chunk) >= chunk_size:
+                    chunk.tofile(f)
+                    chunk = array('q')
+            chunk.tofile(f)
+    os.replace(tmp_filename, filename)
+
+
+class DependencyIndex(object):
+
+    """An on-disk index of which boundaries are made of which elements
+
+    For each boundary (a way or a relation) it records the nodes,
+    ways and relations that it's made of, so that when some of those
+    change, the boundaries that need to be regenerated can be found
+    without looking through every boundary.
+
+    This is only for when boundaries are fetched from Overpass one by
+    one, into the element cache (get-boundaries-by-admin-level.py
+    --invalidate).  The ElementStore knows what its elements are part
+    of already, and applying OsmChange files to it (with --changes)
+    is the canonical way to keep boundaries up to date.  The index is kept in two
+    SortedPairsFiles of packed element keys (see pack_element): one
+    of (member, boundary) pairs, for boundaries_using, and one of
+    (boundary, member) pairs, for members_of.
+
+    What's recorded with add() is kept in memory, replacing anything
+    recorded for that boundary before, until flush() merges it into
+    the files.  The files are locked while that's done, so several
+    processes can share an index, and an instance can be shared
+    between threads.
+
+    >>> tmp_directory = mkdtemp()
+    >>> index = DependencyIndex(os.path.join(tmp_directory, 'dependency-index'))
+    >>> index.add('relation', 20, [('way', 10), ('node', 1), ('node', 2)])
+    >>> index.add('way', 11, [('node', 2), ('node', 3)])
+    >>> sorted(index.boundaries_using([('node', 2)]))
+    [('relation', 20), ('way', 11)]
+    >>> index.flush()
+    >>> sorted(index.boundaries_using([('node', 2)]))
+    [('relation', 20), ('way', 11)]
+
+    Another instance sees what was flushed, and adding a boundary
+    again replaces what it was made of:
+
+    >>> other = DependencyIndex(index.filename)
+    >>> sorted(other.members_of('relation', 20))
+    [('node', 1), ('node', 2), ('way', 10)]
+    >>> other.add('relation', 20, [('way', 12)])
+    >>> sorted(other.boundaries_using([('node', 2), ('way', 12)]))
+    [('relation', 20), ('way', 11)]
+    >>> other.flush()
+    >>> index.flush()
+    >>> sorted(index.boundaries_using([('node', 1)])), sorted(index.members_of('relation', 20))
+    ([], [('way', 12)])
+
+    Remove the temporary directory created for these doctests:
+
+    >>> index.close()
+    >>> other.close()
+    >>> shutil.rmtree(tmp_directory)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        # Maps packed boundary keys to arrays of packed member keys:
+        self.pending = {}
+        self.by_member = None
+        self.by_boundary = None
+        self.reopen()
+
+    def reopen(self):
+        """Map the current versions of the index's files"""
+        for pairs in (self.by_member, self.by_boundary):
+            if pairs is not None:
+                pairs.close()
+        self.by_member = SortedPairsFile(self.filename + '.by-member')
+        self.by_boundary = SortedPairsFile(self.filename + '.by-boundary')
+
+    def add(self, boundary_type, boundary_id, member_type_ids):
+        """Record the elements that a boundary is made of, as (element_type, element_id) tuples"""
+        members = array('q', sorted(set(pack_element(t, i) for t, i in member_type_ids)))
+        with self.lock:
+            self.pending[pack_element(boundary_type, boundary_id)] = members
+
+    def boundaries_using(self, element_type_ids):
+        """Return the set of (element_type, element_id) of the boundaries made of any of element_type_ids"""
+        keys = set(pack_element(t, i) for t, i in element_type_ids)
+        found = set()
+        with self.lock:
+            for key in keys:
+                found.update(b for b in self.by_member.lookup(key) if b not in self.pending)
+            for boundary, members in self.pending.items():
+                if any(m in keys for m in members):
+                    found.add(boundary)
+        return set(unpack_element(b) for b in found)
+
+    def members_of(self, boundary_type, boundary_id):
+        """Return the set of (element_type, element_id) that a boundary is made of"""
+        boundary = pack_element(boundary_type, boundary_id)
+        with self.lock:
+            if boundary in self.pending:
+                members = self.pending[boundary]
+            else:
+                members = self.by_boundary.lookup(boundary)
+            return set(unpack_element(m) for m in members)
+
+    def flush(self):
+        """Merge everything recorded with add() into the index's files
+
+        This also picks up any changes that other instances have
+        flushed since the files were opened."""
+        with self.lock:
+            if not self.pending:
+                self.reopen()
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            with open(self.filename + '.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # Another process may have changed the files since
+                # they were opened:
+                self.reopen()
+                # What the boundaries were made of before is found in
+                # the by-boundary file, so only the pairs that change
+                # need finding in either file:
+                removed = [(b, m) for b in sorted(self.pending) for m in self.by_boundary.lookup(b)]
+                added = [(b, m) for b, members in sorted(self.pending.items()) for m in members]
+                by_member = self.by_member.merged(sorted((m, b) for b, m in removed), sorted((m, b) for b, m in added))
+                by_boundary = self.by_boundary.merged(removed, added)
+                write_sorted_pairs(self.filename + '.by-member', by_member)
+                write_sorted_pairs(self.filename + '.by-boundary', by_boundary)
+                self.reopen()
+            self.pending = {}
+
+    def close(self):
+        with self.lock:
+            self.by_member.close()
+            self.by_boundary.close()
@@ -0,0 +1,978 @@
+from contextlib import contextmanager
+import gzip
+from io import BytesIO
+import os
+import re
+import sqlite3
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The following are only used by doctests, hence noqa
+from mock import patch  # noqa
+import shutil  # noqa
+from tempfile import mkdtemp  # noqa
+
+
+# The ways that cached responses can be compressed, as set with the
+# CACHE_COMPRESSION setting; None means that they're stored as they are:
+COMPRESSIONS = (None, 'gzip', 'zstd')
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def detect_compression(data):
+    """Return how some cached bytes are compressed, from their magic number
+
+    >>> detect_compression(b'<?xml version="1.0"?><osm/>') is None
+    True
+    >>> detect_compression(compress('<osm/>', 'gzip'))
+    'gzip'
+    """
+    if data.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if data.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def check_compression(compression):
+    if compression not in COMPRESSIONS:
+        raise Exception("Unknown cache compression '%s'" % (compression,))
+    if compression == 'zstd' and zstandard is None:
+        raise Exception("The zstandard package is needed for zstd cache compression")
+
+
+def compress(data, compression):
+    """Encode a response (str or bytes) as bytes, compressed as requested
+
+    >>> compress('<osm/>', None)
+    b'<osm/>'
+    >>> decompress(compress('<osm/>', 'gzip'))
+    '<osm/>'
+    >>> compress('<osm/>', 'lzma')
+    Traceback (most recent call last):
+      ...
+    Exception: Unknown cache compression 'lzma'
+    """
+    check_compression(compression)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    elif compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress(data):
+    """Decode a cached response, whichever way it was compressed, as a str"""
+    compression = detect_compression(data)
+    if compression == 'gzip':
+        data = gzip.decompress(data)
+    elif compression == 'zstd':
+        check_compression(compression)
+        # Responses compressed by compressing_writer don't say how
+        # big they are, so ZstdDecompressor().decompress can't be used:
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data.decode('utf-8')
+
+
+class UnclosedFile(object):
+
+    """A wrapper for a file object whose close() leaves the file open"""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def write(self, data):
+        return self.fp.write(data)
+
+    def close(self):
+        pass
+
+
+class ClosingGzipFile(gzip.GzipFile):
+
+    """A GzipFile that also closes the file object it was given"""
+
+    def close(self):
+        fileobj = self.fileobj
+        gzip.GzipFile.close(self)
+        if fileobj is not None:
+            fileobj.close()
+
+
+def compressing_writer(fp, compression):
+    """Return a file object that compresses what's written to fp
+
+    Closing it finishes the compressed data, but doesn't close fp:
+
+    >>> for compression in ('gzip', 'zstd', None):
+    ...     fp = BytesIO()
+    ...     writer = compressing_writer(fp, compression)
+    ...     _ = writer.write(b'<osm>')
+    ...     _ = writer.write(b'</osm>')
+    ...     writer.close()
+    ...     print(detect_compression(fp.getvalue()), decompress(fp.getvalue()))
+    gzip <osm></osm>
+    zstd <osm></osm>
+    None <osm></osm>
+    """
+    check_compression(compression)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fp, mode='wb', compresslevel=6)
+    elif compression == 'zstd':
+        return zstandard.ZstdCompressor().stream_writer(fp, closefd=False)
+    return UnclosedFile(fp)
+
+
+class RestartableWriter(object):
+
+    """A compressing_writer for a seekable file that can start again
+
+    restart() throws away everything written so far, so that a
+    download that fails part of the way through can be retried:
+
+    >>> fp = BytesIO()
+    >>> writer = RestartableWriter(fp, 'gzip')
+    >>> _ = writer.write(b'<osm><no')
+    >>> writer.restart()
+    >>> _ = writer.write(b'<osm/>')
+    >>> writer.close()
+    >>> decompress(fp.getvalue())
+    '<osm/>'
+    """
+
+    def __init__(self, fp, compression):
+        self.fp = fp
+        self.compression = compression
+        self.start = fp.tell()
+        self.writer = compressing_writer(fp, compression)
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def restart(self):
+        # The old writer is closed first, so that it can't write the
+        # end of its compressed data over the new writer's later:
+        self.writer.close()
+        self.fp.seek(self.start)
+        self.fp.truncate()
+        self.writer = compressing_writer(self.fp, self.compression)
+
+    def close(self):
+        self.writer.close()
+
+
+def decompressing_reader(fp):
+    """Return a file object that reads fp, decompressing it if necessary
+
+    fp must be seekable, so that its magic number can be checked.
+    Closing the file object that's returned closes fp too:
+
+    >>> decompressing_reader(BytesIO(compress('<osm/>', 'gzip'))).read()
+    b'<osm/>'
+    >>> decompressing_reader(BytesIO(b'<osm/>')).read()
+    b'<osm/>'
+    """
+    magic = fp.read(len(ZSTD_MAGIC))
+    fp.seek(0)
+    compression = detect_compression(magic)
+    if compression == 'gzip':
+        return ClosingGzipFile(fileobj=fp, mode='rb')
+    elif compression == 'zstd':
+        check_compression(compression)
+        return zstandard.ZstdDecompressor().stream_reader(fp, closefd=True)
+    return fp
+
+
+class DirectoryElementCache(object):
+
+    """A cache of Overpass responses for OSM elements, one file each
+
+    The response for an element is kept in a file called
+    <type>/<id % 1000>/<type>-<id>.xml under the cache directory, so
+    that no directory gets too many files in it.  If compression is
+    'gzip' or 'zstd', new responses are compressed that way, but
+    responses are decompressed according to how they were stored,
+    so compressed and uncompressed ones can be mixed.
+
+    >>> tmp_directory = mkdtemp()
+    >>> cache = DirectoryElementCache(tmp_directory)
+    >>> cache.get('way', '1234') is None
+    True
+    >>> cache.put('way', '1234', '<osm/>')
+    >>> cache.get('way', '1234')
+    '<osm/>'
+    >>> ('way', '1234') in cache
+    True
+    >>> cache.location('way', '1234')[len(tmp_directory):]
+    '/way/234/way-1234.xml'
+    >>> cache.put_many([('node', '5', '<osm></osm>'), ('relation', '6', '<osm/>')])
+    >>> sorted(cache.keys())
+    [('node', '5'), ('relation', '6'), ('way', '1234')]
+
+    >>> compressed = DirectoryElementCache(tmp_directory, compression='gzip')
+    >>> compressed.put('way', '1235', '<osm></osm>')
+    >>> detect_compression(compressed.get_raw('way', '1235'))
+    'gzip'
+    >>> compressed.get('way', '1235'), compressed.get('way', '1234')
+    ('<osm></osm>', '<osm/>')
+
+    A pre-parsed version of each element can be kept alongside its
+    response; it's removed when the response is replaced:
+
+    >>> cache.put_parsed('way', '1234', b'parsed')
+    >>> cache.get_parsed('way', '1234')
+    b'parsed'
+    >>> cache.put('way', '1234', '<osm/>')
+    >>> cache.get_parsed('way', '1234') is None
+    True
+
+    Unless it's only the response's compression that has changed:
+
+    >>> cache.put_parsed('way', '1234', b'parsed')
+    >>> cache.put_many_raw([('way', '1234', compress('<osm/>', 'gzip'))], keep_parsed=True)
+    >>> cache.get_parsed('way', '1234')
+    b'parsed'
+
+    A pre-parsed relation includes its members, so it's also removed
+    when any of the ways or relations it includes are replaced:
+
+    >>> cache.put_parsed('relation', '6', b'parsed', dependencies=[('way', '1234'), ('relation', '7')])
+    >>> cache.put_parsed('relation', '8', b'parsed', dependencies=[('relation', '7')])
+    >>> cache.put('way', '1234', '<osm/>')
+    >>> cache.get_parsed('relation', '6'), cache.get_parsed('relation', '8')
+    (None, b'parsed')
+
+    The pre-parsed elements, and which elements each one includes,
+    can be listed, e.g. to copy them to another cache.  The latter
+    can still name pre-parsed elements that have been removed:
+
+    >>> list(cache.parsed_keys())
+    [('relation', '8')]
+    >>> list(cache.parsed_dependencies())
+    [('relation', '7', 'relation', '6'), ('relation', '7', 'relation', '8')]
+
+    Responses that are out of date can be removed, along with their
+    pre-parsed versions:
+
+    >>> cache.put('way', '1238', '<osm/>')
+    >>> cache.put_parsed('way', '1238', b'parsed')
+    >>> cache.remove_many([('way', '1238'), ('way', '1239')])
+    >>> ('way', '1238') in cache, cache.get_parsed('way', '1238')
+    (False, None)
+
+    Large responses can be written and read as files, rather than
+    being held in memory.  Nothing is stored if writing fails:
+
+    >>> with compressed.open_for_writing('way', '1236') as fp:
+    ...     _ = fp.write(b'<osm>')
+    ...     _ = fp.write(b'</osm>')
+    >>> with compressed.open('way', '1236') as fp:
+    ...     fp.read()
+    b'<osm></osm>'
+    >>> with compressed.open_for_writing('way', '1237') as fp:
+    ...     _ = fp.write(b'<osm>')
+    ...     raise Exception("The connection was lost")
+    Traceback (most recent call last):
+      ...
+    Exception: The connection was lost
+    >>> compressed.open('way', '1237') is None
+    True
+    >>> os.listdir(os.path.join(tmp_directory, 'way', '237'))
+    []
+
+    The cache directory is only scanned once, for the first lookup,
+    so that looking up an element afterwards needs no system calls
+    unless it's cached; directories are only made when a file is
+    written to them:
+
+    >>> cache.get('node', '7') is None
+    True
+    >>> os.path.exists(os.path.join(tmp_directory, 'node', '007'))
+    False
+    >>> reopened = DirectoryElementCache(tmp_directory)
+    >>> ('node', '5') in reopened, ('node', '7') in reopened
+    (True, False)
+    >>> sorted(reopened.present)
+    [('node', 5), ('relation', 6), ('way', 1234), ('way', 1235), ('way', 1236)]
+
+    Remove the temporary directory created for these doctests:
+
+    >>> shutil.rmtree(tmp_directory)
+    """
+
+    FILENAME_RE = re.compile(r'^(way|node|relation)-(\d+)\.xml$')
+    MANIFEST_RE = re.compile(r'^(way|node|relation)-(\d+)\.(xml|parsed|dependents)$')
+
+    def __init__(self, directory, compression=None):
+        check_compression(compression)
+        self.directory = directory
+        self.compression = compression
+        self.manifest_lock = threading.Lock()
+        self.present = None
+        self.present_parsed = None
+        self.present_dependents = None
+        self.created_directories = set()
+
+    def filename(self, element_type, element_id):
+        """Return the cache filename for an element"""
+        element_id = int(element_id, 10)
+        return os.path.join(self.directory,
+                            element_type,
+                            "%03d" % (element_id % 1000,),
+                            "%s-%d.xml" % (element_type, element_id))
+
+    def load_manifest(self):
+        """Find which elements are in the cache, scanning it only once
+
+        Until this is called, nothing is known about what's in the
+        cache directory.  Afterwards, self.present,
+        self.present_parsed and self.present_dependents are sets of
+        the (element_type, element_id) keys, with integer IDs, of the
+        responses, pre-parsed elements and lists of the pre-parsed
+        elements that include them that are cached, and they are kept
+        up to date as
+        elements are added, so that looking up an element that isn't
+        cached needs no system calls at all.  Elements that are added
+        to the directory by another process after the scan won't be
+        seen, but they'll just be fetched and cached again.
+        """
+        with self.manifest_lock:
+            if self.present is not None:
+                return
+            found = {'xml': set(), 'parsed': set(), 'dependents': set()}
+            for element_type in ('node', 'way', 'relation'):
+                type_directory = os.path.join(self.directory, element_type)
+                try:
+                    subdirectories = [e.path for e in os.scandir(type_directory) if e.is_dir()]
+                except FileNotFoundError:
+                    continue
+                for subdirectory in subdirectories:
+                    self.created_directories.add(subdirectory)
+                    for entry in os.scandir(subdirectory):
+                        m = self.MANIFEST_RE.search(entry.name)
+                        if m:
+                            found[m.group(3)].add((m.group(1), int(m.group(2))))
+            self.present_dependents = found['dependents']
+            self.present_parsed = found['parsed']
+            self.present = found['xml']
+
+    def is_present(self, element_type, element_id, parsed=False):
+        """Return whether the manifest says that an element is cached"""
+        if self.present is None:
+            self.load_manifest()
+        return (element_type, int(element_id)) in (self.present_parsed if parsed else self.present)
+
+    def forget(self, element_type, element_id, parsed=False):
+        """Remove an element that's no longer on disk from the manifest"""
+        (self.present_parsed if parsed else self.present).discard((element_type, int(element_id)))
+
+    def location(self, element_type, element_id):
+        """Describe where an element is cached, for error messages"""
+        return self.filename(element_type, element_id)
+
+    def get_raw(self, element_type, element_id):
+        """Return the bytes stored for an element, or None"""
+        if not self.is_present(element_type, element_id):
+            return None
+        try:
+            with open(self.filename(element_type, element_id), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            self.forget(element_type, element_id)
+            return None
+
+    def get(self, element_type, element_id):
+        """Return the cached response for an element, or None"""
+        data = self.get_raw(element_type, element_id)
+        if data is None:
+            return None
+        return decompress(data)
+
+    def __contains__(self, element_type_id):
+        return self.is_present(*element_type_id)
+
+    def parsed_filename(self, element_type, element_id):
+        return re.sub(r'\.xml$', '.parsed', self.filename(element_type, element_id))
+
+    def dependents_filename(self, element_type, element_id):
+        return re.sub(r'\.xml$', '.dependents', self.filename(element_type, element_id))
+
+    def make_directory_for(self, filename):
+        directory = os.path.dirname(filename)
+        if directory not in self.created_directories:
+            os.makedirs(directory, exist_ok=True)
+            self.created_directories.add(directory)
+
+    @contextmanager
+    def atomic_writer(self, filename):
+        """Return a file to write to, which is then renamed to filename
+
+        This means that a reader never sees a partly written file.  If
+        there's an exception while it's being written, the temporary
+        file is removed instead.
+        """
+        self.make_directory_for(filename)
+        tmp_filename = "%s.%d-%d.tmp" % (filename, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_filename, "wb") as fp:
+                yield fp
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+
+    def write_atomically(self, filename, data):
+        with self.atomic_writer(filename) as fp:
+            fp.write(data)
+
+    def put_raw(self, element_type, element_id, data, keep_parsed=False):
+        """Store bytes for an element, removing any pre-parsed version
+
+        If keep_parsed is true, the pre-parsed version is kept, which
+        is only right if the response is unchanged apart from how it's
+        compressed."""
+        self.write_atomically(self.filename(element_type, element_id), data)
+        self.added(element_type, element_id, keep_parsed)
+
+    @contextmanager
+    def open_for_writing(self, element_type, element_id):
+        """Return a binary file to write the response for an element to
+
+        What's written is compressed as it's written, and the response
+        is only stored once the file is closed without an exception,
+        so a partly written response never ends up in the cache.  The
+        file is a RestartableWriter, so a failed download can start
+        writing it again.
+        """
+        with self.atomic_writer(self.filename(element_type, element_id)) as raw:
+            writer = RestartableWriter(raw, self.compression)
+            yield writer
+            writer.close()
+        self.added(element_type, element_id)
+
+    def open(self, element_type, element_id):
+        """Return a binary file for reading the response for an element, or None"""
+        if not self.is_present(element_type, element_id):
+            return None
+        try:
+            return decompressing_reader(open(self.filename(element_type, element_id), 'rb'))
+        except FileNotFoundError:
+            self.forget(element_type, element_id)
+            return None
+
+    def added(self, element_type, element_id, keep_parsed=False):
+        """Note that a response has been stored, removing any pre-parsed version"""
+        if self.present is None:
+            self.load_manifest()
+        self.present.add((element_type, int(element_id)))
+        if not keep_parsed:
+            self.remove_parsed(element_type, element_id)
+
+    def remove_parsed(self, element_type, element_id):
+        """Remove the pre-parsed version of an element and of everything that includes it"""
+        if self.is_present(element_type, element_id, parsed=True):
+            self.forget(element_type, element_id, parsed=True)
+            try:
+                os.remove(self.parsed_filename(element_type, element_id))
+            except FileNotFoundError:
+                pass
+        key = (element_type, int(element_id))
+        if key in self.present_dependents:
+            self.present_dependents.discard(key)
+            filename = self.dependents_filename(element_type, element_id)
+            try:
+                with open(filename) as f:
+                    dependents = [line.split() for line in f]
+                os.remove(filename)
+            except FileNotFoundError:
+                dependents = []
+            for dependent_type, dependent_id in dependents:
+                self.remove_parsed(dependent_type, dependent_id)
+
+    def get_parsed(self, element_type, element_id):
+        """Return the pre-parsed version of an element, or None"""
+        if not self.is_present(element_type, element_id, parsed=True):
+            return None
+        try:
+            with open(self.parsed_filename(element_type, element_id), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            self.forget(element_type, element_id, parsed=True)
+            return None
+
+    def put_parsed(self, element_type, element_id, data, dependencies=()):
+        """Store a pre-parsed version of an element
+
+        dependencies are the (element_type, element_id) of the other
+        ways and relations that are included in it, so that it can be
+        removed if any of them are replaced or removed."""
+        if self.present is None:
+            self.load_manifest()
+        line = '%s %s\n' % (element_type, element_id)
+        for dependency_type, dependency_id in dependencies:
+            filename = self.dependents_filename(dependency_type, dependency_id)
+            self.make_directory_for(filename)
+            with open(filename, 'a') as f:
+                f.write(line)
+            self.present_dependents.add((dependency_type, int(dependency_id)))
+        self.write_atomically(self.parsed_filename(element_type, element_id), data)
+        self.present_parsed.add((element_type, int(element_id)))
+
+    def put(self, element_type, element_id, data):
+        """Cache the response for an element"""
+        self.put_raw(element_type, element_id, compress(data, self.compression))
+
+    def put_many_raw(self, element_type_id_data_tuples, keep_parsed=False):
+        for element_type, element_id, data in element_type_id_data_tuples:
+            self.put_raw(element_type, element_id, data, keep_parsed)
+
+    def put_many(self, element_type_id_data_tuples):
+        for element_type, element_id, data in element_type_id_data_tuples:
+            self.put(element_type, element_id, data)
+
+    def remove_many(self, element_type_id_tuples):
+        """Remove the responses, and any pre-parsed versions, for several elements"""
+        if self.present is None:
+            self.load_manifest()
+        for element_type, element_id in element_type_id_tuples:
+            if self.is_present(element_type, element_id):
+                self.forget(element_type, element_id)
+                try:
+                    os.remove(self.filename(element_type, element_id))
+                except FileNotFoundError:
+                    pass
+            self.remove_parsed(element_type, element_id)
+
+    def keys(self):
+        """Yield an (element_type, element_id) tuple for every cached element"""
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                m = self.FILENAME_RE.search(filename)
+                if m:
+                    yield m.groups()
+
+    def parsed_keys(self):
+        """Yield an (element_type, element_id) tuple for every pre-parsed element"""
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                m = self.MANIFEST_RE.search(filename)
+                if m and m.group(3) == 'parsed':
+                    yield m.group(1), m.group(2)
+
+    def parsed_dependencies(self):
+        """Yield (dependency_type, dependency_id, element_type, element_id) for
+        every element that's included in a pre-parsed element, which
+        may include pre-parsed elements that have since been removed"""
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                m = self.MANIFEST_RE.search(filename)
+                if m and m.group(3) == 'dependents':
+                    with open(os.path.join(dirpath, filename)) as f:
+                        for line in f:
+                            element_type, element_id = line.split()
+                            yield (m.group(1), m.group(2), element_type, element_id)
+
+    def close(self):
+        pass
+
+
+class SQLiteElementCache(object):
+
+    """A cache of Overpass responses for OSM elements in one SQLite file
+
+    This stores the same data as DirectoryElementCache, but keyed by
+    element type and ID in a single table, which avoids having
+    millions of small files.  The database is in WAL mode, so that
+    readers in other processes don't block the writer.  Each thread
+    gets its own connection to the database.  Responses can be
+    compressed, as with DirectoryElementCache.
+
+    >>> tmp_directory = mkdtemp()
+    >>> cache = SQLiteElementCache(os.path.join(tmp_directory, 'elements.sqlite3'))
+    >>> cache.get('way', '1234') is None
+    True
+    >>> cache.put('way', '1234', '<osm/>')
+    >>> cache.get('way', '1234')
+    '<osm/>'
+    >>> ('way', '1234') in cache
+    True
+    >>> cache.location('way', '1234')[len(tmp_directory):]
+    '/elements.sqlite3#way-1234'
+    >>> cache.put_many([('node', '5', '<osm></osm>'), ('relation', '6', '<osm/>')])
+    >>> sorted(cache.keys())
+    [('node', '5'), ('relation', '6'), ('way', '1234')]
+    >>> cache.execute('PRAGMA journal_mode').fetchone()
+    ('wal',)
+
+    >>> compressed = SQLiteElementCache(cache.filename, compression='gzip')
+    >>> compressed.put('way', '1235', '<osm></osm>')
+    >>> detect_compression(compressed.get_raw('way', '1235'))
+    'gzip'
+    >>> compressed.get('way', '1235'), compressed.get('way', '1234')
+    ('<osm></osm>', '<osm/>')
+    >>> compressed.close()
+
+    >>> cache.put_parsed('way', '1234', b'parsed')
+    >>> cache.get_parsed('way', '1234')
+    b'parsed'
+    >>> cache.put('way', '1234', '<osm/>')
+    >>> cache.get_parsed('way', '1234') is None
+    True
+    >>> cache.put_parsed('way', '1234', b'parsed')
+    >>> cache.put_many_raw([('way', '1234', compress('<osm/>', 'gzip'))], keep_parsed=True)
+    >>> cache.get_parsed('way', '1234')
+    b'parsed'
+    >>> cache.put_parsed('relation', '6', b'parsed', dependencies=[('way', '1234'), ('relation', '7')])
+    >>> cache.put_parsed('relation', '8', b'parsed', dependencies=[('relation', '7')])
+    >>> cache.put('way', '1234', '<osm/>')
+    >>> cache.get_parsed('relation', '6'), cache.get_parsed('relation', '8')
+    (None, b'parsed')
+    >>> list(cache.parsed_keys()), list(cache.parsed_dependencies())
+    ([('relation', '8')], [('relation', '7', 'relation', '6'), ('relation', '7', 'relation', '8')])
+    >>> cache.put_parsed('way', '1234', b'parsed')
+    >>> cache.remove_many([('way', '1234')])
+    >>> ('way', '1234') in cache, cache.get_parsed('way', '1234')
+    (False, None)
+
+    >>> with cache.open_for_writing('way', '1236') as fp:
+    ...     _ = fp.write(b'<osm></osm>')
+    >>> with cache.open('way', '1236') as fp:
+    ...     fp.read()
+    b'<osm></osm>'
+
+    Remove the temporary directory created for these doctests:
+
+    >>> cache.close()
+    >>> shutil.rmtree(tmp_directory)
+    """
+
+    def __init__(self, filename, compression=None):
+        check_compression(compression)
+        self.filename = filename
+        self.compression = compression
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with self.connection() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS elements (
+                                      element_type TEXT NOT NULL,
+                                      element_id INTEGER NOT NULL,
+                                      data BLOB NOT NULL,
+                                      PRIMARY KEY (element_type, element_id)
+                                  ) WITHOUT ROWID""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS parsed_elements (
+                                      element_type TEXT NOT NULL,
+                                      element_id INTEGER NOT NULL,
+                                      data BLOB NOT NULL,
+                                      PRIMARY KEY (element_type, element_id)
+                                  ) WITHOUT ROWID""")
+            # Which pre-parsed elements include other elements:
+            connection.execute("""CREATE TABLE IF NOT EXISTS parsed_dependencies (
+                                      dependency_type TEXT NOT NULL,
+                                      dependency_id INTEGER NOT NULL,
+                                      element_type TEXT NOT NULL,
+                                      element_id INTEGER NOT NULL,
+                                      PRIMARY KEY (dependency_type, dependency_id, element_type, element_id)
+                                  ) WITHOUT ROWID""")
+
+    def connection(self):
+        """Return this thread's connection to the database"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def execute(self, sql, parameters=()):
+        return self.connection().execute(sql, parameters)
+
+    def location(self, element_type, element_id):
+        """Describe where an element is cached, for error messages"""
+        return "%s#%s-%s" % (self.filename, element_type, element_id)
+
+    def get_raw(self, element_type, element_id):
+        """Return the bytes stored for an element, or None"""
+        row = self.execute('SELECT data FROM elements WHERE element_type = ? AND element_id = ?',
+                           (element_type, int(element_id))).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get(self, element_type, element_id):
+        """Return the cached response for an element, or None"""
+        data = self.get_raw(element_type, element_id)
+        if data is None:
+            return None
+        return decompress(data)
+
+    def __contains__(self, element_type_id):
+        element_type, element_id = element_type_id
+        return self.execute('SELECT 1 FROM elements WHERE element_type = ? AND element_id = ?',
+                            (element_type, int(element_id))).fetchone() is not None
+
+    def put_raw(self, element_type, element_id, data, keep_parsed=False):
+        """Store bytes for an element"""
+        self.put_many_raw([(element_type, element_id, data)], keep_parsed)
+
+    def put(self, element_type, element_id, data):
+        """Cache the response for an element"""
+        self.put_raw(element_type, element_id, compress(data, self.compression))
+
+    @contextmanager
+    def open_for_writing(self, element_type, element_id):
+        """Return a binary file to write the response for an element to
+
+        As with DirectoryElementCache, the response is only stored if
+        the file is closed without an exception, but since it's
+        stored as a single value, it's compressed in memory first.
+        """
+        raw = BytesIO()
+        writer = RestartableWriter(raw, self.compression)
+        yield writer
+        writer.close()
+        self.put_raw(element_type, element_id, raw.getvalue())
+
+    def open(self, element_type, element_id):
+        """Return a binary file for reading the response for an element, or None"""
+        data = self.get_raw(element_type, element_id)
+        if data is None:
+            return None
+        return decompressing_reader(BytesIO(data))
+
+    def put_many_raw(self, element_type_id_data_tuples, keep_parsed=False):
+        """Store bytes for several elements in a single transaction
+
+        Any pre-parsed versions of those elements are removed, unless
+        keep_parsed is true, as for DirectoryElementCache.put_raw.
+        """
+        rows = [(element_type, int(element_id), data)
+                for element_type, element_id, data in element_type_id_data_tuples]
+        with self.connection() as connection:
+            connection.executemany('INSERT OR REPLACE INTO elements VALUES (?, ?, ?)', rows)
+            if not keep_parsed:
+                self.remove_parsed(connection, [row[:2] for row in rows])
+
+    def remove_parsed(self, connection, keys):
+        """Remove the pre-parsed versions of elements and of everything that includes them"""
+        keys = set(keys)
+        while keys:
+            connection.executemany('DELETE FROM parsed_elements WHERE element_type = ? AND element_id = ?', keys)
+            dependents = set()
+            for key in keys:
+                dependents.update(connection.execute(
+                    """SELECT element_type, element_id FROM parsed_dependencies
+                       WHERE dependency_type = ? AND dependency_id = ?""", key))
+            connection.executemany(
+                'DELETE FROM parsed_dependencies WHERE dependency_type = ? AND dependency_id = ?', keys)
+            keys = dependents
+
+    def get_parsed(self, element_type, element_id):
+        """Return the pre-parsed version of an element, or None"""
+        row = self.execute('SELECT data FROM parsed_elements WHERE element_type = ? AND element_id = ?',
+                           (element_type, int(element_id))).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put_parsed(self, element_type, element_id, data, dependencies=()):
+        """Store a pre-parsed version of an element, which includes the dependencies
+
+        As for DirectoryElementCache.put_parsed, it's removed if any
+        of the dependencies are replaced or removed."""
+        with self.connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO parsed_elements VALUES (?, ?, ?)',
+                               (element_type, int(element_id), data))
+            connection.executemany('INSERT OR IGNORE INTO parsed_dependencies VALUES (?, ?, ?, ?)',
+                                   [(dependency_type, int(dependency_id), element_type, int(element_id))
+                                    for dependency_type, dependency_id in dependencies])
+
+    def put_many(self, element_type_id_data_tuples):
+        """Cache several responses in a single transaction"""
+        self.put_many_raw((element_type, element_id, compress(data, self.compression))
+                          for element_type, element_id, data in element_type_id_data_tuples)
+
+    def remove_many(self, element_type_id_tuples):
+        """Remove the responses, and any pre-parsed versions, for several elements in a single transaction"""
+        rows = [(element_type, int(element_id)) for element_type, element_id in element_type_id_tuples]
+        with self.connection() as connection:
+            connection.executemany('DELETE FROM elements WHERE element_type = ? AND element_id = ?', rows)
+            self.remove_parsed(connection, rows)
+
+    def keys(self):
+        """Yield an (element_type, element_id) tuple for every cached element"""
+        for element_type, element_id in self.execute(
+                'SELECT element_type, element_id FROM elements ORDER BY element_type, element_id'):
+            yield element_type, str(element_id)
+
+    def parsed_keys(self):
+        """Yield an (element_type, element_id) tuple for every pre-parsed element"""
+        for element_type, element_id in self.execute(
+                'SELECT element_type, element_id FROM parsed_elements ORDER BY element_type, element_id'):
+            yield element_type, str(element_id)
+
+    def parsed_dependencies(self):
+        """Yield (dependency_type, dependency_id, element_type, element_id) for
+        every element that's included in a pre-parsed element, which
+        may include pre-parsed elements that have since been removed"""
+        for dependency_type, dependency_id, element_type, element_id in self.execute(
+                'SELECT * FROM parsed_dependencies ORDER BY dependency_type, dependency_id'):
+            yield dependency_type, str(dependency_id), element_type, str(element_id)
+
+    def close(self):
+        """Close this thread's connection to the database"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+class MissingElementCache(object):
+
+    """A record of the elements that a query found nothing for
+
+    When a query for an element returns nothing, because the element
+    has been deleted or never existed, that's recorded in an SQLite
+    database, so that it needn't be queried for again until ttl
+    seconds have passed, even in a later run.  If ttl is 0, nothing is
+    recorded.  The records that are still current are loaded once, so
+    checking an element needs no queries.  hits counts the times that
+    a query was avoided.
+
+    >>> tmp_directory = mkdtemp()
+    >>> filename = os.path.join(tmp_directory, 'missing-elements.sqlite3')
+    >>> missing = MissingElementCache(filename, ttl=3600)
+    >>> missing.is_missing('node', '1000000000000')
+    False
+    >>> missing.add('node', '1000000000000')
+    >>> missing.is_missing('node', '1000000000000')
+    True
+    >>> MissingElementCache(filename, ttl=3600).is_missing('node', '1000000000000')
+    True
+    >>> missing.statistics()
+    {'size': 1, 'recorded': 1, 'hits': 1}
+
+    Once the record is older than the TTL, the element is queried
+    for again:
+
+    >>> with patch.object(time, 'time', return_value=time.time() + 3601):
+    ...     MissingElementCache(filename, ttl=3600).is_missing('node', '1000000000000')
+    False
+
+    Recording that an element has been found removes any record of
+    it being missing:
+
+    >>> missing.discard('node', '1000000000000')
+    >>> MissingElementCache(filename, ttl=3600).is_missing('node', '1000000000000')
+    False
+
+    Remove the temporary directory created for these doctests:
+
+    >>> missing.close()
+    >>> shutil.rmtree(tmp_directory)
+    """
+
+    def __init__(self, filename, ttl):
+        self.filename = filename
+        self.ttl = ttl
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.checked = None
+        self.recorded = 0
+        self.hits = 0
+
+    def connection(self):
+        """Return this thread's connection to the database"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            connection = sqlite3.connect(self.filename, timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute("""CREATE TABLE IF NOT EXISTS missing_elements (
+                                      element_type TEXT NOT NULL,
+                                      element_id INTEGER NOT NULL,
+                                      checked REAL NOT NULL,
+                                      PRIMARY KEY (element_type, element_id)
+                                  ) WITHOUT ROWID""")
+            self.local.connection = connection
+        return connection
+
+    def load(self):
+        """Load the records that are still current, if that hasn't been done"""
+        with self.lock:
+            if self.checked is not None:
+                return
+            rows = self.connection().execute(
+                'SELECT element_type, element_id, checked FROM missing_elements WHERE checked > ?',
+                (time.time() - self.ttl,))
+            self.checked = dict(((element_type, element_id), checked)
+                                for element_type, element_id, checked in rows)
+
+    def is_missing(self, element_type, element_id):
+        """Return whether element is known to be missing, counting a hit if so"""
+        if self.ttl <= 0:
+            return False
+        if self.checked is None:
+            self.load()
+        checked = self.checked.get((element_type, int(element_id)))
+        if checked is None or checked <= time.time() - self.ttl:
+            return False
+        self.hits += 1
+        return True
+
+    def add(self, element_type, element_id):
+        """Record that a query for an element found nothing"""
+        if self.ttl <= 0:
+            return
+        if self.checked is None:
+            self.load()
+        key = (element_type, int(element_id))
+        now = time.time()
+        with self.connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO missing_elements VALUES (?, ?, ?)', key + (now,))
+        self.checked[key] = now
+        self.recorded += 1
+
+    def discard(self, element_type, element_id):
+        """Forget any record of an element being missing"""
+        if self.ttl <= 0:
+            return
+        if self.checked is None:
+            self.load()
+        key = (element_type, int(element_id))
+        if self.checked.pop(key, None) is not None:
+            with self.connection() as connection:
+                connection.execute('DELETE FROM missing_elements WHERE element_type = ? AND element_id = ?', key)
+
+    def statistics(self):
+        return {'size': len(self.checked or ()),
+                'recorded': self.recorded,
+                'hits': self.hits}
+
+    def close(self):
+        """Close this thread's connection to the database"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+# The backends that can be chosen with the CACHE_BACKEND setting:
+ELEMENT_CACHE_BACKENDS = {
+    'directory': lambda directory, compression=None: DirectoryElementCache(directory, compression),
+    'sqlite': lambda directory, compression=None: SQLiteElementCache(os.path.join(directory, 'elements.sqlite3'),
+                                                                     compression),
+}
@@ -0,0 +1,649 @@
+from array import array
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import xml.sax
+from xml.sax.handler import ContentHandler
+
+from osm_pbf import feed_elements
+
+# The following are only used by doctests, hence noqa
+import shutil  # noqa
+from tempfile import mkdtemp  # noqa
+
+
+class ElementStore(object):
+
+    """An indexed store of OSM elements on disk, in an SQLite database
+
+    Nodes, ways and relations are kept in tables indexed by their IDs,
+    with the same (element_type, element_id, value, tags) tuples that
+    osm_pbf.decode_block returns: a node's value is its (lat, lon) in
+    units of 10^-7 degrees, a way's is a list of node IDs, and a
+    relation's is a list of (member type, member ID, role) tuples.
+    The boundaries among them are listed separately, so that they can
+    be found without looking through everything else.  Relation
+    members with one of ignored_roles (e.g. subareas) aren't counted
+    as part of what a relation is made of, as with PBFExtract.
+
+    >>> tmp_directory = mkdtemp()
+    >>> store = ElementStore(os.path.join(tmp_directory, 'element-store.sqlite3'), ignored_roles=('subarea',))
+    >>> store.put_many([('node', 1, (520000000, 10000000), {}),
+    ...                 ('node', 2, (520000000, 20000000), {}),
+    ...                 ('node', 3, (510000000, 20000000), {'place': 'town'}),
+    ...                 ('way', 10, [1, 2, 3, 1], {}),
+    ...                 ('relation', 20, [('way', 10, 'outer'), ('relation', 21, 'outer')],
+    ...                  {'boundary': 'administrative', 'admin_level': '2'}),
+    ...                 ('relation', 21, [('node', 3, 'admin_centre')], {})])
+    >>> store.add_boundaries([('relation', 20, {'boundary': 'administrative', 'admin_level': '2'})])
+    >>> store.get('way', 10)
+    ([1, 2, 3, 1], {})
+    >>> store.get('node', 4) is None
+    True
+    >>> list(store.boundaries({'admin_level': '2'})), list(store.boundaries({'admin_level': '4'}))
+    ([('relation', 20, {'boundary': 'administrative', 'admin_level': '2'})], [])
+    >>> store.boundary_tags([('relation', 20), ('relation', 21), ('way', 10)])
+    {('relation', 20): {'boundary': 'administrative', 'admin_level': '2'}}
+
+    Everything that a relation is made of can be found at once, as
+    dictionaries of nodes, ways and relations:
+
+    >>> nodes, ways, relations = store.dependents('relation', 20)
+    >>> sorted(nodes), sorted(ways), sorted(relations)
+    ([1, 2, 3], [10], [20, 21])
+
+    Except for members with ignored roles:
+
+    >>> store.put_many([('relation', 22, [('relation', 20, 'subarea'), ('node', 1, 'admin_centre')], {})])
+    >>> nodes, ways, relations = store.dependents('relation', 22)
+    >>> sorted(nodes), sorted(ways), sorted(relations)
+    ([1], [], [22])
+    >>> store.delete_many([('relation', 22)])
+
+    And so can everything that an element is part of:
+
+    >>> sorted(store.users([('node', 3)]))
+    [('node', 3), ('relation', 20), ('relation', 21), ('way', 10)]
+
+    Replacing or deleting elements updates that:
+
+    >>> store.put_many([('way', 10, [1, 2, 1], {})])
+    >>> sorted(store.users([('node', 3)]))
+    [('node', 3), ('relation', 20), ('relation', 21)]
+    >>> store.delete_many([('relation', 21)])
+    >>> sorted(store.users([('node', 3)])), store.present('relation', [20, 21])
+    ([('node', 3)], {20})
+
+    Remove the temporary directory created for these doctests:
+
+    >>> store.close()
+    >>> shutil.rmtree(tmp_directory)
+    """
+
+    # The most IDs to look up with one query:
+    LOOKUP_BATCH_SIZE = 500
+
+    def __init__(self, filename, ignored_roles=()):
+        self.filename = filename
+        self.ignored_roles = set(ignored_roles)
+        self.local = threading.local()
+
+    def connection(self):
+        """Return this thread's connection to the database"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            connection = sqlite3.connect(self.filename, timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute("""CREATE TABLE IF NOT EXISTS nodes (
+                                      id INTEGER PRIMARY KEY,
+                                      lat INTEGER NOT NULL,
+                                      lon INTEGER NOT NULL,
+                                      tags TEXT
+                                  )""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS ways (
+                                      id INTEGER PRIMARY KEY,
+                                      nodes BLOB NOT NULL,
+                                      tags TEXT
+                                  )""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS relations (
+                                      id INTEGER PRIMARY KEY,
+                                      members TEXT NOT NULL,
+                                      tags TEXT
+                                  )""")
+            # The reverse of the ways' nodes and the relations'
+            # members, for finding what an element is part of:
+            connection.execute("""CREATE TABLE IF NOT EXISTS way_nodes (
+                                      node_id INTEGER NOT NULL,
+                                      way_id INTEGER NOT NULL,
+                                      PRIMARY KEY (node_id, way_id)
+                                  ) WITHOUT ROWID""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS relation_members (
+                                      member_type TEXT NOT NULL,
+                                      member_id INTEGER NOT NULL,
+                                      relation_id INTEGER NOT NULL,
+                                      PRIMARY KEY (member_type, member_id, relation_id)
+                                  ) WITHOUT ROWID""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS boundaries (
+                                      element_type TEXT NOT NULL,
+                                      element_id INTEGER NOT NULL,
+                                      tags TEXT NOT NULL,
+                                      PRIMARY KEY (element_type, element_id)
+                                  ) WITHOUT ROWID""")
+            self.local.connection = connection
+        return connection
+
+    def put_many(self, elements):
+        """Add or replace elements, given as (element_type, element_id, value, tags) tuples"""
+        rows = {'node': [], 'way': [], 'relation': []}
+        way_nodes = []
+        relation_members = []
+        for element_type, element_id, value, tags in elements:
+            encoded_tags = json.dumps(tags) if tags else None
+            if element_type == 'node':
+                rows['node'].append((element_id, value[0], value[1], encoded_tags))
+            elif element_type == 'way':
+                rows['way'].append((element_id, array('q', value).tobytes(), encoded_tags))
+                way_nodes.extend((node_id, element_id) for node_id in set(value))
+            else:
+                rows['relation'].append((element_id, json.dumps(value), encoded_tags))
+                relation_members.extend(set((t, member_id, element_id) for t, member_id, role in value))
+        replaced_ways = self.get_many('way', [row[0] for row in rows['way']])
+        replaced_relations = self.get_many('relation', [row[0] for row in rows['relation']])
+        with self.connection() as connection:
+            self.remove_references(connection, replaced_ways, replaced_relations)
+            connection.executemany('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?)', rows['node'])
+            connection.executemany('INSERT OR REPLACE INTO ways VALUES (?, ?, ?)', rows['way'])
+            connection.executemany('INSERT OR REPLACE INTO relations VALUES (?, ?, ?)', rows['relation'])
+            connection.executemany('INSERT OR IGNORE INTO way_nodes VALUES (?, ?)', way_nodes)
+            connection.executemany('INSERT OR IGNORE INTO relation_members VALUES (?, ?, ?)', relation_members)
+
+    def remove_references(self, connection, ways, relations):
+        """Remove the reverse references for the old versions of ways and relations"""
+        connection.executemany('DELETE FROM way_nodes WHERE node_id = ? AND way_id = ?',
+                               [(node_id, way_id) for way_id, (refs, tags) in ways.items() for node_id in set(refs)])
+        connection.executemany('DELETE FROM relation_members WHERE member_type = ? AND member_id = ? '
+                               'AND relation_id = ?',
+                               [(t, member_id, relation_id)
+                                for relation_id, (members, tags) in relations.items()
+                                for t, member_id in set((t, member_id) for t, member_id, role in members)])
+
+    def delete_many(self, element_type_ids):
+        """Remove elements, given as (element_type, element_id) tuples, if they're stored"""
+        ids = {'node': [], 'way': [], 'relation': []}
+        for element_type, element_id in element_type_ids:
+            ids[element_type].append(element_id)
+        ways = self.get_many('way', ids['way'])
+        relations = self.get_many('relation', ids['relation'])
+        with self.connection() as connection:
+            self.remove_references(connection, ways, relations)
+            for element_type, table in (('node', 'nodes'), ('way', 'ways'), ('relation', 'relations')):
+                connection.executemany('DELETE FROM %s WHERE id = ?' % (table,),
+                                       [(i,) for i in ids[element_type]])
+            connection.executemany('DELETE FROM boundaries WHERE element_type = ? AND element_id = ?',
+                                   [(t, i) for t, i in element_type_ids if t != 'node'])
+
+    def remove_boundaries(self, element_type_ids):
+        """Record that elements, given as (element_type, element_id) tuples, aren't boundaries"""
+        with self.connection() as connection:
+            connection.executemany('DELETE FROM boundaries WHERE element_type = ? AND element_id = ?',
+                                   list(element_type_ids))
+
+    def add_boundaries(self, boundaries):
+        """Record that elements are boundaries, given (element_type, element_id, tags) tuples"""
+        with self.connection() as connection:
+            connection.executemany('INSERT OR REPLACE INTO boundaries VALUES (?, ?, ?)',
+                                   ((t, i, json.dumps(tags)) for t, i, tags in boundaries))
+
+    def decode_row(self, element_type, row):
+        if element_type == 'node':
+            lat, lon, tags = row
+            value = (lat, lon)
+        elif element_type == 'way':
+            nodes, tags = row
+            value = array('q', nodes).tolist()
+        else:
+            members, tags = row
+            value = [tuple(m) for m in json.loads(members)]
+        return value, (json.loads(tags) if tags else {})
+
+    def get_many(self, element_type, element_ids):
+        """Return a dictionary mapping each of element_ids that's stored to its (value, tags)"""
+        table, columns = {'node': ('nodes', 'lat, lon, tags'),
+                          'way': ('ways', 'nodes, tags'),
+                          'relation': ('relations', 'members, tags')}[element_type]
+        return dict((row[0], self.decode_row(element_type, row[1:]))
+                    for row in self.select_in('SELECT id, %s FROM %s WHERE id IN (%%s)' % (columns, table),
+                                              element_ids))
+
+    def get(self, element_type, element_id):
+        """Return the (value, tags) of an element, or None if it isn't stored"""
+        return self.get_many(element_type, [element_id]).get(element_id)
+
+    def select_in(self, sql, ids):
+        """Yield the rows from a query with an IN (%s) clause for each batch of ids"""
+        ids = list(ids)
+        connection = self.connection()
+        for i in range(0, len(ids), self.LOOKUP_BATCH_SIZE):
+            batch = ids[i:i + self.LOOKUP_BATCH_SIZE]
+            for row in connection.execute(sql % (', '.join('?' * len(batch)),), batch):
+                yield row
+
+    def present(self, element_type, element_ids):
+        """Return the set of element_ids that are stored"""
+        table = {'node': 'nodes', 'way': 'ways', 'relation': 'relations'}[element_type]
+        return set(row[0] for row in self.select_in('SELECT id FROM %s WHERE id IN (%%s)' % (table,), element_ids))
+
+    def users(self, element_type_ids):
+        """Return every element that's made of any of element_type_ids
+
+        That's all the ways and relations that they're part of,
+        directly or through other elements, as (element_type,
+        element_id) tuples, including element_type_ids themselves.
+        """
+        found = set(element_type_ids)
+        to_check = set(found)
+        while to_check:
+            parents = set()
+            node_ids = [i for t, i in to_check if t == 'node']
+            parents.update(('way', row[0]) for row in self.select_in(
+                'SELECT way_id FROM way_nodes WHERE node_id IN (%s)', node_ids))
+            for member_type in ('node', 'way', 'relation'):
+                member_ids = [i for t, i in to_check if t == member_type]
+                parents.update(('relation', row[0]) for row in self.select_in(
+                    "SELECT relation_id FROM relation_members WHERE member_type = '%s' AND member_id IN (%%s)" % (
+                        member_type,), member_ids))
+            to_check = parents - found
+            found |= to_check
+        return found
+
+    def boundary_tags(self, element_type_ids):
+        """Return a dictionary mapping those of element_type_ids that are boundaries to their tags"""
+        found = {}
+        for element_type in ('way', 'relation'):
+            for element_id, tags in self.select_in(
+                    "SELECT element_id, tags FROM boundaries WHERE element_type = '%s' AND element_id IN (%%s)" % (
+                        element_type,), [i for t, i in element_type_ids if t == element_type]):
+                found[(element_type, element_id)] = json.loads(tags)
+        return found
+
+    def boundaries(self, required_tags=None):
+        """Yield (element_type, element_id, tags) for boundaries with all of required_tags"""
+        rows = self.connection().execute(
+            'SELECT element_type, element_id, tags FROM boundaries ORDER BY element_type, element_id')
+        for element_type, element_id, tags in rows:
+            tags = json.loads(tags)
+            if all(tags.get(k) == v for k, v in (required_tags or {}).items()):
+                yield element_type, element_id, tags
+
+    def dependents(self, element_type, element_id):
+        """Return the nodes, ways and relations that make up an element, including itself
+
+        Each is a dictionary mapping IDs to (value, tags), as
+        feed_elements needs.  Anything that isn't stored, or is only a
+        member with one of ignored_roles, is left out.
+        """
+        found = {'node': {}, 'way': {}, 'relation': {}}
+        to_get = {'node': set(), 'way': set(), 'relation': set()}
+        to_get[element_type].add(element_id)
+        # Relations first, since they can have any members, then
+        # ways, and then the nodes of all of them:
+        for t in ('relation', 'way', 'node'):
+            while to_get[t]:
+                batch = to_get[t] - set(found[t])
+                to_get[t] = set()
+                for i, (value, tags) in self.get_many(t, batch).items():
+                    found[t][i] = (value, tags)
+                    if t == 'relation':
+                        for member_type, member_id, role in value:
+                            if role not in self.ignored_roles and member_id not in found[member_type]:
+                                to_get[member_type].add(member_id)
+                    elif t == 'way':
+                        to_get['node'].update(value)
+        return found['node'], found['way'], found['relation']
+
+    def feed(self, element_type, element_id, handler):
+        """Give an element and everything it's made of to a SAX-style handler
+
+        This is done with feed_elements, so the members of each
+        element come before it.
+        """
+        feed_elements(handler, *self.dependents(element_type, element_id))
+
+    def clear(self):
+        """Remove every element"""
+        with self.connection() as connection:
+            for table in ('nodes', 'ways', 'relations', 'way_nodes', 'relation_members', 'boundaries'):
+                connection.execute('DELETE FROM %s' % (table,))
+
+    def close(self):
+        """Close this thread's connection to the database"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+def matches_any(tags, tag_filters):
+    """Return True if tags include all of those in any of tag_filters
+
+    >>> matches_any({'boundary': 'administrative', 'admin_level': '8'},
+    ...             [{'admin_level': '4'}, {'boundary': 'administrative'}])
+    True
+    >>> matches_any({'boundary': 'administrative'}, [{'admin_level': '4'}])
+    False
+    """
+    return any(all(tags.get(k) == v for k, v in f.items()) for f in tag_filters)
+
+
+class ElementTupleHandler(ContentHandler):
+
+    """A SAX-style handler that turns OSM XML into element tuples
+
+    Each element is passed to handle_element as an (element_type,
+    element_id, value, tags) tuple, like those ElementStore holds,
+    once its end tag is reached:
+
+    >>> xml.sax.parseString(b'<osm><way id="10"><nd ref="1"/><tag k="name" v="Here"/></way></osm>',
+    ...                     ElementTupleHandler(print))
+    ('way', 10, [1], {'name': 'Here'})
+    """
+
+    def __init__(self, handle_element):
+        self.handle_element = handle_element
+        self.current = None
+
+    def startElement(self, name, attr):
+        if name == 'node':
+            # Deleted nodes may have no location:
+            self.current = ('node', int(attr['id']),
+                            (int(round(float(attr.get('lat', 0)) * 1e7)),
+                             int(round(float(attr.get('lon', 0)) * 1e7))), {})
+        elif name == 'way' or name == 'relation':
+            self.current = (name, int(attr['id']), [], {})
+        elif name == 'nd':
+            self.current[2].append(int(attr['ref']))
+        elif name == 'member':
+            self.current[2].append((attr['type'], int(attr['ref']), attr['role']))
+        elif name == 'tag':
+            self.current[3][attr['k']] = attr['v']
+
+    def endElement(self, name):
+        if name in ('node', 'way', 'relation'):
+            self.handle_element(self.current)
+            self.current = None
+
+
+class ElementStoreLoader(ElementTupleHandler):
+
+    """A SAX-style handler that puts every element it's given into an ElementStore
+
+    Elements are written in batches of batch_size, so close() must be
+    called at the end to write the last of them.  Ways and relations
+    whose tags match one of tag_filters (dictionaries of tags that
+    must all be present) are recorded as boundaries.
+
+    >>> tmp_directory = mkdtemp()
+    >>> store = ElementStore(os.path.join(tmp_directory, 'element-store.sqlite3'))
+    >>> loader = ElementStoreLoader(store, [{'boundary': 'administrative'}], batch_size=2)
+    >>> xml.sax.parseString(b'''<?xml version="1.0" encoding="UTF-8"?>
+    ... <osm version="0.6" generator="Overpass API">
+    ...   <node id="291974462" lat="55.0548850" lon="-2.9544991"/>
+    ...   <node id="312203528" lat="54.4600000" lon="-5.0596341"/>
+    ...   <way id="28421671">
+    ...     <nd ref="291974462"/>
+    ...     <nd ref="312203528"/>
+    ...   </way>
+    ...   <relation id="3123205528">
+    ...     <member type="way" ref="28421671" role="outer"/>
+    ...     <tag k="boundary" v="administrative"/>
+    ...   </relation>
+    ... </osm>''', loader)
+    >>> loader.close()
+    >>> loader.counts
+    {'node': 2, 'way': 1, 'relation': 1}
+    >>> store.get('node', 291974462), list(store.boundaries())
+    (((550548850, -29544991), {}), [('relation', 3123205528, {'boundary': 'administrative'})])
+    >>> store.close()
+    >>> shutil.rmtree(tmp_directory)
+    """
+
+    def __init__(self, store, tag_filters=(), batch_size=10000):
+        super(ElementStoreLoader, self).__init__(self.add_element)
+        self.store = store
+        self.tag_filters = list(tag_filters)
+        self.batch_size = batch_size
+        self.elements = []
+        self.boundaries = []
+        self.counts = {'node': 0, 'way': 0, 'relation': 0}
+
+    def add_element(self, element):
+        element_type, element_id, value, tags = element
+        self.elements.append(element)
+        self.counts[element_type] += 1
+        if element_type != 'node' and matches_any(tags, self.tag_filters):
+            self.boundaries.append((element_type, element_id, tags))
+        if len(self.elements) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.store.put_many(self.elements)
+        self.store.add_boundaries(self.boundaries)
+        self.elements = []
+        self.boundaries = []
+
+    def close(self):
+        self.flush()
+
+
+class OsmChangeReader(ElementTupleHandler):
+
+    """A SAX-style handler that collects the changes in an OsmChange document
+
+    Each change is kept in the changes list as an (action, element)
+    tuple, where action is 'create', 'modify' or 'delete', and element
+    is an element tuple; see iter_osm_change.
+    """
+
+    def __init__(self):
+        super(OsmChangeReader, self).__init__(self.add_change)
+        self.action = None
+        self.changes = []
+
+    def startElement(self, name, attr):
+        if name in ('create', 'modify', 'delete'):
+            self.action = name
+        else:
+            super(OsmChangeReader, self).startElement(name, attr)
+
+    def add_change(self, element):
+        self.changes.append((self.action, element))
+
+
+def iter_osm_change(fp, chunk_size=1024 * 1024):
+    """Yield (action, element) for each change in an OsmChange (.osc) file
+
+    The changes are read incrementally, from the start, from the
+    binary file object fp, which must be seekable, and may be gzip
+    compressed, as the replication diffs are.
+
+    >>> import io
+    >>> osc = b'''<?xml version="1.0" encoding="UTF-8"?>
+    ... <osmChange version="0.6" generator="Osmosis">
+    ...   <modify>
+    ...     <node id="1" version="2" lat="52.1" lon="0.5"/>
+    ...     <way id="10" version="3">
+    ...       <nd ref="1"/>
+    ...       <nd ref="2"/>
+    ...       <tag k="highway" v="track"/>
+    ...     </way>
+    ...   </modify>
+    ...   <delete>
+    ...     <node id="3" version="4"/>
+    ...   </delete>
+    ... </osmChange>'''
+    >>> for change in iter_osm_change(io.BytesIO(osc)):
+    ...     print(change)
+    ('modify', ('node', 1, (521000000, 5000000), {}))
+    ('modify', ('way', 10, [1, 2], {'highway': 'track'}))
+    ('delete', ('node', 3, (0, 0), {}))
+    >>> list(iter_osm_change(io.BytesIO(gzip.compress(osc)))) == list(iter_osm_change(io.BytesIO(osc)))
+    True
+    """
+    # fp may have been read before, e.g. by an earlier pass of
+    # apply_osm_change:
+    fp.seek(0)
+    compressed = fp.read(2) == b'\x1f\x8b'
+    fp.seek(0)
+    if compressed:
+        fp = gzip.GzipFile(fileobj=fp)
+    reader = OsmChangeReader()
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(reader)
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        for change in reader.changes:
+            yield change
+        reader.changes = []
+    parser.close()
+    for change in reader.changes:
+        yield change
+
+
+def apply_osm_change(store, fp, tag_filters=(), node_locations=None, batch_size=10000):
+    """Apply the changes in an OsmChange file to an ElementStore
+
+    Only the changes that matter for boundaries are applied: those to
+    elements that are already stored, to ways and relations whose
+    tags match one of tag_filters, and to anything that a changed
+    boundary (or a relation in it) now needs.  The boundaries table is
+    updated to match.  If node_locations (e.g. a DenseNodeLocations)
+    is given, the new locations of the nodes are set in it too.
+
+    fp is read twice, once for the ways and relations and then once
+    for the nodes, so that the nodes don't all have to be held in
+    memory.  Returns the set of (element_type, element_id) for the
+    elements that were changed.
+
+    >>> import io
+    >>> tmp_directory = mkdtemp()
+    >>> store = ElementStore(os.path.join(tmp_directory, 'element-store.sqlite3'))
+    >>> store.put_many([('node', 1, (520000000, 10000000), {}),
+    ...                 ('node', 2, (520000000, 20000000), {}),
+    ...                 ('node', 3, (510000000, 20000000), {}),
+    ...                 ('way', 10, [1, 2, 3, 1], {'boundary': 'administrative'})])
+    >>> store.add_boundaries([('way', 10, {'boundary': 'administrative'})])
+    >>> osc = io.BytesIO(b\'\'\'<?xml version="1.0" encoding="UTF-8"?>
+    ... <osmChange version="0.6">
+    ...   <create>
+    ...     <node id="4" lat="51" lon="1"/>
+    ...     <node id="5" lat="40" lon="1"/>
+    ...     <way id="11">
+    ...       <nd ref="1"/>
+    ...       <nd ref="4"/>
+    ...       <tag k="highway" v="track"/>
+    ...     </way>
+    ...   </create>
+    ...   <modify>
+    ...     <node id="2" lat="52.5" lon="2"/>
+    ...     <way id="10">
+    ...       <nd ref="1"/>
+    ...       <nd ref="2"/>
+    ...       <nd ref="4"/>
+    ...       <nd ref="1"/>
+    ...       <tag k="boundary" v="administrative"/>
+    ...     </way>
+    ...   </modify>
+    ...   <delete>
+    ...     <node id="3"/>
+    ...   </delete>
+    ... </osmChange>\'\'\')
+    >>> sorted(apply_osm_change(store, osc, [{'boundary': 'administrative'}]))
+    [('node', 2), ('node', 3), ('node', 4), ('way', 10)]
+
+    The way that isn't a boundary, and the node that nothing needs,
+    were left out:
+
+    >>> store.get('way', 10), store.get('node', 4), store.get('node', 3)
+    (([1, 2, 4, 1], {'boundary': 'administrative'}), ((510000000, 10000000), {}), None)
+    >>> store.present('way', [11]), store.present('node', [5])
+    (set(), set())
+
+    A gzipped file, as the replication diffs are, works too:
+
+    >>> osc = io.BytesIO(gzip.compress(
+    ...     b'<osmChange version="0.6"><modify><node id="2" lat="52.6" lon="2"/></modify></osmChange>'))
+    >>> sorted(apply_osm_change(store, osc, [{'boundary': 'administrative'}])), store.get('node', 2)
+    ([('node', 2)], ((526000000, 20000000), {}))
+    >>> store.close()
+    >>> shutil.rmtree(tmp_directory)
+    """
+    tag_filters = list(tag_filters)
+    changes = {}
+    for action, element in iter_osm_change(fp):
+        if element[0] != 'node':
+            changes[element[:2]] = (action, element)
+
+    def wanted(element_type_id):
+        action, element = changes[element_type_id]
+        return action != 'delete' and matches_any(element[3], tag_filters)
+
+    # Relations that are stored or that are boundaries are applied,
+    # and then so are any that they have as members, and so on:
+    relation_ids = [i for t, i in changes if t == 'relation']
+    applied = set(('relation', i) for i in store.present('relation', relation_ids))
+    applied.update(('relation', i) for i in relation_ids if wanted(('relation', i)))
+    needed = set()
+    to_check = set(applied)
+    while to_check:
+        for element_type_id in to_check:
+            action, element = changes[element_type_id]
+            if action != 'delete':
+                needed.update((t, i) for t, i, role in element[2])
+        to_check = set(k for k in needed if k[0] == 'relation' and k in changes) - applied
+        applied |= to_check
+    way_ids = [i for t, i in changes if t == 'way']
+    stored_ways = store.present('way', way_ids)
+    for i in way_ids:
+        if i in stored_ways or ('way', i) in needed or wanted(('way', i)):
+            applied.add(('way', i))
+            action, element = changes[('way', i)]
+            if action != 'delete':
+                needed.update(('node', node_id) for node_id in element[2])
+
+    deleted = [k for k in applied if changes[k][0] == 'delete']
+    updated = [changes[k][1] for k in applied if changes[k][0] != 'delete']
+    store.delete_many(deleted)
+    store.put_many(updated)
+    store.add_boundaries([(t, i, tags) for t, i, value, tags in updated if matches_any(tags, tag_filters)])
+    store.remove_boundaries([(t, i) for t, i, value, tags in updated if not matches_any(tags, tag_filters)])
+
+    def apply_nodes(batch):
+        # If a node was changed more than once, the last change is the one that counts:
+        batch = dict((element[1], (action, element)) for action, element in batch)
+        stored = store.present('node', batch)
+        batch = [(action, element) for node_id, (action, element) in batch.items()
+                 if node_id in stored or ('node', node_id) in needed]
+        store.delete_many([element[:2] for action, element in batch if action == 'delete'])
+        store.put_many([element for action, element in batch if action != 'delete'])
+        if node_locations is not None:
+            for action, (t, node_id, (lat, lon), tags) in batch:
+                if action != 'delete':
+                    node_locations.set(node_id, lon, lat)
+        applied.update(element[:2] for action, element in batch)
+
+    batch = []
+    for action, element in iter_osm_change(fp):
+        if element[0] == 'node':
+            batch.append((action, element))
+            if len(batch) >= batch_size:
+                apply_nodes(batch)
+                batch = []
+    apply_nodes(batch)
+    return applied
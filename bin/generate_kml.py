@@ -4,12 +4,14 @@
 import sys
 from lxml import etree
 from shapely.geometry import Polygon
-from boundaries import join_way_soup, fetch_osm_element, UnclosedBoundariesException
+from boundaries import join_way_soup, fetch_osm_element, map_concurrently, UnclosedBoundariesException
 
 # The following are only used by doctests, hence noqa
 from boundaries import fake_requests_get # noqa
 import requests # noqa
 from mock import patch # noqa
+import shutil # noqa
+from tempfile import mkdtemp # noqa
 
 
 def ways_overlap(a, b):
@@ -43,6 +45,12 @@ def ways_overlap(a, b):
     >>> ways_overlap(w1, w3)
     False
 
+    ArrayWay objects can be compared in the same way:
+
+    >>> from boundaries import ArrayWay
+    >>> ways_overlap(ArrayWay.from_way(w1), ArrayWay.from_way(w2))
+    True
+
     Passing in a Way with too few points is an error:
 
     >>> w_open = Way('4', nodes=[Node('18', latitude=51, longitude=7),
@@ -53,10 +61,8 @@ def ways_overlap(a, b):
     ValueError: A LinearRing must have at least 3 coordinate tuples
     """
 
-    tuples_a = [(float(n.lon), float(n.lat)) for n in a]
-    tuples_b = [(float(n.lon), float(n.lat)) for n in b]
-    polygon_a = Polygon(tuples_a)
-    polygon_b = Polygon(tuples_b)
+    polygon_a = Polygon(a.float_lon_lat_tuples())
+    polygon_b = Polygon(b.float_lon_lat_tuples())
     return polygon_a.intersects(polygon_b)
 
 
@@ -207,6 +213,21 @@ def kml_string(folder_name,
         </Placemark>
       </Folder>
     </kml>
+
+    The ways can also be made of CompactNode objects, whose
+    coordinates are output with OSM's precision:
+
+    >>> from boundaries import CompactNode
+    >>> compact_square = Way('4', nodes=[CompactNode('18', latitude=52, longitude=-3),
+    ...                                  CompactNode('19', latitude=52, longitude=-2),
+    ...                                  CompactNode('20', latitude=51, longitude=-2),
+    ...                                  CompactNode('21', latitude=51, longitude=-3),
+    ...                                  CompactNode('18', latitude=52, longitude=-3)])
+    >>> kml = kml_string('Example Folder', 'Example Placemark', {}, [compact_square], [])
+    >>> print(kml.decode('utf-8')) # doctest: +ELLIPSIS
+    <?xml ...
+                  <coordinates>-3.0000000,52.0000000,0  -2.0000000,52.0000000,0  ...</coordinates>
+    ...
     """
 
     kml = etree.Element("kml",
@@ -237,7 +258,7 @@ def kml_string(folder_name,
             boundary = etree.SubElement(polygon, boundary_type + "BoundaryIs")
             linear_ring = etree.SubElement(boundary, "LinearRing")
             coordinates = etree.SubElement(linear_ring, "coordinates")
-            coordinates.text = " ".join("%s,%s,0 " % n.lon_lat_tuple() for n in way.nodes)
+            coordinates.text = " ".join("%s,%s,0 " % t for t in way.lon_lat_tuples())
 
     return etree.tostring(kml,
                           pretty_print=True,
@@ -341,7 +362,9 @@ def get_kml_for_osm_element(element_type, element_id):
     For example, we could fetch the boundary of the South
     Cambridgeshire (which has a hole in it, which is Cambridge) with:
 
-    >>> with patch.object(requests, 'get', side_effect=fake_requests_get):
+    >>> tmp_cache = mkdtemp()
+    >>> with patch('boundaries.get_default_cache_directory', return_value=tmp_cache), \\
+    ...         patch.object(requests.Session, 'get', side_effect=fake_requests_get):
     ...     kml, bbox = get_kml_for_osm_element('relation', '295353')
     >>> print(kml.decode('utf-8'), end='') #doctest: +ELLIPSIS
     <?xml version='1.0' encoding='utf-8'?>
@@ -399,9 +422,11 @@ def get_kml_for_osm_element(element_type, element_id):
 
     If a relation can't be found, (None, None) is returned:
 
-    >>> with patch.object(requests, 'get', side_effect=fake_requests_get):
+    >>> with patch('boundaries.get_default_cache_directory', return_value=tmp_cache), \\
+    ...         patch.object(requests.Session, 'get', side_effect=fake_requests_get):
     ...     get_kml_for_osm_element('relation', '10000000000')
     (None, None)
+    >>> shutil.rmtree(tmp_cache)
     """
 
     e = fetch_osm_element(element_type, element_id, visited=set())
@@ -411,6 +436,32 @@ def get_kml_for_osm_element(element_type, element_id):
     return get_kml_for_osm_element_no_fetch(e)
 
 
+def get_kml_for_osm_elements(element_type_id_tuples, max_workers=None):
+    """Call get_kml_for_osm_element for several elements concurrently
+
+    element_type_id_tuples should be an iterable of (element_type,
+    element_id) tuples.  The elements are fetched in a pool of up to
+    max_workers threads (by default, the FETCH_CONCURRENCY setting)
+    and pairs of each tuple and a completed Future are yielded in the
+    same order.  The Future's result() returns what
+    get_kml_for_osm_element did, or raises its exception, e.g.
+    UnclosedBoundariesException:
+
+    >>> tmp_cache = mkdtemp()
+    >>> with patch('boundaries.get_default_cache_directory', return_value=tmp_cache), \\
+    ...         patch.object(requests.Session, 'get', side_effect=fake_requests_get):
+    ...     for t, future in get_kml_for_osm_elements([('relation', '10000000000'),
+    ...                                                ('relation', '295353')]):
+    ...         kml, bounding_boxes = future.result()
+    ...         print(t, len(bounding_boxes) if kml else None)
+    ('relation', '10000000000') None
+    ('relation', '295353') 1
+    >>> shutil.rmtree(tmp_cache)
+    """
+
+    return map_concurrently(get_kml_for_osm_element, element_type_id_tuples, max_workers)
+
+
 if __name__ == "__main__":
 
     from optparse import OptionParser
@@ -4,6 +4,7 @@
 # This script fetches all administrative and political boundaries from
 # OpenStreetMap and writes them out as KML.
 
+from glob import glob
 import os
 import re
 import sys
@@ -11,15 +12,87 @@ import sys
 from django.utils.encoding import smart_str
 
 from boundaries import (
-    mkdir_p, get_query_relations_and_ways, get_osm3s, get_name_from_tags, parse_xml_minimal,
-    UnclosedBoundariesException)
-from generate_kml import get_kml_for_osm_element
+    mkdir_p, get_query_relations_and_ways, stream_osm3s, get_name_from_tags, iter_xml_minimal,
+    get_in_memory_cache_totals, get_missing_element_statistics, get_parsed_file_memo_statistics,
+    read_boundaries_from_pbf, get_element_store, load_element_store, get_element_from_store,
+    apply_osm_changes, get_dependency_index, invalidate_dependents, config, UnclosedBoundariesException)
+from element_store import iter_osm_change
+from generate_kml import get_kml_for_osm_elements, get_kml_for_osm_element_no_fetch
 
 
 def replace_slashes(s):
     return re.sub(r'/', '_', s)
 
 
+def get_kml_filename(level_directory, element_type, element_id, tags):
+    """Return the filename to write the KML for a boundary to"""
+
+    name = get_name_from_tags(tags, element_type, element_id)
+
+    print("Considering admin boundary:", smart_str(name))
+
+    basename = "%s-%s-%s" % (element_type,
+                             element_id,
+                             replace_slashes(name))
+
+    return os.path.join(level_directory, "%s.kml" % (basename,))
+
+
+def write_kml(filename, element_type, element_id, get_result):
+    """Write the KML that get_result() returns for a boundary to filename
+
+    Returns True if the KML was written."""
+
+    try:
+
+        kml, _ = get_result()
+        if not kml:
+            print("      No data found for %s %s" % (element_type, element_id))
+            return False
+
+        print("      Writing KML to", smart_str(filename))
+        with open(filename, "w") as fp:
+            fp.write(kml)
+        return True
+
+    except UnclosedBoundariesException:
+        print("      ... ignoring unclosed boundary for %s %s" % (element_type, element_id))
+        return False
+
+
+def refresh_changed_kml(output_directory, mapit_types, store, affected, no_longer_boundaries):
+    """Regenerate the KML for the boundaries that apply_osm_changes says were affected
+
+    Any older KML for those boundaries (say, from before they were
+    renamed) is removed, as is the KML for anything that's no longer
+    a boundary of that MapIt type.  Returns the filenames that were
+    written, relative to output_directory, and those that were
+    removed."""
+
+    written = []
+    removed = []
+    for mapit_type in mapit_types:
+        required_tags = mapit_type_to_tags[mapit_type]
+        level_directory = os.path.join(output_directory, mapit_type)
+        mkdir_p(level_directory)
+        for element_type, element_id in sorted(set(affected) | no_longer_boundaries):
+            old_filenames = glob(os.path.join(level_directory, "%s-%s-*.kml" % (element_type, element_id)))
+            tags = affected.get((element_type, element_id))
+            if tags is not None and all(tags.get(k) == v for k, v in required_tags.items()):
+                filename = get_kml_filename(level_directory, element_type, element_id, tags)
+                if not write_kml(filename, element_type, element_id,
+                                 lambda: get_kml_for_osm_element_no_fetch(
+                                     get_element_from_store(store, element_type, element_id))):
+                    continue
+                written.append(os.path.relpath(filename, output_directory))
+                old_filenames = [f for f in old_filenames if f != filename]
+            for old_filename in old_filenames:
+                print("      Removing", smart_str(old_filename))
+                os.remove(old_filename)
+                removed.append(os.path.relpath(old_filename, output_directory))
+    return written, removed
+
+
 mapit_type_to_tags = {
     # Administrative boundaries, each with a numbered admin_level:
     # http://wiki.openstreetmap.org/wiki/Tag:boundary%3Dadministrative
@@ -47,13 +120,50 @@ mapit_type_to_tags = {
 
 if __name__ == '__main__':
 
-    if len(sys.argv) > 2:
-        print("Usage: %s [FIRST-MAPIT_TYPE]" % (sys.argv[0],), file=sys.stderr)
+    from optparse import OptionParser
+    parser = OptionParser(usage="Usage: %prog [options] [FIRST-MAPIT_TYPE]")
+    parser.add_option("--pbf", dest="pbf", metavar="FILENAME",
+                      help="Read the boundaries from this .osm.pbf file rather than from Overpass")
+    parser.add_option("--element-store", dest="element_store",
+                      default=False, action='store_true',
+                      help="Fetch every boundary and everything they're made of with one query into "
+                           "the local element store, and generate the KML from that")
+    parser.add_option("--reuse-element-store", dest="reuse_element_store",
+                      default=False, action='store_true',
+                      help="Generate the KML from the element store as it was last loaded, with no queries")
+    parser.add_option("--changes", dest="changes", metavar="FILENAME",
+                      default=[], action='append',
+                      help="Apply the changes in this OsmChange (.osc or .osc.gz) file to the element store, "
+                           "and only regenerate the KML for the boundaries they affect; may be given more than "
+                           "once, in order.  This is the canonical way to keep the KML up to date")
+    parser.add_option("--invalidate", dest="invalidate", metavar="FILENAME",
+                      default=[], action='append',
+                      help="Without an element store, use the dependency index (see DEPENDENCY_INDEX) to remove "
+                           "the cached responses and KML for the boundaries affected by the changes in this "
+                           "OsmChange file before fetching from Overpass, so only they are regenerated; may be "
+                           "given more than once.  Use --changes instead if there's an element store")
+    parser.add_option("--changed-list", dest="changed_list", metavar="FILENAME",
+                      help="With --changes, write the KML files that were regenerated to FILENAME, for "
+                           "mapit_global_import --alter-current-generation --only-listed (default: "
+                           "changed-files.txt in the output directory)")
+    parser.add_option("--removed-list", dest="removed_list", metavar="FILENAME",
+                      help="With --changes, write the KML files that were removed to FILENAME, for "
+                           "mapit_global_import --alter-current-generation --retire-listed (default: "
+                           "removed-files.txt in the output directory)")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) > 1:
+        parser.print_help(file=sys.stderr)
         sys.exit(1)
 
+    if options.changes and options.invalidate:
+        parser.error("--changes and --invalidate are alternatives: --changes updates the element store, "
+                     "and --invalidate is for fetching from Overpass without one")
+
     start_mapit_type = 'O02'
-    if len(sys.argv) == 2:
-        start_mapit_type = sys.argv[1]
+    if len(args) == 1:
+        start_mapit_type = args[0]
 
     dir = os.path.dirname(os.path.abspath(__file__))
     data_dir = os.path.join(dir, '..', 'data')
@@ -65,6 +175,67 @@ if __name__ == '__main__':
             print(" ", mapit_type, file=sys.stderr)
         sys.exit(1)
 
+    tag_filters = [required_tags for mapit_type, required_tags in sorted(mapit_type_to_tags.items())
+                   if mapit_type >= start_mapit_type]
+
+    output_directory = os.path.join(data_dir, "cache-with-political")
+
+    # With OsmChange files, the element store (which must have been
+    # loaded with --element-store) is brought up to date, and only
+    # the KML for the boundaries that changed is regenerated:
+    if options.changes:
+        store = get_element_store()
+        print("Applying changes from", ", ".join(options.changes))
+        affected, no_longer_boundaries = apply_osm_changes(store, options.changes, tag_filters)
+        print("%d boundaries affected, %d no longer boundaries" % (len(affected), len(no_longer_boundaries)))
+        written, removed = refresh_changed_kml(
+            output_directory, [t for t in sorted(mapit_type_to_tags) if t >= start_mapit_type],
+            store, affected, no_longer_boundaries)
+        changed_list = options.changed_list or os.path.join(output_directory, "changed-files.txt")
+        removed_list = options.removed_list or os.path.join(output_directory, "removed-files.txt")
+        for list_filename, filenames in ((changed_list, written), (removed_list, removed)):
+            with open(list_filename, "w") as fp:
+                for filename in filenames:
+                    fp.write(filename + "\n")
+        print("Wrote %d changed KML files to %s, and %d removed ones to %s" % (
+            len(written), changed_list, len(removed), removed_list))
+        sys.exit(0)
+
+    # The dependency index, built up as boundaries are fetched if
+    # DEPENDENCY_INDEX is set, says which boundaries are affected by
+    # changes, so only their KML needs removing to be regenerated:
+    if options.invalidate:
+        changed = set()
+        for filename in options.invalidate:
+            with open(filename, 'rb') as fp:
+                changed.update(element[:2] for action, element in iter_osm_change(fp))
+        affected = invalidate_dependents(changed)
+        print("%d changed elements affect %d boundaries" % (len(changed), len(affected)))
+        for mapit_type in mapit_type_to_tags:
+            for element_type, element_id in sorted(affected):
+                for old_filename in glob(os.path.join(
+                        output_directory, mapit_type, "%s-%s-*.kml" % (element_type, element_id))):
+                    print("      Removing", smart_str(old_filename))
+                    os.remove(old_filename)
+
+    # With a PBF file, the boundaries of every MapIt type (and
+    # everything they're made of) are read from it in one go, in a
+    # few passes through the file:
+    pbf_boundaries = None
+    if options.pbf:
+        print("Reading boundaries from", options.pbf)
+        pbf_boundaries = read_boundaries_from_pbf(options.pbf, tag_filters)
+
+    # Or they can all be fetched with one query into the element
+    # store, rather than with a query for each boundary:
+    store = None
+    if options.element_store or options.reuse_element_store:
+        store = get_element_store()
+        if not options.reuse_element_store:
+            print("Loading every boundary into the element store")
+            counts = load_element_store(store, tag_filters)
+            print("Loaded %d nodes, %d ways and %d relations" % (counts['node'], counts['way'], counts['relation']))
+
     reached_first_mapit_type = False
 
     for mapit_type, required_tags in sorted(mapit_type_to_tags.items()):
@@ -79,46 +250,70 @@ if __name__ == '__main__':
         print("Fetching data for MapIt type", mapit_type)
 
         file_basename = mapit_type + ".xml"
-        output_directory = os.path.join(data_dir, "cache-with-political")
         query = get_query_relations_and_ways(required_tags)
-        data = get_osm3s(query.encode('utf-8'))
 
         level_directory = os.path.join(output_directory, mapit_type)
         mkdir_p(level_directory)
 
-        def handle_top_level_element(element_type, element_id, tags):
+        if pbf_boundaries is not None:
+            for element in pbf_boundaries:
+                if any(element.tags.get(k) != v for k, v in required_tags.items()):
+                    continue
+                element_type, element_id = element.name_id_tuple()
+                filename = get_kml_filename(level_directory, element_type, element_id, element.tags)
+                if not os.path.exists(filename):
+                    write_kml(filename, element_type, element_id,
+                              lambda: get_kml_for_osm_element_no_fetch(element))
+            continue
 
-            for required_key, required_value in list(required_tags.items()):
+        if store is not None:
+            for element_type, element_id, tags in store.boundaries(required_tags):
+                filename = get_kml_filename(level_directory, element_type, element_id, tags)
+                if not os.path.exists(filename):
+                    write_kml(filename, element_type, element_id,
+                              lambda: get_kml_for_osm_element_no_fetch(
+                                  get_element_from_store(store, element_type, element_id)))
+            continue
 
-                if required_key not in tags:
-                    return
-                if tags[required_key] != required_value:
-                    return
+        # The filename to write the KML for each element to:
+        filenames = {}
 
-            name = get_name_from_tags(tags, element_type, element_id)
+        def elements_to_generate(stdout):
+            """Yield the elements that need KML to be generated
 
-            print("Considering admin boundary:", smart_str(name))
+            They're found as the response to the query is read, so
+            that KML can be generated while osm3s_query is still
+            running, and the response is never all in memory."""
 
-            try:
+            for element_type, element_id, tags in iter_xml_minimal(stdout):
 
-                basename = "%s-%s-%s" % (element_type,
-                                         element_id,
-                                         replace_slashes(name))
+                if any(tags.get(k) != v for k, v in required_tags.items()):
+                    continue
 
-                filename = os.path.join(level_directory, "%s.kml" % (basename,))
+                filename = get_kml_filename(level_directory, element_type, element_id, tags)
 
                 if not os.path.exists(filename):
-
-                    kml, _ = get_kml_for_osm_element(element_type, element_id)
-                    if not kml:
-                        print("      No data found for %s %s" % (element_type, element_id))
-                        return
-
-                    print("      Writing KML to", smart_str(filename))
-                    with open(filename, "w") as fp:
-                        fp.write(kml)
-
-            except UnclosedBoundariesException:
-                print("      ... ignoring unclosed boundary")
-
-        parse_xml_minimal(data, handle_top_level_element)
+                    filenames[(element_type, element_id)] = filename
+                    yield element_type, element_id
+
+        # Fetch the elements concurrently, up to FETCH_CONCURRENCY at
+        # a time:
+        with stream_osm3s(query) as stdout:
+            for t, future in get_kml_for_osm_elements(elements_to_generate(stdout)):
+                element_type, element_id = t
+                write_kml(filenames.pop(t), element_type, element_id, future.result)
+
+        # Report how well the parsers' in-memory caches did, to help
+        # with setting IN_MEMORY_CACHE_LIMITS:
+        for element_type, totals in sorted(get_in_memory_cache_totals(reset=True).items()):
+            print("In-memory %s cache for %s: %d hits, %d misses, %d evictions" % (
+                element_type, mapit_type, totals['hits'], totals['misses'], totals['evictions']))
+        memo = get_parsed_file_memo_statistics()
+        print("Parsed-file memo so far: %d re-parses avoided, %d elements (%d bytes), %d evictions" % (
+            memo['hits'], memo['size'], memo['weight'], memo['evictions']))
+        missing = get_missing_element_statistics()
+        print("Missing elements so far: %d queries avoided, %d newly recorded as missing" % (
+            missing['hits'], missing['recorded']))
+
+        if config.get('DEPENDENCY_INDEX'):
+            get_dependency_index().flush()
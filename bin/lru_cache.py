@@ -0,0 +1,136 @@
+from collections import OrderedDict
+
+
+class LRUCache(OrderedDict):
+
+    """A dictionary that can be limited to its most recently used items
+
+    If maxsize is None, the dictionary is unbounded.  Otherwise, once
+    there are more than maxsize items the least recently used one is
+    evicted.  Lookups made with lookup() count as a use, and are
+    counted as hits or misses:
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.lookup('a')
+    1
+    >>> cache['c'] = 3
+    >>> list(cache.keys())
+    ['a', 'c']
+    >>> cache.lookup('b') is None
+    True
+    >>> cache.get('b', 0)
+    0
+    >>> cache.statistics()
+    {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 2, 'evictions': 1}
+
+    Otherwise, it's an ordinary dictionary:
+
+    >>> unbounded = LRUCache()
+    >>> for i in range(1000):
+    ...     unbounded[i] = i
+    >>> len(unbounded), unbounded.evictions
+    (1000, 0)
+    """
+
+    def __init__(self, maxsize=None):
+        OrderedDict.__init__(self)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """Return the value for key, or None if there isn't one"""
+        try:
+            value = self[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.maxsize is not None:
+            self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        """Like lookup(), so an LRUCache can be used in place of a dict"""
+        value = self.lookup(key)
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        if self.maxsize is not None:
+            self.move_to_end(key)
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+                self.evictions += 1
+
+    def statistics(self):
+        return {'size': len(self),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class WeightedLRUCache(LRUCache):
+
+    """An LRUCache that's limited by the total weight of its items
+
+    Items are added with put(), with a weight, such as an estimate of
+    their size in bytes.  Once the total weight is more than
+    maxweight, the least recently used items are evicted.  An item
+    that's heavier than maxweight on its own isn't kept at all:
+
+    >>> cache = WeightedLRUCache(maxweight=10)
+    >>> cache.put('a', 'A', 4)
+    >>> cache.put('b', 'B', 4)
+    >>> cache.lookup('a')
+    'A'
+    >>> cache.put('c', 'C', 4)
+    >>> list(cache.keys()), cache.weight
+    (['a', 'c'], 8)
+    >>> cache.put('d', 'D', 11)
+    >>> 'd' in cache
+    False
+    >>> cache.statistics()
+    {'size': 2, 'maxsize': None, 'hits': 1, 'misses': 0, 'evictions': 1, 'weight': 8, 'maxweight': 10}
+    """
+
+    def __init__(self, maxweight):
+        LRUCache.__init__(self)
+        self.maxweight = maxweight
+        self.weights = {}
+        self.weight = 0
+
+    def put(self, key, value, weight):
+        if weight > self.maxweight:
+            return
+        if key in self:
+            self.weight -= self.weights[key]
+        self[key] = value
+        self.move_to_end(key)
+        self.weights[key] = weight
+        self.weight += weight
+        while self.weight > self.maxweight:
+            evicted_key, _ = self.popitem(last=False)
+            self.weight -= self.weights.pop(evicted_key)
+            self.evictions += 1
+
+    def lookup(self, key):
+        value = LRUCache.lookup(self, key)
+        if value is not None:
+            self.move_to_end(key)
+        return value
+
+    def clear(self):
+        LRUCache.clear(self)
+        self.weights.clear()
+        self.weight = 0
+
+    def statistics(self):
+        statistics = LRUCache.statistics(self)
+        statistics['weight'] = self.weight
+        statistics['maxweight'] = self.maxweight
+        return statistics
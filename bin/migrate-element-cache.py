@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# This script copies every cached Overpass response from one cache
+# backend to another, e.g. from the default tree of files in
+# data/new-cache to a single SQLite database, before setting
+# CACHE_BACKEND to 'sqlite' in general.yml:
+#
+#   bin/migrate-element-cache.py --from=directory --to=sqlite
+#
+# Responses are copied as they're stored, so compressed ones stay
+# compressed, and the pre-parsed elements are copied after them.
+
+from collections import defaultdict
+from itertools import islice
+import sys
+
+from boundaries import get_default_cache_directory
+from element_cache import ELEMENT_CACHE_BACKENDS
+
+
+def copy_cache(from_cache, to_cache, batch_size=1000, verbose=False):
+    """Copy every element in from_cache to to_cache, returning the number copied"""
+    copied = 0
+    keys = from_cache.keys()
+    while True:
+        batch = [(element_type, element_id, from_cache.get_raw(element_type, element_id))
+                 for element_type, element_id in islice(keys, batch_size)]
+        if not batch:
+            break
+        to_cache.put_many_raw(batch)
+        copied += len(batch)
+        if verbose:
+            print("Copied %d elements" % (copied,))
+    return copied
+
+
+def copy_parsed(from_cache, to_cache, verbose=False):
+    """Copy every pre-parsed element in from_cache to to_cache, returning the number copied
+
+    This must be done after the responses are copied, since storing
+    a response removes the pre-parsed versions of what includes it."""
+    dependencies = defaultdict(list)
+    for dependency_type, dependency_id, element_type, element_id in from_cache.parsed_dependencies():
+        dependencies[(element_type, element_id)].append((dependency_type, dependency_id))
+    copied = 0
+    for element_type, element_id in from_cache.parsed_keys():
+        data = from_cache.get_parsed(element_type, element_id)
+        if data is None:
+            continue
+        to_cache.put_parsed(element_type, element_id, data, dependencies[(element_type, element_id)])
+        copied += 1
+        if verbose and copied % 1000 == 0:
+            print("Copied %d pre-parsed elements" % (copied,))
+    return copied
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+    parser = OptionParser()
+    parser.add_option("--cache-directory", dest="cache_directory",
+                      default=get_default_cache_directory(),
+                      help="The cache directory (default data/new-cache)")
+    parser.add_option("--from", dest="from_backend", default="directory",
+                      help="The backend to copy from (default directory)")
+    parser.add_option("--to", dest="to_backend", default="sqlite",
+                      help="The backend to copy to (default sqlite)")
+    parser.add_option("--verbose", dest="verbose",
+                      default=False, action='store_true',
+                      help="Report progress")
+
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.print_help(file=sys.stderr)
+        sys.exit(1)
+
+    for backend in (options.from_backend, options.to_backend):
+        if backend not in ELEMENT_CACHE_BACKENDS:
+            print("Unknown cache backend '%s'; the backends are: %s" % (
+                backend, ", ".join(sorted(ELEMENT_CACHE_BACKENDS))), file=sys.stderr)
+            sys.exit(1)
+
+    if options.from_backend == options.to_backend:
+        print("The --from and --to backends must be different", file=sys.stderr)
+        sys.exit(1)
+
+    from_cache = ELEMENT_CACHE_BACKENDS[options.from_backend](options.cache_directory)
+    to_cache = ELEMENT_CACHE_BACKENDS[options.to_backend](options.cache_directory)
+    copied = copy_cache(from_cache, to_cache, verbose=options.verbose)
+    copied_parsed = copy_parsed(from_cache, to_cache, verbose=options.verbose)
+    print("Copied %d elements and %d pre-parsed elements from the %s cache to the %s cache" % (
+        copied, copied_parsed, options.from_backend, options.to_backend))
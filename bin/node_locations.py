@@ -0,0 +1,160 @@
+import fcntl
+import mmap
+import os
+import threading
+
+# The following are only used by doctests, hence noqa
+import shutil  # noqa
+from tempfile import mkdtemp  # noqa
+
+
+class DenseNodeLocations(object):
+
+    """A memory-mapped file of node locations, indexed by OSM node ID
+
+    This is like osmium's dense file index: the location of node N is
+    stored at offset 8 * N in the file, as a pair of unsigned 32 bit
+    integers (in native byte order) for the longitude and latitude in
+    units of 10^-7 degrees.  The values are offset by 2^31, so that a
+    slot that has never been written (which reads as zero) means that
+    the location is unknown.  The file is grown as necessary, and is
+    sparse, so it only takes up disk space for the parts of the ID
+    range that have been used.
+
+    Since the file is memory-mapped with MAP_SHARED, it can be used by
+    several processes at once, and persists between runs.  An
+    instance can also be shared between threads.
+
+    >>> tmp_directory = mkdtemp()
+    >>> filename = os.path.join(tmp_directory, 'node-locations')
+    >>> locations = DenseNodeLocations(filename)
+    >>> locations.set(2919744, -29544991, 550548850)
+    >>> locations.get(2919744)
+    (-29544991, 550548850)
+    >>> locations.get(2919745) is None
+    True
+    >>> 2919744 in locations
+    True
+
+    Asking for an ID beyond the end of the file is fine too:
+
+    >>> locations.get(10 ** 10) is None
+    True
+
+    Another instance on the same file sees the same locations,
+    including any that are added after it was opened:
+
+    >>> reader = DenseNodeLocations(filename, readonly=True)
+    >>> reader.get(2919744)
+    (-29544991, 550548850)
+    >>> locations.set(5000000, 1800000000, -900000000)
+    >>> reader.get(5000000)
+    (1800000000, -900000000)
+    >>> reader.close()
+
+    A read-only instance can't be changed:
+
+    >>> with DenseNodeLocations(filename, readonly=True) as reader:
+    ...     reader.set(1, 0, 0)
+    Traceback (most recent call last):
+      ...
+    Exception: Trying to set a node location in a read-only DenseNodeLocations
+
+    Remove the temporary directory created for these doctests:
+
+    >>> locations.close()
+    >>> shutil.rmtree(tmp_directory)
+    """
+
+    SLOT_SIZE = 8
+    GROWTH_SLOTS = 1 << 20
+    BIAS = 1 << 31
+
+    def __init__(self, filename, readonly=False):
+        self.filename = filename
+        self.readonly = readonly
+        flags = os.O_RDONLY if readonly else (os.O_RDWR | os.O_CREAT)
+        self.fd = os.open(filename, flags, 0o644)
+        self.mm = None
+        self.view = None
+        self.capacity = 0
+        self.lock = threading.Lock()
+        self.remap()
+
+    def remap(self):
+        """Map the whole of the file, which may have been grown elsewhere
+
+        The previous mapping isn't closed explicitly, since another
+        thread may still be using it; it goes away when the last
+        reference to it does.  The new view is set before the new
+        capacity, so that a view is always at least as big as the
+        capacity that was read before it.
+        """
+        with self.lock:
+            size = os.fstat(self.fd).st_size
+            if size <= self.capacity * self.SLOT_SIZE:
+                return
+            access = mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE
+            self.mm = mmap.mmap(self.fd, size, access=access)
+            self.view = memoryview(self.mm).cast('I')
+            self.capacity = size // self.SLOT_SIZE
+
+    def unmap(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.capacity = 0
+
+    def grow(self, node_id):
+        """Extend the file so that there's a slot for node_id"""
+        new_size = (node_id // self.GROWTH_SLOTS + 1) * self.GROWTH_SLOTS * self.SLOT_SIZE
+        # Lock the file so that a concurrent grow in another process
+        # can't truncate it to a smaller size than this one:
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size < new_size:
+                os.ftruncate(self.fd, new_size)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.remap()
+
+    def set(self, node_id, lon_e7, lat_e7):
+        if self.readonly:
+            raise Exception("Trying to set a node location in a read-only DenseNodeLocations")
+        if node_id >= self.capacity:
+            self.grow(node_id)
+        view = self.view
+        i = node_id * 2
+        view[i] = lon_e7 + self.BIAS
+        view[i + 1] = lat_e7 + self.BIAS
+
+    def get(self, node_id):
+        """Return (lon_e7, lat_e7) for the node, or None if it's unknown"""
+        if node_id >= self.capacity:
+            self.remap()
+            if node_id >= self.capacity:
+                return None
+        view = self.view
+        i = node_id * 2
+        lon = view[i]
+        if lon == 0:
+            return None
+        return (lon - self.BIAS, view[i + 1] - self.BIAS)
+
+    def __contains__(self, node_id):
+        return self.get(node_id) is not None
+
+    def close(self):
+        self.unmap()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
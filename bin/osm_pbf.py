@@ -0,0 +1,767 @@
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, chain
+import lzma
+import os
+import struct
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The following are only used by doctests, hence noqa
+from io import BytesIO  # noqa
+from mock import patch  # noqa
+import shutil  # noqa
+from tempfile import mkdtemp  # noqa
+
+
+# Protocol buffer wire types:
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# The limits on the sizes of a BlobHeader and a Blob from the OSM PBF
+# specification:
+MAX_BLOB_HEADER_SIZE = 64 * 1024
+MAX_BLOB_SIZE = 32 * 1024 * 1024
+
+ELEMENT_TYPES = ('node', 'way', 'relation')
+
+# Anything else in a file's required_features means that it has data
+# (e.g. history) that can't be read as elements in the usual way:
+SUPPORTED_FEATURES = set(('OsmSchema-V0.6', 'DenseNodes'))
+
+
+def read_varint(data, pos):
+    """Return the varint that starts at pos in data, and the position after it
+
+    >>> read_varint(b'\\x96\\x01\\x05', 0)
+    (150, 2)
+    """
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_fields(data):
+    """Yield (field number, value) for each field of an encoded protobuf message
+
+    Varints are returned as (unsigned) ints, and every other kind of
+    field as bytes:
+
+    >>> list(iter_fields(b'\\x08\\x96\\x01\\x12\\x02hi'))
+    [(1, 150), (2, b'hi')]
+    """
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == VARINT:
+            value, pos = read_varint(data, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == FIXED64:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == FIXED32:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise Exception("Unsupported protobuf wire type %d" % (wire_type,))
+        yield key >> 3, value
+
+
+def unpack_varints(value):
+    """Return the list of varints in a packed repeated field
+
+    A repeated field that wasn't packed comes as one int per field,
+    so that's returned as a list of one:
+
+    >>> unpack_varints(b'\\x03\\x8e\\x02'), unpack_varints(7)
+    ([3, 270], [7])
+    """
+    if isinstance(value, int):
+        return [value]
+    values = []
+    append = values.append
+    pos = 0
+    end = len(value)
+    while pos < end:
+        b = value[pos]
+        if b < 0x80:
+            append(b)
+            pos += 1
+        else:
+            n, pos = read_varint(value, pos)
+            append(n)
+    return values
+
+
+def signed(n):
+    """Return the int64 that a varint encodes in two's complement"""
+    return n - (1 << 64) if n >= (1 << 63) else n
+
+
+def unzigzag(values):
+    """Decode a list of sint64 values
+
+    >>> unzigzag([0, 1, 2, 3])
+    [0, -1, 1, -2]
+    """
+    return [(n >> 1) ^ -(n & 1) for n in values]
+
+
+def undelta(values):
+    """Return the running totals of delta-coded values"""
+    return list(accumulate(values))
+
+
+def iter_blobs(fp):
+    """Yield (offset, type, blob) for each blob in a PBF file
+
+    The blob is still encoded (and usually compressed): that's left
+    to decompress_blob, so that it can be done in another process.
+    """
+    while True:
+        offset = fp.tell()
+        length_bytes = fp.read(4)
+        if not length_bytes:
+            return
+        if len(length_bytes) < 4:
+            raise Exception("Truncated PBF file")
+        (length,) = struct.unpack('!I', length_bytes)
+        if length > MAX_BLOB_HEADER_SIZE:
+            raise Exception("A PBF blob header is too big (%d bytes)" % (length,))
+        blob_type = None
+        data_size = 0
+        for field, value in iter_fields(fp.read(length)):
+            if field == 1:
+                blob_type = value.decode('utf-8')
+            elif field == 3:
+                data_size = value
+        if data_size > MAX_BLOB_SIZE:
+            raise Exception("A PBF blob is too big (%d bytes)" % (data_size,))
+        blob = fp.read(data_size)
+        if len(blob) < data_size:
+            raise Exception("Truncated PBF file")
+        yield offset, blob_type, blob
+
+
+def decompress_blob(blob):
+    """Return the uncompressed data in an encoded Blob"""
+    fields = dict(iter_fields(blob))
+    if 1 in fields:
+        return fields[1]
+    if 3 in fields:
+        return zlib.decompress(fields[3])
+    if 4 in fields:
+        return lzma.decompress(fields[4])
+    if 7 in fields:
+        if zstandard is None:
+            raise Exception("The zstandard package is needed to read zstd-compressed PBF files")
+        return zstandard.ZstdDecompressor().decompress(fields[7], max_output_size=fields.get(2, 0))
+    raise Exception("Unsupported PBF blob compression")
+
+
+def check_header_block(data):
+    """Raise an exception if an OSMHeader blob needs unsupported features"""
+    required = [value.decode('utf-8') for field, value in iter_fields(data) if field == 4]
+    unsupported = [f for f in required if f not in SUPPORTED_FEATURES]
+    if unsupported:
+        raise Exception("The PBF file needs unsupported features: %s" % (", ".join(unsupported),))
+
+
+class SortedIds(object):
+
+    """A set of element IDs, kept as a sorted array of 64 bit integers
+
+    That takes 8 bytes per ID, rather than the 60 or so of a set of
+    Python ints, and is pickled as just those bytes, so it's quick to
+    send to the worker processes of a PBFReader.  numpy is used for
+    it if it's installed:
+
+    >>> ids = SortedIds([30, 10, 20, 10])
+    >>> len(ids), 20 in ids, 25 in ids, 40 in ids, list(ids)
+    (3, True, False, False, [10, 20, 30])
+    >>> ids.mask([5, 10, 15, 20])
+    [False, True, False, True]
+    >>> with patch.dict(SortedIds.mask.__globals__, {'numpy': None}):
+    ...     ids = SortedIds([30, 10, 20, 10])
+    ...     list(ids), 20 in ids, 25 in ids, ids.mask([5, 10, 15, 20])
+    ([10, 20, 30], True, False, [False, True, False, True])
+    """
+
+    def __init__(self, ids=()):
+        if numpy is not None:
+            self.ids = numpy.unique(numpy.fromiter(ids, dtype=numpy.int64))
+        else:
+            self.ids = array('q', sorted(set(ids)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return (int(i) for i in self.ids)
+
+    def __contains__(self, element_id):
+        ids = self.ids
+        i = ids.searchsorted(element_id) if numpy is not None else bisect_left(ids, element_id)
+        return i < len(ids) and ids[i] == element_id
+
+    def mask(self, element_ids):
+        """Return a list of whether each of element_ids is in the set"""
+        ids = self.ids
+        if numpy is None or not len(ids):
+            return [i in self for i in element_ids]
+        element_ids = numpy.array(element_ids, dtype=numpy.int64)
+        positions = numpy.minimum(ids.searchsorted(element_ids), len(ids) - 1)
+        return (ids[positions] == element_ids).tolist()
+
+
+class Selection(object):
+
+    """Which elements to decode from the blocks of a PBF file
+
+    Nodes, ways or relations are wanted if their IDs are in node_ids,
+    way_ids or relation_ids respectively (iterables of IDs, which are
+    kept as SortedIds).  Ways and relations are also
+    wanted if their tags match one of tag_filters, each of which is a
+    dictionary of tags that must all be present:
+
+    >>> selection = Selection(tag_filters=[{'boundary': 'administrative', 'admin_level': '2'}],
+    ...                       node_ids=set([12]))
+    >>> selection.wants('relation', 1, {'boundary': 'administrative', 'admin_level': '2'})
+    True
+    >>> selection.wants('relation', 2, {'boundary': 'administrative', 'admin_level': '4'})
+    False
+    >>> selection.wants('node', 12, {}), selection.decodes('way'), selection.decodes('node')
+    (True, True, True)
+    """
+
+    def __init__(self, tag_filters=(), node_ids=None, way_ids=None, relation_ids=None):
+        self.tag_filters = [dict(f) for f in tag_filters]
+        self.ids = dict((element_type, ids if isinstance(ids, SortedIds) else SortedIds(ids or ()))
+                        for element_type, ids in (('node', node_ids), ('way', way_ids), ('relation', relation_ids)))
+
+    def decodes(self, element_type):
+        """Return whether any elements of element_type could be wanted"""
+        return bool(self.ids[element_type]) or (element_type != 'node' and bool(self.tag_filters))
+
+    def wants_id(self, element_type, element_id):
+        return element_id in self.ids[element_type]
+
+    def matches_tags(self, tags):
+        return any(all(tags.get(k) == v for k, v in f.items()) for f in self.tag_filters)
+
+    def wants(self, element_type, element_id, tags):
+        return self.wants_id(element_type, element_id) or (element_type != 'node' and self.matches_tags(tags))
+
+
+def decode_tags(strings, keys, values):
+    return dict((strings[k], strings[v]) for k, v in zip(unpack_varints(keys), unpack_varints(values)))
+
+
+def decode_block(data, selection):
+    """Decode the elements that selection wants from a PrimitiveBlock
+
+    This returns the set of element types that are in the block, and
+    a list of (element_type, element_id, value, tags) tuples, where
+    the value is a (lat, lon) tuple in units of 10^-7 degrees for a
+    node, a list of node IDs for a way, and a list of (member type,
+    member ID, role) tuples for a relation.  Element types that
+    selection can't want are only noted as being in the block.
+    """
+    strings = []
+    groups = []
+    granularity = 100
+    lat_offset = 0
+    lon_offset = 0
+    for field, value in iter_fields(data):
+        if field == 1:
+            strings = [s.decode('utf-8') for f, s in iter_fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 19:
+            lat_offset = signed(value)
+        elif field == 20:
+            lon_offset = signed(value)
+
+    def location(lat, lon):
+        return ((lat_offset + granularity * lat) // 100, (lon_offset + granularity * lon) // 100)
+
+    types = set()
+    elements = []
+    for group in groups:
+        for field, value in iter_fields(group):
+            element_type = {1: 'node', 2: 'node', 3: 'way', 4: 'relation'}.get(field)
+            if element_type is None:
+                continue
+            types.add(element_type)
+            if not selection.decodes(element_type):
+                continue
+            if field == 2:
+                elements.extend(decode_dense_nodes(value, strings, selection, location))
+                continue
+            fields = {}
+            for f, v in iter_fields(value):
+                if f in fields and isinstance(v, bytes):
+                    fields[f] += v
+                else:
+                    fields[f] = v
+            # A Node's ID is a sint64, but those of Ways and Relations
+            # are int64s:
+            element_id = unzigzag([fields.get(1, 0)])[0] if field == 1 else signed(fields.get(1, 0))
+            if not selection.wants_id(element_type, element_id) and (field == 1 or not selection.tag_filters):
+                continue
+            tags = decode_tags(strings, fields.get(2, b''), fields.get(3, b''))
+            if not selection.wants(element_type, element_id, tags):
+                continue
+            if field == 1:
+                lat, lon = unzigzag([fields[8], fields[9]])
+                element_value = location(lat, lon)
+            elif field == 3:
+                element_value = undelta(unzigzag(unpack_varints(fields.get(8, b''))))
+            else:
+                element_value = list(zip(
+                    [ELEMENT_TYPES[t] for t in unpack_varints(fields.get(10, b''))],
+                    undelta(unzigzag(unpack_varints(fields.get(9, b'')))),
+                    [strings[r] for r in unpack_varints(fields.get(8, b''))]))
+            elements.append((element_type, element_id, element_value, tags))
+    return types, elements
+
+
+def decode_dense_nodes(data, strings, selection, location):
+    """Decode the nodes that selection wants from a DenseNodes message"""
+    fields = {}
+    for field, value in iter_fields(data):
+        fields.setdefault(field, []).extend(unpack_varints(value) if field != 5 else [])
+    ids = undelta(unzigzag(fields.get(1, [])))
+    lats = undelta(unzigzag(fields.get(8, [])))
+    lons = undelta(unzigzag(fields.get(9, [])))
+    keys_vals = fields.get(10)
+    wanted = selection.ids['node'].mask(ids)
+    nodes = []
+    kv = 0
+    for i, node_id in enumerate(ids):
+        tags = {}
+        if keys_vals:
+            while keys_vals[kv]:
+                tags[strings[keys_vals[kv]]] = strings[keys_vals[kv + 1]]
+                kv += 2
+            kv += 1
+        if wanted[i]:
+            nodes.append(('node', node_id, location(lats[i], lons[i]), tags))
+    return nodes
+
+
+# The Selection that the worker processes of a PBFReader decode with,
+# set once for each pass rather than sent with every block:
+worker_selection = None
+
+
+def set_worker_selection(selection):
+    global worker_selection
+    worker_selection = selection
+
+
+def decode_blob_in_worker(blob):
+    return decode_block(decompress_blob(blob), worker_selection)
+
+
+class PBFReader(object):
+
+    """Reads the elements that a Selection wants from an .osm.pbf file
+
+    Each call to scan() is a pass through the file, in which the
+    blocks are decompressed and decoded in a pool of processes (if
+    processes is more than 1), with only a few more blocks read ahead
+    than there are processes.  The first pass notes which element
+    types each block holds, so that later passes can skip the blocks
+    that can't have anything they want; in a file sorted in the usual
+    way, that's most of them.
+    """
+
+    def __init__(self, filename, processes=None):
+        self.filename = filename
+        self.processes = processes or os.cpu_count() or 1
+        # (offset, types) for each data block, once known:
+        self.block_types = None
+
+    def iter_data_blobs(self, fp, types):
+        if self.block_types is None:
+            for offset, blob_type, blob in iter_blobs(fp):
+                if blob_type == 'OSMHeader':
+                    check_header_block(decompress_blob(blob))
+                elif blob_type == 'OSMData':
+                    yield offset, blob
+            return
+        for offset, block_types in self.block_types:
+            if types is None or block_types & types:
+                fp.seek(offset)
+                _, _, blob = next(iter_blobs(fp))
+                yield offset, blob
+
+    def scan(self, selection, types=None):
+        """Yield the elements that selection wants, block by block
+
+        If types is given, only blocks that hold elements of those
+        types (if that's known yet) are read.
+        """
+        record_types = self.block_types is None
+        block_types = []
+        with open(self.filename, 'rb') as fp:
+            if self.processes <= 1:
+                for offset, blob in self.iter_data_blobs(fp, types):
+                    found_types, elements = decode_block(decompress_blob(blob), selection)
+                    block_types.append((offset, found_types))
+                    for e in elements:
+                        yield e
+            else:
+                pending = deque()
+                with ProcessPoolExecutor(max_workers=self.processes,
+                                         initializer=set_worker_selection,
+                                         initargs=(selection,)) as executor:
+                    for offset, blob in self.iter_data_blobs(fp, types):
+                        pending.append((offset, executor.submit(decode_blob_in_worker, blob)))
+                        while len(pending) > 2 * self.processes:
+                            yield from self.finish_block(pending, block_types)
+                    while pending:
+                        yield from self.finish_block(pending, block_types)
+        if record_types:
+            self.block_types = block_types
+
+    def finish_block(self, pending, block_types):
+        offset, future = pending.popleft()
+        found_types, elements = future.result()
+        block_types.append((offset, found_types))
+        return elements
+
+
+class PBFExtract(object):
+
+    """The boundaries in a PBF file, with everything they're made of
+
+    This reads the file in passes: the first finds the relations and
+    ways whose tags match one of tag_filters, and then there are
+    passes for any member relations that were missed and for the
+    member ways.  Members with one of ignored_roles (e.g. subareas)
+    aren't read at all.  The IDs of all the nodes those are made of
+    are then kept as SortedIds.
+
+    The elements can then be given to a SAX-style handler, as if they
+    were an Overpass response, with feed().  That makes another pass
+    for the nodes, which go straight to the handler as they're
+    decoded, so there's never a copy of them all here:
+
+    >>> tmp_directory = mkdtemp()
+    >>> filename = os.path.join(tmp_directory, 'example.osm.pbf')
+    >>> with open(filename, 'wb') as fp:
+    ...     write_pbf(fp, [
+    ...         ('node', 1, (520000000, 10000000), {}),
+    ...         ('node', 2, (520000000, 20000000), {}),
+    ...         ('node', 3, (510000000, 20000000), {}),
+    ...         ('node', 4, (500000000, 0), {'place': 'town'}),
+    ...         ('way', 10, [1, 2, 3, 1], {}),
+    ...         ('way', 11, [4, 1], {'highway': 'road'}),
+    ...         ('relation', 20, [('way', 10, 'outer'), ('node', 4, 'admin_centre')],
+    ...          {'boundary': 'administrative', 'admin_level': '2'}),
+    ...         ('relation', 21, [('relation', 20, 'subarea')],
+    ...          {'boundary': 'administrative', 'admin_level': '1'}),
+    ...     ])
+    >>> extract = PBFExtract(filename, [{'boundary': 'administrative', 'admin_level': '2'}],
+    ...                      ignored_roles=('subarea',), processes=1)
+    >>> extract.boundaries
+    [('relation', 20)]
+    >>> list(extract.node_ids), sorted(extract.ways), sorted(extract.relations)
+    ([1, 2, 3, 4], [10], [20])
+    >>> class Printer(object):
+    ...     def startElement(self, name, attr):
+    ...         if name in ('node', 'way', 'relation'):
+    ...             print(name, attr['id'])
+    ...     def endElement(self, name):
+    ...         pass
+    >>> extract.feed(Printer())
+    node 1
+    node 2
+    node 3
+    node 4
+    way 10
+    relation 20
+
+    Remove the temporary directory created for these doctests:
+
+    >>> shutil.rmtree(tmp_directory)
+    """
+
+    def __init__(self, filename, tag_filters, ignored_roles=(), processes=None):
+        self.reader = PBFReader(filename, processes)
+        self.ignored_roles = set(ignored_roles)
+        self.node_ids = SortedIds()
+        self.ways = {}
+        self.relations = {}
+        self.boundaries = []
+        self.read_boundaries(tag_filters)
+        self.read_relations()
+        self.read_ways()
+        self.read_nodes()
+
+    def store(self, elements):
+        d = {'way': self.ways, 'relation': self.relations}
+        for element_type, element_id, value, tags in elements:
+            d[element_type][element_id] = (value, tags)
+
+    def read_boundaries(self, tag_filters):
+        elements = list(self.reader.scan(Selection(tag_filters=tag_filters)))
+        self.boundaries = [(e[0], e[1]) for e in elements]
+        self.store(elements)
+
+    def members(self, member_type):
+        return set(member_id
+                   for members, tags in self.relations.values()
+                   for t, member_id, role in members
+                   if t == member_type and role not in self.ignored_roles)
+
+    def read_relations(self):
+        """Read member relations until there are none missing (or in the file)"""
+        tried = set(self.relations)
+        while True:
+            missing = self.members('relation') - tried
+            if not missing:
+                return
+            tried |= missing
+            self.store(self.reader.scan(Selection(relation_ids=missing), set(['relation'])))
+
+    def read_ways(self):
+        missing = self.members('way') - set(self.ways)
+        if missing:
+            self.store(self.reader.scan(Selection(way_ids=missing), set(['way'])))
+
+    def read_nodes(self):
+        self.node_ids = SortedIds(chain(self.members('node'), *(refs for refs, tags in self.ways.values())))
+
+    def iter_nodes(self):
+        """Yield (node_id, (lat, lon), tags) for each node, as they're read from the file"""
+        if self.node_ids:
+            for element_type, node_id, location, tags in self.reader.scan(Selection(node_ids=self.node_ids),
+                                                                          set(['node'])):
+                yield node_id, location, tags
+
+    def feed(self, handler):
+        """Call handler's startElement and endElement methods for each element
+
+        This is done as for feed_elements, but with the nodes in the
+        order they're in the file.
+        """
+        handler.startElement('osm', {'version': '0.6'})
+        feed_nodes(handler, self.iter_nodes())
+        feed_ways_and_relations(handler, self.ways, self.relations)
+        handler.endElement('osm')
+
+
+def relation_order(relations):
+    """Return the IDs of relations with every member relation before its parents
+
+    relations maps the ID of each relation to a (members, tags)
+    tuple.  A cycle of relations is broken somewhere:
+
+    >>> relation_order({1: ([('relation', 2, '')], {}),
+    ...                 2: ([('relation', 3, ''), ('way', 4, 'outer')], {}),
+    ...                 3: ([('relation', 1, '')], {})})
+    [3, 2, 1]
+    """
+    order = []
+    done = set()
+
+    def visit(relation_id, visiting):
+        if relation_id in done or relation_id in visiting or relation_id not in relations:
+            return
+        visiting.add(relation_id)
+        for t, member_id, role in relations[relation_id][0]:
+            if t == 'relation':
+                visit(member_id, visiting)
+        visiting.discard(relation_id)
+        done.add(relation_id)
+        order.append(relation_id)
+
+    for relation_id in sorted(relations):
+        visit(relation_id, set())
+    return order
+
+
+def feed_elements(handler, nodes, ways, relations):
+    """Call a SAX-style handler's methods as if for an Overpass response
+
+    nodes, ways and relations are dictionaries that map IDs to the
+    (value, tags) of each element, with values as from decode_block.
+    Nodes come first, then ways, and then relations (in
+    relation_order), so that a handler always knows an element's
+    members by the time it reaches it.  Coordinates are given with 7
+    decimal places, as Overpass gives them:
+
+    >>> class Printer(object):
+    ...     def startElement(self, name, attr):
+    ...         print(name, sorted(attr.items()))
+    ...     def endElement(self, name):
+    ...         pass
+    >>> feed_elements(Printer(), {1: ((520000000, -5000000), {})}, {2: ([1], {'name': 'Here'})}, {})
+    osm [('version', '0.6')]
+    node [('id', '1'), ('lat', '52.0000000'), ('lon', '-0.5000000')]
+    way [('id', '2')]
+    nd [('ref', '1')]
+    tag [('k', 'name'), ('v', 'Here')]
+    """
+    handler.startElement('osm', {'version': '0.6'})
+    feed_nodes(handler, ((node_id, location, tags) for node_id, (location, tags) in sorted(nodes.items())))
+    feed_ways_and_relations(handler, ways, relations)
+    handler.endElement('osm')
+
+
+def feed_tags(handler, tags):
+    for k, v in tags.items():
+        handler.startElement('tag', {'k': k, 'v': v})
+        handler.endElement('tag')
+
+
+def feed_nodes(handler, nodes):
+    """Call a SAX-style handler's methods for each (node_id, (lat, lon), tags) in nodes"""
+    start, end = handler.startElement, handler.endElement
+    for node_id, (lat, lon), tags in nodes:
+        start('node', {'id': str(node_id), 'lat': '%.7f' % (lat / 1e7,), 'lon': '%.7f' % (lon / 1e7,)})
+        feed_tags(handler, tags)
+        end('node')
+
+
+def feed_ways_and_relations(handler, ways, relations):
+    """Call a SAX-style handler's methods for ways and relations, as for feed_elements"""
+    start, end = handler.startElement, handler.endElement
+    for way_id, (refs, way_tags) in sorted(ways.items()):
+        start('way', {'id': str(way_id)})
+        for ref in refs:
+            start('nd', {'ref': str(ref)})
+            end('nd')
+        feed_tags(handler, way_tags)
+        end('way')
+    for relation_id in relation_order(relations):
+        members, relation_tags = relations[relation_id]
+        start('relation', {'id': str(relation_id)})
+        for member_type, member_id, role in members:
+            start('member', {'type': member_type, 'ref': str(member_id), 'role': role})
+            end('member')
+        feed_tags(handler, relation_tags)
+        end('relation')
+
+
+def encode_varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def encode_field(field, value):
+    """Encode a protobuf field: an int as a varint, and bytes as length-delimited"""
+    if isinstance(value, int):
+        return encode_varint(field << 3 | VARINT) + encode_varint(value if value >= 0 else value + (1 << 64))
+    return encode_varint(field << 3 | LENGTH_DELIMITED) + encode_varint(len(value)) + value
+
+
+def encode_packed(field, values):
+    return encode_field(field, b''.join(encode_varint(v) for v in values))
+
+
+def zigzag(values):
+    return [(n << 1) ^ (n >> 63) for n in values]
+
+
+def delta(values):
+    return [b - a for a, b in zip([0] + values[:-1], values)]
+
+
+def write_blob(fp, blob_type, data):
+    blob = encode_field(2, len(data)) + encode_field(3, zlib.compress(data))
+    header = encode_field(1, blob_type.encode('utf-8')) + encode_field(3, len(blob))
+    fp.write(struct.pack('!I', len(header)) + header + blob)
+
+
+def write_pbf(fp, elements, block_size=8000):
+    """Write elements as a PBF file, in blocks of up to block_size of each type
+
+    The elements are tuples like those that decode_block returns, in
+    the usual order of nodes, ways and then relations.  This is for
+    making files to test and benchmark the reader with:
+
+    >>> fp = BytesIO()
+    >>> write_pbf(fp, [('node', 1, (520000000, 10000000), {'name': 'Here'}),
+    ...                ('way', 10, [1, 1], {})])
+    >>> _ = fp.seek(0)
+    >>> for offset, blob_type, blob in iter_blobs(fp):
+    ...     if blob_type == 'OSMData':
+    ...         print(decode_block(decompress_blob(blob), Selection(node_ids=set([1]), way_ids=set([10]))))
+    ({'node'}, [('node', 1, (520000000, 10000000), {'name': 'Here'})])
+    ({'way'}, [('way', 10, [1, 1], {})])
+    """
+    header = b''.join(encode_field(4, f.encode('utf-8')) for f in sorted(SUPPORTED_FEATURES))
+    write_blob(fp, 'OSMHeader', header)
+    blocks = []
+    for e in elements:
+        if not blocks or blocks[-1][0][0] != e[0] or len(blocks[-1]) >= block_size:
+            blocks.append([])
+        blocks[-1].append(e)
+    for block in blocks:
+        strings = {'': 0}
+
+        def sid(s):
+            return strings.setdefault(s, len(strings))
+
+        element_type = block[0][0]
+        if element_type == 'node':
+            keys_vals = []
+            for e in block:
+                for k, v in e[3].items():
+                    keys_vals += [sid(k), sid(v)]
+                keys_vals.append(0)
+            group = encode_field(2, b''.join([
+                encode_packed(1, zigzag(delta([e[1] for e in block]))),
+                encode_packed(8, zigzag(delta([e[2][0] for e in block]))),
+                encode_packed(9, zigzag(delta([e[2][1] for e in block]))),
+                encode_packed(10, keys_vals)]))
+        else:
+            messages = []
+            for element_id, value, tags in (e[1:] for e in block):
+                message = encode_field(1, element_id)
+                message += encode_packed(2, [sid(k) for k in tags])
+                message += encode_packed(3, [sid(v) for v in tags.values()])
+                if element_type == 'way':
+                    message += encode_packed(8, zigzag(delta(value)))
+                else:
+                    message += encode_packed(8, [sid(role) for t, member_id, role in value])
+                    message += encode_packed(9, zigzag(delta([member_id for t, member_id, role in value])))
+                    message += encode_packed(10, [ELEMENT_TYPES.index(t) for t, member_id, role in value])
+                messages.append(encode_field(3 if element_type == 'way' else 4, message))
+            group = b''.join(messages)
+        string_table = b''.join(encode_field(1, s.encode('utf-8')) for s in sorted(strings, key=strings.get))
+        write_blob(fp, 'OSMData', encode_field(1, string_table) + encode_field(2, group))
@@ -94,6 +94,49 @@ def compare_polygons(area, new_geometry, verbose):
     return False
 
 
+def read_file_list(filename):
+    """Return the set of non-empty lines in filename, without surrounding whitespace"""
+    with open(filename) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def osm_element_from_filename(filename):
+    """Return the (OSM element type, ID) that a KML file is for, from its name"""
+    m = re.search(r'^(way|relation)-(\d+)-', os.path.basename(filename))
+    if not m:
+        raise Exception("Couldn't extract OSM element type and ID from: " + filename)
+    return m.groups()
+
+
+def retire_area(filename, current_generation, commit, verbose):
+    """Take the area that a removed KML file was for out of the current generation
+
+    filename is relative to the KML directory, so its directory is
+    the MapIt type.  The area is kept for earlier generations, or
+    deleted if it was only in the current one."""
+    type_code = os.path.dirname(filename)
+    osm_type, osm_id = osm_element_from_filename(filename)
+    code_type_code = {'relation': 'osm_rel', 'way': 'osm_way'}[osm_type]
+    areas = Area.objects.filter(type__code=type_code,
+                                codes__type__code=code_type_code,
+                                codes__code=osm_id,
+                                generation_low__lte=current_generation,
+                                generation_high__gte=current_generation)
+    if not areas:
+        verbose('No area in the current generation for the removed ' + filename)
+        return
+    previous_generation = Generation.objects.filter(id__lt=current_generation.id).order_by('-id').first()
+    for area in areas:
+        print(smart_str("  Retiring %s (%s)" % (area.name, filename)))
+        if not commit:
+            continue
+        if previous_generation is None or area.generation_low_id > previous_generation.id:
+            area.delete()
+        else:
+            area.generation_high = previous_generation
+            area.save()
+
+
 class Command(LabelCommand):
     help = 'Import OSM boundary data from KML files'
     label = 'KML-DIRECTORY'
@@ -110,8 +153,25 @@ class Command(LabelCommand):
             action='store_true',
             help='Rather than importing to a new inactive generation, update the current, active generation')
         parser.add_argument('--commit', action='store_true', dest='commit', help='Actually update the database')
+        parser.add_argument(
+            '--only-listed',
+            metavar='FILENAME',
+            help='Only import the KML files listed in FILENAME (one per line, relative to KML-DIRECTORY), '
+                 'such as the list of changed files that get-boundaries-by-admin-level.py --changes writes; '
+                 'needs --alter-current-generation, since every other area is left as it is')
+        parser.add_argument(
+            '--retire-listed',
+            metavar='FILENAME',
+            help='Take the areas whose KML files are listed in FILENAME out of the current generation, '
+                 'such as the list of removed files that get-boundaries-by-admin-level.py --changes writes; '
+                 'needs --alter-current-generation')
 
     def handle_label(self, directory_name, **options):
+        for option in ('only_listed', 'retire_listed'):
+            if options[option] and not options['alter_current_generation']:
+                raise Exception("--%s needs --alter-current-generation, or every area not listed "
+                                "would be left out of the new generation" % (option.replace('_', '-'),))
+
         current_generation = Generation.objects.current()
         if options['alter_current_generation']:
             new_generation = current_generation
@@ -123,6 +183,14 @@ class Command(LabelCommand):
         if not os.path.isdir(directory_name):
             raise Exception("'%s' is not a directory" % (directory_name,))
 
+        listed = None
+        if options['only_listed']:
+            listed = read_file_list(options['only_listed'])
+
+        to_retire = []
+        if options['retire_listed']:
+            to_retire = read_file_list(options['retire_listed'])
+
         os.chdir(directory_name)
 
         mapit_type_glob = smart_str("[A-Z0-9][A-Z0-9][A-Z0-9]")
@@ -152,6 +220,14 @@ class Command(LabelCommand):
 
         global_country = Country.objects.get(code='G')
 
+        # An element whose KML was removed from one place but written
+        # somewhere else (say, if its admin_level changed) is updated
+        # by the import below rather than retired:
+        still_listed = set(osm_element_from_filename(f) for f in listed or ())
+        for filename in sorted(to_retire):
+            if osm_element_from_filename(filename) not in still_listed:
+                retire_area(filename, current_generation, options['commit'], verbose)
+
         # print json.dumps(language_code_to_name, sort_keys=True, indent=4)
 
         skip_up_to = None
@@ -171,6 +247,8 @@ class Command(LabelCommand):
             verbose("Loading all KML in " + type_directory)
 
             files = sorted(os.listdir(type_directory))
+            if listed is not None:
+                files = [e for e in files if os.path.join(type_directory, e) in listed]
             total_files = len(files)
 
             for i, e in enumerate(files):
@@ -187,11 +265,7 @@ class Command(LabelCommand):
                     verbose("Ignoring non-KML file: " + e)
                     continue
 
-                m = re.search(r'^(way|relation)-(\d+)-', e)
-                if not m:
-                    raise Exception("Couldn't extract OSM element type and ID from: " + e)
-
-                osm_type, osm_id = m.groups()
+                osm_type, osm_id = osm_element_from_filename(e)
 
                 kml_filename = os.path.join(type_directory, e)
 
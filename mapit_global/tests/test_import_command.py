@@ -379,3 +379,38 @@ class ImportCommandTests(TestCase):
             [('osm_attr_ref', 'source:XYZ'), ('osm_way', '1234')]
         assert list(area.names.values_list('type__code', 'name')) == \
             [('default', 'New Ambridge'), ('fr', 'Nouveau Ambridge')]
+
+    def test_only_listed_needs_alter_current_generation(self):
+        call_command('loaddata', 'global.json')
+        call_command('mapit_generation_create', '--commit', '--desc=Initial import')
+        with example_files('OCL', []) as tmp_dir:
+            listed = join(tmp_dir, 'changed-files.txt')
+            with open(listed, 'w') as f:
+                f.write('OCL/way-1234-ambridge.kml\n')
+            with self.assertRaises(Exception):
+                call_command('mapit_global_import', '--commit', '--only-listed', listed, tmp_dir)
+
+    def test_retire_listed(self):
+        call_command('loaddata', 'global.json')
+        files = [
+            ('way-1234-ambridge.kml',
+             get_example_kml({'name': 'Ambridge'}, include_big_square=True)),
+            ('way-5678-borchester.kml',
+             get_example_kml({'name': 'Borchester'}, include_small_square=True)),
+        ]
+        # Import the same files into two generations:
+        for description in ('Initial import', 'Second import'):
+            call_command('mapit_generation_create', '--commit', '--desc=' + description)
+            with example_files('OCL', files) as tmp_dir:
+                call_command('mapit_global_import', '--commit', tmp_dir)
+            call_command('mapit_generation_activate', '--commit')
+        first_generation, second_generation = Generation.objects.order_by('id')
+        # Then retire one of them from the current generation:
+        with example_files('OCL', []) as tmp_dir:
+            removed = join(tmp_dir, 'removed-files.txt')
+            with open(removed, 'w') as f:
+                f.write('OCL/way-5678-borchester.kml\n')
+            call_command('mapit_global_import', '--commit', '--alter-current-generation',
+                         '--retire-listed', removed, tmp_dir)
+        assert Area.objects.get(name='Ambridge').generation_high == second_generation
+        assert Area.objects.get(name='Borchester').generation_high == first_generation